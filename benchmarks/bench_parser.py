@@ -0,0 +1,68 @@
+"""Speedup of the bulk engine of data_parser.tracing_parser over the python engine on the bundled traces.
+
+The engines are timed in turns on each trace, so that both see the same load of the machine, and the
+speedup of each trace is the ratio of their best times.
+
+Usage:
+    python -m benchmarks.bench_parser [--repeat N] [trace.txt ...]
+"""
+from indoor_positioning import data_parser
+
+import argparse
+import glob
+import sys
+import time
+
+DEFAULT_TRACES = "./dataset/5cd56b6ae2acfd2d33b59ccb/F1/*.txt"
+ENGINES = ["python", "bulk"]
+
+
+def time_engines(trace_filename, repeat):
+    """Best wall time of parsing a tracing file with each engine
+
+    Args:
+        trace_filename (str): Tracing file to parse
+        repeat (int): Number of timed runs of each engine
+
+    Returns:
+        dict: Best time in seconds by engine
+    """
+    best = dict.fromkeys(ENGINES, float("inf"))
+    for engine in ENGINES:
+        data_parser.tracing_parser(trace_filename, engine=engine)
+    for _ in range(repeat):
+        for engine in ENGINES:
+            start = time.perf_counter()
+            data_parser.tracing_parser(trace_filename, engine=engine)
+            best[engine] = min(best[engine], time.perf_counter() - start)
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("traces", nargs="*", default=sorted(glob.glob(DEFAULT_TRACES)))
+    parser.add_argument("--repeat", type=int, default=20, help="Number of timed runs of each engine")
+    args = parser.parse_args(argv)
+
+    totals = dict.fromkeys(ENGINES, 0.0)
+    total_lines = 0
+    for trace_filename in args.traces:
+        with open(trace_filename, "rb") as f:
+            n_lines = f.read().count(b"\n")
+        total_lines += n_lines
+        times = time_engines(trace_filename, args.repeat)
+        for engine in ENGINES:
+            totals[engine] += times[engine]
+        print("{}: {} lines, {}, speedup x{:.2f}".format(
+            trace_filename, n_lines,
+            ", ".join("{} {:.1f} ms".format(engine, times[engine] * 1e3) for engine in ENGINES),
+            times["python"] / times["bulk"]))
+
+    for engine in ENGINES:
+        print("{}: {:.0f} lines/s".format(engine, total_lines / totals[engine]))
+    print("speedup x{:.2f}".format(totals["python"] / totals["bulk"]))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
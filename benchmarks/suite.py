@@ -0,0 +1,305 @@
+"""Benchmark suite of the parsing, processing, gridding and visualization stages, with a stored baseline.
+
+Every case is run on the bundled traces and floors, and on synthetic scaled-up ones: traces repeated with
+shifted timestamps, floors scaled up and gridded with smaller cells, and larger waypoint sets. Each timed run
+of a case calls it as many times as needed to last at least --min-time seconds, so that the fastest cases are
+not dominated by the timer and scheduling noise. The throughput of a case is its best of --repeat timed runs,
+and its peak memory is the peak traced by tracemalloc during one more call.
+
+Absolute throughputs only compare with a baseline recorded on the same host, so the baseline is regenerated
+with --update-baseline on each host. The ratios of cases timed on the same run, such as the speedup of the bulk
+engine of the parser over the python engine, are compared with any baseline.
+
+Usage:
+    python -m benchmarks.suite [--repeat N] [--min-time S] [--quick] [--output FILE] [--baseline FILE]
+                               [--threshold T] [--update-baseline] [--filter TEXT]
+"""
+from indoor_positioning import data_parser, data_processing, visualizer
+from indoor_positioning.gridding.format import extract_geometries, transform
+from indoor_positioning.gridding.occupancy import OccupancyGridMap
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable
+
+import argparse
+import glob
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+
+VENUE_ID = "5cd56b6ae2acfd2d33b59ccb"
+VENUE_DIR = "./dataset/" + VENUE_ID
+METADATA_DIR = "./dataset/metadata/"
+DEFAULT_BASELINE = str(Path(__file__).with_name("baseline.json"))
+
+
+@dataclass
+class Case:
+    """A benchmarked stage on one input: run processes size units (lines, samples, cells or points)"""
+
+    name: str
+    unit: str
+    size: int
+    run: Callable
+
+
+def measure(case, repeat, min_time=0.2):
+    """Best time, throughput and peak memory of a case
+
+    Args:
+        case (Case): Benchmarked case
+        repeat (int): Number of timed runs
+        min_time (float, optional): Minimum duration of a timed run in seconds, the case is called as many
+        times as needed to reach it. Defaults to 0.2.
+
+    Returns:
+        dict: Result of the case, whose seconds are the best time of one call
+    """
+    # The warm-up call also sets the number of calls of each timed run
+    start = time.perf_counter()
+    case.run()
+    number = max(1, int(np.ceil(min_time / max(time.perf_counter() - start, 1e-9))))
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            case.run()
+        best = min(best, (time.perf_counter() - start) / number)
+
+    # The peak is measured on its own run, as tracing the allocations slows the code down
+    tracemalloc.start()
+    case.run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"seconds": best, "number": number, "size": case.size, "unit": case.unit,
+            "throughput": case.size / best, "peak_bytes": peak}
+
+
+def scaled_trace(trace_filename, factor, output_dir):
+    """Synthetic trace made of a tracing file repeated factor times, each copy shifted after the previous one
+
+    Args:
+        trace_filename (str): Tracing file to repeat
+        factor (int): Number of copies
+        output_dir (str): Folder of the synthetic trace, which has the floor folder of the original one
+
+    Returns:
+        str: Path of the synthetic trace
+    """
+    with open(trace_filename, encoding="utf-8") as f:
+        lines = f.read().splitlines()
+    header = [line for line in lines[:10] if line.startswith("#")]
+    body = [line.split("\t", 1) for line in lines if line and not line.startswith("#")]
+    tss = np.array([int(fields[0]) for fields in body], dtype=np.int64)
+    duration = int(tss.max() - tss.min()) + 1
+
+    output_file = Path(output_dir) / Path(trace_filename).parent.name / \
+        "{}_x{}.txt".format(Path(trace_filename).stem, factor)
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(output_file, "w", encoding="utf-8") as f:
+        f.write("\n".join(header) + "\n")
+        for copy_ix in range(factor):
+            f.write("\n".join("{}\t{}".format(ts + copy_ix * duration, fields[1])
+                              for ts, fields in zip(tss, body)) + "\n")
+        f.write("#\tendTime:{}\n".format(tss.max() + (factor - 1) * duration))
+    return str(output_file)
+
+
+def count_lines(trace_filename):
+    with open(trace_filename, "rb") as f:
+        return f.read().count(b"\n")
+
+
+def build_cases(work_dir, quick=False):
+    """Cases of the suite
+
+    Args:
+        work_dir (str): Folder of the synthetic inputs and the written reports
+        quick (bool, optional): Whether to skip the largest synthetic inputs. Defaults to False.
+
+    Returns:
+        list(Case): Cases of every stage
+    """
+    traces = sorted(glob.glob(VENUE_DIR + "/*/*.txt"))
+    factors = [10] if quick else [10, 50]
+    synthetic_traces = [scaled_trace(traces[0], factor, work_dir) for factor in factors]
+    cases = []
+
+    # Parsing, with the default bulk engine and the python engine
+    for trace_filename in traces + synthetic_traces:
+        cases.append(Case("parser/{}".format(Path(trace_filename).stem), "lines", count_lines(trace_filename),
+                          lambda trace_filename=trace_filename: data_parser.tracing_parser(trace_filename)))
+        cases.append(Case("parser_python/{}".format(Path(trace_filename).stem), "lines",
+                          count_lines(trace_filename), lambda trace_filename=trace_filename:
+                          data_parser.tracing_parser(trace_filename, engine="python")))
+
+    # Processing
+    for trace_filename in traces + synthetic_traces:
+        parsed_data = data_parser.tracing_parser(trace_filename)
+        cases.append(Case("acc_df/{}".format(Path(trace_filename).stem), "samples", len(parsed_data.acc_calib),
+                          lambda parsed_data=parsed_data: data_processing.acc_df(parsed_data)))
+
+    # Gridding, every floor of the venue and a scaled-up floor with smaller cells
+    floors = sorted(Path(floor_dir).name for floor_dir in glob.glob(METADATA_DIR + VENUE_ID + "/*"))
+    for floor_name in floors:
+        floorplan = data_parser.floorplan(METADATA_DIR, VENUE_DIR + "/" + floor_name)
+        geometry = extract_geometries(floorplan["floor_geojson"])
+        for scale, cell_size in [(1, 0.5), (1, 0.25)] + ([] if quick else [(1, 0.1), (4, 0.25)]):
+            layout = transform(geometry, dict(floorplan, width=floorplan["width"] * scale,
+                                              height=floorplan["height"] * scale))
+            n_cells = int(np.ceil(layout.bounds[2] / cell_size)) * int(np.ceil(layout.bounds[3] / cell_size))
+            cases.append(Case("grid/{}_x{}_{}m".format(floor_name, scale, cell_size), "cells", n_cells,
+                              lambda layout=layout, cell_size=cell_size: OccupancyGridMap(layout, cell_size)))
+
+    # Waypoints, the bundled floor and larger synthetic sets over the same area
+    waypoints = np.asarray(data_parser.waypoint_list(VENUE_DIR + "/F1"), dtype="float64")
+    rng = np.random.default_rng(0)
+    for n_waypoints in [waypoints.shape[0]] + ([10000] if quick else [10000, 100000]):
+        points = waypoints if n_waypoints == waypoints.shape[0] else \
+            rng.uniform(waypoints.min(axis=0), waypoints.max(axis=0), (n_waypoints, 2))
+        cases.append(Case("nearest_node/{}".format(n_waypoints), "points", n_waypoints,
+                          lambda points=points: data_processing.nearest_node(points)))
+
+    # Visualization, downsampled accelerometer figures written with a shared plotly.js
+    for trace_filename in traces + synthetic_traces:
+        acc_df = data_processing.acc_df(data_parser.tracing_parser(trace_filename))
+        html_file = str(Path(work_dir) / (Path(trace_filename).stem + ".html"))
+        cases.append(Case("figures_to_html/{}".format(Path(trace_filename).stem), "samples", len(acc_df),
+                          lambda acc_df=acc_df, html_file=html_file: visualizer.figures_to_html(
+                              [visualizer.fig_acc_filter(acc_df, max_points=2000)], html_file, add_js="directory")))
+    return cases
+
+
+def host():
+    """Description of the host, the absolute throughputs of a baseline only hold on the host it was recorded on"""
+    return "{} {} {} cpus".format(platform.node(), platform.machine(), os.cpu_count())
+
+
+def ratios(results):
+    """Host independent ratios of the results: the speedup of the bulk engine of the parser over the python
+    engine on each trace
+
+    Args:
+        results (dict): Results of the run, by case name
+
+    Returns:
+        dict: Ratio by name
+    """
+    speedups = {}
+    for name, result in results.items():
+        prefix, _, trace = name.partition("/")
+        if prefix == "parser_python" and "parser/" + trace in results:
+            speedups["parser_speedup/" + trace] = result["seconds"] / results["parser/" + trace]["seconds"]
+    return speedups
+
+
+def compare_ratios(run_ratios, baseline_ratios, threshold):
+    """Ratios which fell more than threshold below their baseline
+
+    Args:
+        run_ratios (dict): Ratios of the run, by name
+        baseline_ratios (dict): Baseline ratios, by name
+        threshold (float): Tolerated relative drop of a ratio
+
+    Returns:
+        list(str): Description of each regression
+    """
+    regressions = []
+    for name, ratio in run_ratios.items():
+        if name in baseline_ratios and ratio < baseline_ratios[name] * (1 - threshold):
+            regressions.append("{}: x{:.2f}, baseline x{:.2f}".format(name, ratio, baseline_ratios[name]))
+    return regressions
+
+
+def compare(results, baseline, threshold):
+    """Cases whose throughput fell more than threshold below their baseline
+
+    Args:
+        results (dict): Results of the run, by case name
+        baseline (dict): Baseline results, by case name
+        threshold (float): Tolerated relative drop of throughput
+
+    Returns:
+        list(str): Description of each regression
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result["throughput"] / baseline[name]["throughput"]
+        if ratio < 1 - threshold:
+            regressions.append("{}: {:.3g} {}/s, {:.0%} of the baseline {:.3g} {}/s".format(
+                name, result["throughput"], result["unit"], ratio, baseline[name]["throughput"], result["unit"]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5, help="Number of timed runs of each case")
+    parser.add_argument("--min-time", type=float, default=0.2,
+                        help="Minimum duration of a timed run in seconds, short cases are called repeatedly")
+    parser.add_argument("--quick", action="store_true", help="Skip the largest synthetic inputs")
+    parser.add_argument("--filter", default="", help="Only run the cases whose name contains this text")
+    parser.add_argument("--output", default="./output/benchmarks.json", help="JSON file of the results")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="JSON file of the baseline results")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="Tolerated relative drop of throughput against the baseline")
+    parser.add_argument("--update-baseline", action="store_true", help="Save the results as the baseline")
+    args = parser.parse_args(argv)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        for case in build_cases(work_dir, quick=args.quick):
+            if args.filter not in case.name:
+                continue
+            results[case.name] = measure(case, args.repeat, args.min_time)
+            print("{:<48} {:>12.4g} {}/s {:>10.2f} ms {:>10.1f} MiB peak".format(
+                case.name, results[case.name]["throughput"], case.unit, results[case.name]["seconds"] * 1e3,
+                results[case.name]["peak_bytes"] / 2 ** 20))
+
+    run_ratios = ratios(results)
+    for name, ratio in run_ratios.items():
+        print("{:<48} {:>12.2f}x".format(name, ratio))
+
+    report = {"meta": {"python": platform.python_version(), "numpy": np.__version__,
+                       "platform": platform.platform(), "host": host(),
+                       "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "repeat": args.repeat,
+                       "min_time": args.min_time, "quick": args.quick},
+              "results": results, "ratios": run_ratios}
+    Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print("Baseline saved to {}".format(args.baseline))
+        return 0
+
+    if not Path(args.baseline).exists():
+        print("No baseline at {}, run with --update-baseline to save one".format(args.baseline))
+        return 0
+    with open(args.baseline) as f:
+        baseline_report = json.load(f)
+    regressions = compare_ratios(run_ratios, baseline_report.get("ratios", {}), args.threshold)
+    baseline = baseline_report["results"]
+    if baseline_report["meta"].get("host") != host():
+        print("The baseline was recorded on another host ({}), only the ratios are compared, run with "
+              "--update-baseline to record one on this host".format(baseline_report["meta"].get("host")))
+        baseline = {}
+    regressions += compare(results, baseline, args.threshold)
+    for regression in regressions:
+        print("REGRESSION " + regression)
+    print("{} cases, {} compared with the baseline, {} ratios, {} regressions".format(
+        len(results), len(set(results) & set(baseline)), len(set(run_ratios) & set(baseline_report.get("ratios", {}))),
+        len(regressions)))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,172 @@
+"""Venue or dataset wide batch parsing and feature extraction
+
+Usage:
+    python -m indoor_positioning.batch ROOT [--output DIR] [--workers N] [--chunksize K] [--cache-dir DIR]
+                                            [--cache-max-bytes B] [--instrument FILE] [--profile-trace ID]
+"""
+from indoor_positioning import data_parser, data_processing, instrumentation
+from indoor_positioning.data_parser import find_traces
+from indoor_positioning.trace_cache import TraceCache
+from functools import partial
+from multiprocessing import Pool
+from pathlib import Path
+
+import argparse
+import json
+import os
+import sys
+import time
+import numpy as np
+
+# TraceCache of the worker process, created once by _init_worker so that its counters last for the whole batch
+_worker_cache = None
+
+
+def process_trace(trace_filename, output_dir, cache=None):
+    """Parses a tracing file and writes its per-trace products into output_dir/site_id/floor_name/trace_id.npz
+
+    The .npz file keeps the acc_df and mag_df columns, as "acc_df.<column>" and "mag_df.<column>", and the
+    waypoints of the trace.
+
+    Args:
+        trace_filename (str): Tracing file recorded for the XYZ2020 competition
+        output_dir (str): Folder of the results
+        cache (TraceCache, optional): Cache of parsed traces used for parsing. Defaults to None.
+
+    Returns:
+        dict: Summary of the processed trace, with an "error" message when it could not be processed, and
+        whether it was a "cache_hit" when a cache is used
+    """
+    summary = {"trace": trace_filename}
+    with instrumentation.trace(Path(trace_filename).stem):
+        try:
+            if cache is None:
+                parsed_data = data_parser.tracing_parser(trace_filename)
+            else:
+                hits = cache.hits
+                parsed_data = cache.load(trace_filename)
+                summary["cache_hit"] = cache.hits > hits
+
+            products = {"waypoints": np.asarray(parsed_data.waypoint.xy)}
+            for product_name, product in [("acc_df", data_processing.acc_df(parsed_data)),
+                                          ("mag_df", data_processing.mag_df(parsed_data))]:
+                for column in product.columns:
+                    products["{}.{}".format(product_name, column)] = product[column].to_numpy()
+
+            output_file = Path(output_dir) / parsed_data.site_id / parsed_data.floor_name / \
+                (Path(trace_filename).stem + ".npz")
+            output_file.parent.mkdir(parents=True, exist_ok=True)
+            np.savez(output_file, **products)
+
+            summary.update({"output": str(output_file), "site_id": parsed_data.site_id,
+                            "floor_name": parsed_data.floor_name, "n_acc": len(parsed_data.acc_calib),
+                            "n_mag": len(parsed_data.mag_calib), "n_waypoints": len(parsed_data.waypoint)})
+        except Exception as error:
+            # A broken trace must not stop the whole batch, it is reported in its summary instead
+            summary["error"] = "{}: {}".format(type(error).__name__, error)
+    return summary
+
+
+def _init_worker(cache_dir, cache_max_bytes, instrument_file, profile_trace, profile_dir):
+    """Initializer of the worker processes, which open the trace cache once and append their stages to the same
+    JSON-lines file"""
+    global _worker_cache
+    if cache_dir is not None:
+        _worker_cache = TraceCache(cache_dir, max_bytes=cache_max_bytes)
+    if instrument_file is not None:
+        instrumentation.enable(instrumentation.JsonLinesSink(instrument_file), profile_trace=profile_trace,
+                               profile_dir=profile_dir)
+
+
+def _process_worker_trace(trace_filename, output_dir):
+    """process_trace with the trace cache of the worker process"""
+    return process_trace(trace_filename, output_dir, cache=_worker_cache)
+
+
+def batch_process(root, output_dir, workers=None, chunksize=4, cache_dir=None, cache_max_bytes=1024 ** 3,
+                  progress=True, instrument_file=None, profile_trace=None):
+    """Processes every tracing file under root in a pool of worker processes
+
+    Each worker writes the products of its traces on its own, so only their small summaries go back to the
+    main process, and each summary is written to output_dir/manifest.jsonl as soon as it arrives. The manifest
+    is rewritten by each run, so it only lists the traces of the last one.
+
+    Args:
+        root (str): Venue, floor or dataset folder
+        output_dir (str): Folder of the results
+        workers (int, optional): Number of worker processes, None uses every core. Defaults to None.
+        chunksize (int, optional): Number of traces sent to a worker at a time. Defaults to 4.
+        cache_dir (str, optional): Folder of a TraceCache used for parsing, opened once by each worker.
+        Defaults to None.
+        cache_max_bytes (int, optional): Maximum total size of the cache entries, None for no maximum.
+        Defaults to 1 GiB.
+        progress (bool, optional): Whether to report the progress on stderr. Defaults to True.
+        instrument_file (str, optional): JSON-lines file the workers append the timings of their stages to,
+        see instrumentation. Defaults to None.
+        profile_trace (str, optional): Trace id captured with cProfile and tracemalloc into
+        output_dir/profiles/, only with instrument_file. Defaults to None.
+
+    Raises:
+        ValueError: When a not valid number of workers or chunksize is input
+
+    Returns:
+        list(dict): Summaries of the processed traces, see process_trace
+    """
+    workers = os.cpu_count() if workers is None else workers
+    if workers < 1:
+        raise ValueError(
+            "{} is not a valid number of workers.".format(workers))
+    if chunksize < 1:
+        raise ValueError(
+            "{} is not a valid chunksize.".format(chunksize))
+
+    traces = find_traces(root)
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    worker_task = partial(_process_worker_trace, output_dir=output_dir)
+
+    summaries = []
+    start_time = time.perf_counter()
+    with open(Path(output_dir) / "manifest.jsonl", "w") as manifest, \
+            Pool(processes=min(workers, max(len(traces), 1)),
+                 initializer=_init_worker, initargs=(cache_dir, cache_max_bytes, instrument_file, profile_trace,
+                                                     str(Path(output_dir) / "profiles"))) as pool:
+        for summary in pool.imap_unordered(worker_task, traces, chunksize=chunksize):
+            summaries.append(summary)
+            manifest.write(json.dumps(summary) + "\n")
+            manifest.flush()
+            if progress:
+                elapsed = time.perf_counter() - start_time
+                print("[{}/{}] {:.1f} traces/s {}{}".format(
+                    len(summaries), len(traces), len(summaries) / elapsed, summary["trace"],
+                    " ({})".format(summary["error"]) if "error" in summary else ""), file=sys.stderr)
+    return summaries
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Parses the tracing files of a venue or dataset folder "
+                                     "and extracts their per-trace products")
+    parser.add_argument("root", help="Venue, floor or dataset folder")
+    parser.add_argument("--output", default="./output/batch/", help="Folder of the results")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes")
+    parser.add_argument("--chunksize", type=int, default=4, help="Traces sent to a worker at a time")
+    parser.add_argument("--cache-dir", default=None, help="Folder of a parsed trace cache")
+    parser.add_argument("--cache-max-bytes", type=int, default=1024 ** 3,
+                        help="Maximum total size of the cache entries, 0 for no maximum")
+    parser.add_argument("--quiet", action="store_true", help="Do not report the progress")
+    parser.add_argument("--instrument", default=None, help="JSON-lines file of the timings of the stages")
+    parser.add_argument("--profile-trace", default=None, help="Trace id captured with cProfile and tracemalloc")
+    args = parser.parse_args(argv)
+
+    summaries = batch_process(args.root, args.output, workers=args.workers, chunksize=args.chunksize,
+                              cache_dir=args.cache_dir, cache_max_bytes=args.cache_max_bytes or None,
+                              progress=not args.quiet, instrument_file=args.instrument,
+                              profile_trace=args.profile_trace)
+    n_errors = sum("error" in summary for summary in summaries)
+    print("{} traces processed, {} errors".format(len(summaries) - n_errors, n_errors))
+    if args.cache_dir is not None:
+        print("{} cache hits".format(sum(summary.get("cache_hit", False) for summary in summaries)))
+    return 1 if n_errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
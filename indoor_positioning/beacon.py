@@ -0,0 +1,339 @@
+from indoor_positioning import data_parser
+from indoor_positioning.fingerprint import label_scans
+from pathlib import Path
+
+import glob
+import json
+import os
+import numpy as np
+
+
+# Log-distance path-loss model, RSSI = reference RSSI - 10 * PATH_LOSS_EXPONENT * log10(distance in meters), the
+# reference RSSI at 1 m being the tx_power advertised by the beacon, or REFERENCE_RSSI when it is unknown
+REFERENCE_RSSI = -59
+PATH_LOSS_EXPONENT = 2.0
+
+
+def rssi_to_distance(rssi, reference_rssi=REFERENCE_RSSI, exponent=PATH_LOSS_EXPONENT):
+    """Distance of a beacon from its RSSI, with the log-distance path-loss model
+
+    Args:
+        rssi (np.array): RSSI readings in dBm
+        reference_rssi (float or np.array, optional): RSSI at 1 m, of all the readings or of each one.
+        Defaults to REFERENCE_RSSI.
+        exponent (float, optional): Path-loss exponent. Defaults to PATH_LOSS_EXPONENT.
+
+    Returns:
+        np.array: Distances in meters
+    """
+    path_loss = np.asarray(reference_rssi, dtype="float64") - np.asarray(rssi, dtype="float64")
+    return np.power(10.0, path_loss / (10 * exponent))
+
+
+def _pad(groups, values, n_groups):
+    """Scatters grouped values into an (n_groups, max group size) array, NaN-padded
+
+    Args:
+        groups (np.array): Sorted group of each value
+        values (np.array): (N, ...) values
+        n_groups (int): Number of groups
+
+    Returns:
+        np.array: Padded values
+    """
+    counts = np.bincount(groups, minlength=n_groups)
+    width = int(counts.max()) if counts.shape[0] else 0
+    rank = np.arange(groups.shape[0]) - np.repeat(np.cumsum(counts) - counts, counts)
+    padded = np.full((n_groups, width) + values.shape[1:], np.nan)
+    padded[groups, rank] = values
+    return padded
+
+
+def _weighted_cost(positions, anchors, ranges, weights):
+    """Weighted sum of the squared range residuals of (E, 2) positions, with the (E, K) padded anchors"""
+    residual = np.linalg.norm(positions[:, None, :] - anchors, axis=-1) - ranges
+    return (weights * residual ** 2).sum(axis=1)
+
+
+def _linear_positions(anchors, ranges, weights, total):
+    """Weighted least-squares solutions of the range equations linearized by subtracting their weighted mean,
+    NaN for the epochs whose anchors are collinear"""
+    # |p - a_i|^2 = r_i^2 minus its weighted mean gives 2 (a_i - mean a) . p = |a_i|^2 - r_i^2 - mean(|a|^2 - r^2)
+    mean_anchor = (weights[..., None] * anchors).sum(axis=1) / total[:, None]
+    rhs = (anchors ** 2).sum(axis=-1) - ranges ** 2
+    rhs -= (weights * rhs).sum(axis=1, keepdims=True) / total[:, None]
+    rows = 2 * (anchors - mean_anchor[:, None, :])
+    rw = rows * weights[..., None]
+    a = (rw[..., 0] * rows[..., 0]).sum(axis=1)
+    b = (rw[..., 0] * rows[..., 1]).sum(axis=1)
+    d = (rw[..., 1] * rows[..., 1]).sum(axis=1)
+    gx = (rw[..., 0] * rhs).sum(axis=1)
+    gy = (rw[..., 1] * rhs).sum(axis=1)
+    determinant = a * d - b * b
+    conditioned = determinant > 1e-9 * np.maximum(a * d, 1e-300)
+    determinant = np.where(conditioned, determinant, 1)
+    positions = np.stack([d * gx - b * gy, a * gy - b * gx], axis=1) / determinant[:, None]
+    positions[~conditioned] = np.nan
+    return positions
+
+
+def multilaterate(anchors, ranges, weights=None, n_iterations=20, damping=1e-3, tolerance=1e-3, min_anchors=3):
+    """Weighted least-squares positions from ranges to known anchors, for many epochs in one batched call
+
+    Each epoch is solved by Levenberg-Marquardt iterations, with the 2 x 2 normal equations of all the epochs
+    solved in closed form, from the weighted centroid of its anchors or the solution of its linearized range
+    equations, whichever has the smallest residual. A step is only taken when it decreases the
+    weighted squared residual of its epoch, whose damping is then divided by 10, otherwise the step is rejected
+    and the damping multiplied by 10, so the residual of an epoch never grows. An epoch stops once its step is
+    shorter than tolerance, or its damping exceeds 1e6. The position of an epoch with fewer than min_anchors
+    anchors is not determined by its ranges, it is kept at the weighted centroid.
+
+    Args:
+        anchors (np.array): (E, K, 2) positions of the anchors of each epoch, NaN for the missing ones
+        ranges (np.array): (E, K) measured distances to the anchors
+        weights (np.array, optional): (E, K) weights of the ranges, None weights them by 1 / range ** 2.
+        Defaults to None.
+        n_iterations (int, optional): Maximum number of iterations. Defaults to 20.
+        damping (float, optional): Initial damping, relative to the weights of each epoch. Defaults to 1e-3.
+        tolerance (float, optional): Step length in meters below which an epoch stops. Defaults to 1e-3.
+        min_anchors (int, optional): Minimum number of anchors of the solved epochs. Defaults to 3.
+
+    Returns:
+        (np.array, np.array): (E, 2) positions, NaN for the epochs without anchors, and the weighted RMS
+        range residual of each epoch
+    """
+    anchors = np.asarray(anchors, dtype="float64")
+    ranges = np.asarray(ranges, dtype="float64")
+    weights = 1 / np.maximum(ranges, 0.1) ** 2 if weights is None else np.asarray(weights, dtype="float64")
+    present = ~np.isnan(anchors).any(axis=-1) & ~np.isnan(ranges)
+    weights = np.where(present, weights, 0)
+    anchors = np.where(present[..., None], anchors, 0)
+    ranges = np.where(present, ranges, 0)
+    total = weights.sum(axis=1)
+    valid = total > 0
+    total = np.where(valid, total, 1)
+
+    position = (weights[..., None] * anchors).sum(axis=1) / total[:, None]
+    # Only the epochs which did not stop yet are iterated
+    active = np.flatnonzero(valid & (present.sum(axis=1) >= min_anchors))
+    cost = _weighted_cost(position[active], anchors[active], ranges[active], weights[active])
+    # Each epoch starts from its centroid or from its linearized solution, whichever fits its ranges best
+    linear = _linear_positions(anchors[active], ranges[active], weights[active], total[active])
+    linear_cost = _weighted_cost(linear, anchors[active], ranges[active], weights[active])
+    closer = linear_cost < cost
+    position[active[closer]] = linear[closer]
+    cost = np.where(closer, linear_cost, cost)
+    lambdas = np.full(active.shape[0], float(damping))
+    for _ in range(n_iterations):
+        if not active.shape[0]:
+            break
+        epoch_anchors, epoch_ranges, epoch_weights = anchors[active], ranges[active], weights[active]
+        offset = position[active, None, :] - epoch_anchors
+        distance = np.maximum(np.linalg.norm(offset, axis=-1), 1e-6)
+        jacobian = offset / distance[..., None]
+        residual = distance - epoch_ranges
+        # Normal equations (J^T W J + lambda I) delta = -J^T W r of each epoch
+        jw = jacobian * epoch_weights[..., None]
+        a = (jw[..., 0] * jacobian[..., 0]).sum(axis=1) + lambdas * total[active]
+        b = (jw[..., 0] * jacobian[..., 1]).sum(axis=1)
+        d = (jw[..., 1] * jacobian[..., 1]).sum(axis=1) + lambdas * total[active]
+        gx = -(jw[..., 0] * residual).sum(axis=1)
+        gy = -(jw[..., 1] * residual).sum(axis=1)
+        determinant = a * d - b * b
+        step = np.stack([d * gx - b * gy, a * gy - b * gx], axis=1) / determinant[:, None]
+
+        candidate = position[active] + step
+        candidate_cost = _weighted_cost(candidate, epoch_anchors, epoch_ranges, epoch_weights)
+        accepted = candidate_cost < cost
+        position[active[accepted]] = candidate[accepted]
+        cost = np.where(accepted, candidate_cost, cost)
+        lambdas = np.where(accepted, lambdas / 10, lambdas * 10)
+        running = (np.linalg.norm(step, axis=1) >= tolerance) & (lambdas <= 1e6)
+        active, cost, lambdas = active[running], cost[running], lambdas[running]
+
+    rms = np.sqrt(_weighted_cost(position, anchors, ranges, weights) / total)
+    position[~valid] = np.nan
+    rms[~valid] = np.nan
+    return position, rms
+
+
+class BeaconMap:
+    """Estimated positions of the beacons of a venue, fitted from waypoint-labelled traces
+
+    Each reading of a trace is labelled with the position of the device, interpolated between its waypoints.
+    A beacon is placed on the floor where it was read the most, at the multilateration of the labelled
+    positions of its readings on that floor with their path-loss ranges. The ranges of the readings are
+    referenced to the tx_power advertised by the beacon, or to reference_rssi when it is unknown.
+    """
+
+    def __init__(self, reference_rssi=REFERENCE_RSSI, exponent=PATH_LOSS_EXPONENT):
+        """
+        Args:
+            reference_rssi (float, optional): RSSI at 1 m of the path-loss model, for the readings without
+            tx_power. Defaults to REFERENCE_RSSI.
+            exponent (float, optional): Path-loss exponent. Defaults to PATH_LOSS_EXPONENT.
+        """
+        self.reference_rssi = reference_rssi
+        self.exponent = exponent
+        self.beacon_ids = {}
+        self.positions = np.empty((0, 2))
+        self.floors = []
+        self.n_readings = np.empty(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.beacon_ids)
+
+    def _reference(self, tx_power):
+        """RSSI at 1 m of readings, their tx_power or reference_rssi when it is unknown (0)"""
+        tx_power = np.asarray(tx_power, dtype="float64")
+        return np.where(tx_power != 0, tx_power, self.reference_rssi)
+
+    def fit(self, floor_traces, min_readings=3):
+        """Estimates the beacon positions from the readings of waypoint-labelled traces
+
+        Args:
+            floor_traces (dict): List of the parsed traces (TraceData) of each floor name
+            min_readings (int, optional): Minimum number of labelled readings of a beacon. Defaults to 3.
+
+        Returns:
+            BeaconMap: The fitted map
+        """
+        names, floors, positions, rssi, tx_power = [], [], [], [], []
+        for floor, traces in floor_traces.items():
+            for trace_data in traces:
+                beacon = trace_data.beacon
+                labelled, xy = label_scans(np.asarray(beacon.tss), trace_data.waypoint)
+                names.append(beacon.beacon_names[beacon.beacon[labelled]] if len(beacon) else np.empty(0, dtype=str))
+                floors.append(np.full(xy.shape[0], floor, dtype=object))
+                positions.append(xy)
+                rssi.append(beacon.rssi[labelled])
+                tx_power.append(beacon.tx_power[labelled])
+
+        names = np.concatenate(names + [np.empty(0, dtype=str)])
+        floors = np.concatenate(floors + [np.empty(0, dtype=object)])
+        positions = np.concatenate(positions + [np.empty((0, 2), dtype=np.float32)])
+        rssi = np.concatenate(rssi + [np.empty(0, dtype=np.int16)])
+        tx_power = np.concatenate(tx_power + [np.empty(0, dtype=np.int16)])
+        if not names.shape[0]:
+            return self
+
+        # Floor of each beacon, where it has the most readings
+        keys, key_ix, key_counts = np.unique(np.stack([names, floors.astype(str)], axis=1), axis=0,
+                                             return_inverse=True, return_counts=True)
+        key_ix = key_ix.reshape(-1)
+        order = np.lexsort((-key_counts, keys[:, 0]))
+        first = np.ones(order.shape[0], dtype=bool)
+        first[1:] = keys[order[1:], 0] != keys[order[:-1], 0]
+        chosen = order[first & (key_counts[order] >= min_readings)]
+
+        # One multilateration epoch per beacon, with its readings on its floor as anchors
+        beacon_of_key = np.full(keys.shape[0], -1)
+        beacon_of_key[chosen] = np.arange(chosen.shape[0])
+        reading_beacon = beacon_of_key[key_ix]
+        used = np.flatnonzero(reading_beacon >= 0)
+        used = used[np.argsort(reading_beacon[used], kind="stable")]
+        anchors = _pad(reading_beacon[used], positions[used].astype("float64"), chosen.shape[0])
+        ranges = _pad(reading_beacon[used], rssi_to_distance(rssi[used], self._reference(tx_power[used]),
+                                                              self.exponent), chosen.shape[0])
+
+        self.positions, _ = multilaterate(anchors, ranges)
+        self.beacon_ids = {str(name): ix for ix, name in enumerate(keys[chosen, 0])}
+        self.floors = [str(floor) for floor in keys[chosen, 1]]
+        self.n_readings = key_counts[chosen].astype(np.int64)
+        return self
+
+    def locate(self, beacon, floor=None, window=1000, min_beacons=1):
+        """Positions of a device from its beacon readings, one multilateration epoch per time window
+
+        Args:
+            beacon (BeaconData): Beacon readings of a trace
+            floor (str, optional): Floor of the trace, only its beacons are used. None uses every beacon.
+            Defaults to None.
+            window (float, optional): Length of the epochs in ms. Defaults to 1000.
+            min_beacons (int, optional): Minimum number of mapped beacons of an epoch. Defaults to 1.
+
+        Returns:
+            (np.array, np.array, np.array): Mean timestamp of each epoch, its (E, 2) position and its number
+            of beacons. The readings of a beacon within an epoch are averaged
+        """
+        beacon_ix = np.array([self.beacon_ids.get(name, -1) for name in beacon.beacon_names], dtype=np.int64)
+        reading_beacon = beacon_ix[beacon.beacon] if len(beacon) else np.empty(0, dtype=np.int64)
+        mapped = reading_beacon >= 0
+        if floor is not None:
+            mapped &= np.array(self.floors + [None], dtype=object)[reading_beacon] == floor
+        tss = np.asarray(beacon.tss, dtype="float64")[mapped]
+        reading_beacon = reading_beacon[mapped]
+        rssi = np.asarray(beacon.rssi, dtype="float64")[mapped]
+        reference = self._reference(beacon.tx_power)[mapped]
+        if not tss.shape[0]:
+            return np.empty(0), np.empty((0, 2)), np.empty(0, dtype=np.int64)
+
+        # Mean RSSI and reference RSSI of each (epoch, beacon) pair
+        epoch = np.floor((tss - tss.min()) / window).astype(np.int64)
+        pairs, pair_ix = np.unique(np.stack([epoch, reading_beacon], axis=1), axis=0, return_inverse=True)
+        pair_ix = pair_ix.reshape(-1)
+        pair_counts = np.bincount(pair_ix)
+        pair_rssi = np.bincount(pair_ix, weights=rssi) / pair_counts
+        pair_reference = np.bincount(pair_ix, weights=reference) / pair_counts
+        epochs, pair_epoch = np.unique(pairs[:, 0], return_inverse=True)
+        pair_epoch = pair_epoch.reshape(-1)
+        epoch_tss = np.bincount(epoch, weights=tss)[epochs] / np.bincount(epoch)[epochs]
+
+        anchors = _pad(pair_epoch, self.positions[pairs[:, 1]], epochs.shape[0])
+        ranges = _pad(pair_epoch, rssi_to_distance(pair_rssi, pair_reference, self.exponent), epochs.shape[0])
+        positions, _ = multilaterate(anchors, ranges)
+        n_beacons = np.bincount(pair_epoch, minlength=epochs.shape[0])
+        selected = n_beacons >= min_beacons
+        return epoch_tss[selected], positions[selected], n_beacons[selected]
+
+    def save(self, map_file):
+        """Saves the map as a .json file
+
+        Args:
+            map_file (str): Path of the .json file
+        """
+        map_file = Path(map_file)
+        map_file.parent.mkdir(parents=True, exist_ok=True)
+        beacons = sorted(self.beacon_ids, key=self.beacon_ids.get)
+        tmp_file = map_file.with_name(map_file.name + ".tmp{}".format(os.getpid()))
+        with open(tmp_file, "w") as f:
+            json.dump({"reference_rssi": self.reference_rssi, "exponent": self.exponent, "beacons": beacons,
+                       "positions": self.positions.tolist(), "floors": self.floors,
+                       "n_readings": self.n_readings.tolist()}, f)
+        os.replace(tmp_file, map_file)
+
+    @classmethod
+    def load(cls, map_file):
+        """Loads a map saved with save
+
+        Args:
+            map_file (str): Path of the .json file
+
+        Returns:
+            BeaconMap: Loaded map
+        """
+        with open(map_file) as f:
+            saved = json.load(f)
+        beacon_map = cls(reference_rssi=saved["reference_rssi"], exponent=saved["exponent"])
+        beacon_map.beacon_ids = {beacon: ix for ix, beacon in enumerate(saved["beacons"])}
+        beacon_map.positions = np.array(saved["positions"], dtype="float64").reshape(-1, 2)
+        beacon_map.floors = saved["floors"]
+        beacon_map.n_readings = np.array(saved["n_readings"], dtype=np.int64)
+        return beacon_map
+
+
+def fit_venue(venue_dir, **kwargs):
+    """Beacon map of a venue, fitted from the beacon and waypoint records of all its tracing files
+
+    Args:
+        venue_dir (str): DIR of the venue, with one folder per floor
+        **kwargs: Options of BeaconMap.fit
+
+    Returns:
+        BeaconMap: Fitted map, with the floor folder names as floors
+    """
+    floor_traces = {}
+    for trace_filename in sorted(glob.glob(str(Path(venue_dir) / "*" / "*.txt"))):
+        floor_traces.setdefault(Path(trace_filename).parent.name, []).append(data_parser.tracing_parser(
+            trace_filename, record_types={"TYPE_BEACON", "TYPE_WAYPOINT"}))
+    return BeaconMap().fit(floor_traces, **kwargs)
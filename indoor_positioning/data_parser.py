@@ -1,14 +1,13 @@
 import glob
-from math import floor
-import re
+import io
+import os
 import numpy as np
 import json
 
+from indoor_positioning import instrumentation
 from pathlib import Path
 from dataclasses import dataclass
-from trace import Trace
 from typing import NewType
-from unicodedata import name
 
 
 # Alias types
@@ -21,10 +20,221 @@ Tss = NewType("tss", int)
 Distance = NewType("distance", float)
 Freq = NewType("freq", int)
 XYZ = tuple[float, float, float]
-SensorsXYZ = list[tuple[Tss, XYZ]]
-WifiData = list[tuple[Tss, tuple[SSID, BSSID, RSSI]]]
-BeaconData = list[tuple[Tss, tuple[UUID, RSSI]]]
-WaypointData = list[tuple[Tss, tuple[Distance, Distance]]]
+
+
+def _categorical(values):
+    """Encodes a sequence of strings as (categories, int32 codes)
+
+    Args:
+        values (list(str) or np.array): Values to be encoded, utf-8 bytes arrays are decoded after the encoding
+
+    Returns:
+        (np.array, np.array): Sorted unique values and the code of each value in them
+    """
+    if isinstance(values, list):
+        # Python strings are grouped with a dict, which is much faster than sorting them as a NumPy array
+        first_codes = {}
+        codes = np.array([first_codes.setdefault(value, len(first_codes)) for value in values], dtype=np.int32)
+        categories = np.array(list(first_codes), dtype=str)
+        order = np.argsort(categories)
+        rank = np.empty(order.shape[0], dtype=np.int32)
+        rank[order] = np.arange(order.shape[0])
+        return categories[order], rank[codes]
+
+    if not (isinstance(values, np.ndarray) and values.dtype.kind == "S"):
+        values = np.asarray(values, dtype=str)
+
+    if values.dtype.kind == "S" and values.dtype.itemsize % 8 == 0 and values.shape[0]:
+        # Bytes are grouped by a hash of their uint64 words, which is much faster than sorting the strings.
+        # The grouping is then checked, and the categories are sorted afterwards.
+        words = values.view("<u8").reshape(values.shape[0], -1)
+        hashes = words[:, 0].copy()
+        for word_ix in range(1, words.shape[1]):
+            hashes = hashes * np.uint64(0x9E3779B97F4A7C15) ^ words[:, word_ix]
+        _, first_ix, codes = np.unique(hashes, return_index=True, return_inverse=True)
+        codes = codes.reshape(-1)
+        if (values[first_ix][codes] == values).all():
+            order = np.argsort(values[first_ix])
+            rank = np.empty_like(order)
+            rank[order] = np.arange(order.shape[0])
+            categories = np.char.decode(values[first_ix][order], "utf-8").astype(str)
+            return categories, rank[codes].astype(np.int32)
+
+    categories, codes = np.unique(values, return_inverse=True)
+    if categories.dtype.kind == "S":
+        categories = np.char.decode(categories, "utf-8").astype(str)
+    return categories, codes.astype(np.int32).reshape(-1)
+
+
+@dataclass
+class SensorsXYZ:
+    """Columnar data of a 3-axis sensor: int64 timestamps and a float32 (N, 3) array of readings"""
+
+    # Minimum number of tab separated fields of a line of this record type
+    n_fields = 5
+
+    tss: np.ndarray
+    xyz: np.ndarray
+
+    def __len__(self):
+        return self.tss.shape[0]
+
+    def __getitem__(self, rows):
+        return SensorsXYZ(tss=self.tss[rows], xyz=self.xyz[rows])
+
+    @classmethod
+    def from_records(cls, records):
+        tss = np.array([record[0] for record in records], dtype=np.int64)
+        xyz = np.array([record[1] for record in records],
+                       dtype=np.float32).reshape(-1, 3)
+        return cls(tss=tss, xyz=xyz)
+
+    @classmethod
+    def from_rows(cls, rows):
+        tss = np.array([fields[0] for fields in rows], dtype=np.int64)
+        # Each axis is converted with float(), which is much faster than NumPy parsing nested lists of strings
+        xyz = np.array([[float(fields[ix]) for fields in rows] for ix in (2, 3, 4)]).T
+        return cls(tss=tss, xyz=xyz.astype(np.float32, order="C"))
+
+    @classmethod
+    def from_lines(cls, lines):
+        records = _loadtxt(lines, cls.n_fields, (0, 2, 3, 4), [("tss", np.int64), ("xyz", np.float64, (3,))])
+        return cls(tss=np.ascontiguousarray(records["tss"]), xyz=records["xyz"].astype(np.float32))
+
+
+@dataclass
+class WifiData:
+    """Columnar WiFi scans, SSIDs and BSSIDs are stored as int32 codes into ssid_names and bssid_names"""
+
+    n_fields = 5
+
+    tss: np.ndarray
+    ssid: np.ndarray
+    bssid: np.ndarray
+    rssi: np.ndarray
+    ssid_names: np.ndarray
+    bssid_names: np.ndarray
+
+    def __len__(self):
+        return self.tss.shape[0]
+
+    def __getitem__(self, rows):
+        return WifiData(tss=self.tss[rows], ssid=self.ssid[rows], bssid=self.bssid[rows], rssi=self.rssi[rows],
+                        ssid_names=self.ssid_names, bssid_names=self.bssid_names)
+
+    @classmethod
+    def from_records(cls, records):
+        tss = np.array([record[0] for record in records], dtype=np.int64)
+        ssid_names, ssid = _categorical([record[1][0] for record in records])
+        bssid_names, bssid = _categorical([record[1][1] for record in records])
+        rssi = np.array([record[1][2] for record in records], dtype=np.int16)
+        return cls(tss=tss, ssid=ssid, bssid=bssid, rssi=rssi,
+                   ssid_names=ssid_names, bssid_names=bssid_names)
+
+    @classmethod
+    def from_rows(cls, rows):
+        tss = np.array([fields[0] for fields in rows], dtype=np.int64)
+        ssid_names, ssid = _categorical([fields[2] for fields in rows])
+        bssid_names, bssid = _categorical([fields[3] for fields in rows])
+        rssi = np.array([int(fields[4]) for fields in rows], dtype=np.int16)
+        return cls(tss=tss, ssid=ssid, bssid=bssid, rssi=rssi,
+                   ssid_names=ssid_names, bssid_names=bssid_names)
+
+    @classmethod
+    def from_lines(cls, lines):
+        # No string field is longer than its line
+        string = _bytes_dtype(lines)
+        records = _loadtxt(lines, cls.n_fields, (0, 2, 3, 4),
+                           [("tss", np.int64), ("ssid", string), ("bssid", string), ("rssi", np.int16)])
+        ssid_names, ssid = _categorical(np.ascontiguousarray(records["ssid"]))
+        bssid_names, bssid = _categorical(np.ascontiguousarray(records["bssid"]))
+        return cls(tss=np.ascontiguousarray(records["tss"]), ssid=ssid, bssid=bssid,
+                   rssi=np.ascontiguousarray(records["rssi"]), ssid_names=ssid_names, bssid_names=bssid_names)
+
+
+@dataclass
+class BeaconData:
+    """Columnar iBeacon readings, the UUID_major_minor ids are stored as int32 codes into beacon_names. tx_power
+    is the RSSI at 1 m advertised by the beacon, 0 when it is unknown"""
+
+    n_fields = 7
+
+    tss: np.ndarray
+    beacon: np.ndarray
+    rssi: np.ndarray
+    tx_power: np.ndarray
+    beacon_names: np.ndarray
+
+    def __len__(self):
+        return self.tss.shape[0]
+
+    def __getitem__(self, rows):
+        return BeaconData(tss=self.tss[rows], beacon=self.beacon[rows], rssi=self.rssi[rows],
+                          tx_power=self.tx_power[rows], beacon_names=self.beacon_names)
+
+    @classmethod
+    def from_records(cls, records):
+        tss = np.array([record[0] for record in records], dtype=np.int64)
+        beacon_names, beacon = _categorical([record[1][0] for record in records])
+        rssi = np.array([record[1][1] for record in records], dtype=np.int16)
+        tx_power = np.array([record[1][2] for record in records], dtype=np.int16)
+        return cls(tss=tss, beacon=beacon, rssi=rssi, tx_power=tx_power, beacon_names=beacon_names)
+
+    @classmethod
+    def from_rows(cls, rows):
+        tss = np.array([fields[0] for fields in rows], dtype=np.int64)
+        beacon_names, beacon = _categorical(["_".join(fields[2:5]) for fields in rows])
+        rssi = np.array([int(fields[6]) for fields in rows], dtype=np.int16)
+        tx_power = np.array([int(fields[5]) for fields in rows], dtype=np.int16)
+        return cls(tss=tss, beacon=beacon, rssi=rssi, tx_power=tx_power, beacon_names=beacon_names)
+
+    @classmethod
+    def from_lines(cls, lines):
+        string = _bytes_dtype(lines)
+        records = _loadtxt(lines, cls.n_fields, (0, 2, 3, 4, 5, 6),
+                           [("tss", np.int64), ("uuid", string), ("major", string), ("minor", string),
+                            ("tx_power", np.int16), ("rssi", np.int16)])
+        # UUID, major and minor are joined with "_"
+        beacon_names, beacon = _categorical([b"_".join(ids).decode("utf-8") for ids in zip(
+            records["uuid"], records["major"], records["minor"])])
+        return cls(tss=np.ascontiguousarray(records["tss"]), beacon=beacon,
+                   rssi=np.ascontiguousarray(records["rssi"]), tx_power=np.ascontiguousarray(records["tx_power"]),
+                   beacon_names=beacon_names)
+
+
+@dataclass
+class WaypointData:
+    """Columnar ground truth positions: int64 timestamps and a float32 (N, 2) array of x, y in meters"""
+
+    n_fields = 4
+
+    tss: np.ndarray
+    xy: np.ndarray
+
+    def __len__(self):
+        return self.tss.shape[0]
+
+    def __getitem__(self, rows):
+        return WaypointData(tss=self.tss[rows], xy=self.xy[rows])
+
+    @classmethod
+    def from_records(cls, records):
+        tss = np.array([record[0] for record in records], dtype=np.int64)
+        xy = np.array([record[1] for record in records],
+                      dtype=np.float32).reshape(-1, 2)
+        return cls(tss=tss, xy=xy)
+
+    @classmethod
+    def from_rows(cls, rows):
+        tss = np.array([fields[0] for fields in rows], dtype=np.int64)
+        xy = np.array([[float(fields[ix]) for fields in rows] for ix in (2, 3)]).T
+        return cls(tss=tss, xy=xy.astype(np.float32, order="C"))
+
+    @classmethod
+    def from_lines(cls, lines):
+        records = _loadtxt(lines, cls.n_fields, (0, 2, 3), [("tss", np.int64), ("xy", np.float64, (2,))])
+        return cls(tss=np.ascontiguousarray(records["tss"]), xy=records["xy"].astype(np.float32))
+
 
 # Tracing file's Metadata
 
@@ -37,19 +247,20 @@ METADATA_NAMES = {
 }
 
 # Admisible sensor types and their mapping functions for the tracing files
-# The lambda function is used as a replacement for the case function
+# The lambda function is used as a replacement for the case function, the "columns"
+# class turns the mapped records into the columnar arrays kept in TraceData
 
 SENSOR_TYPES = {
-    "TYPE_ACCELEROMETER": {"name": "acc_calib", "mapping": lambda x: (x[0], (x[2], x[3], x[4]))},
-    "TYPE_MAGNETIC_FIELD": {"name": "mag_calib", "mapping": lambda x: (x[0], (x[2], x[3], x[4]))},
-    "TYPE_GYROSCOPE": {"name": "gyro_calib", "mapping": lambda x: (x[0], (x[2], x[3], x[4]))},
-    "TYPE_ROTATION_VECTOR": {"name": "rotation_vector", "mapping": lambda x: (x[0], (x[2], x[3], x[4]))},
-    "TYPE_ACCELEROMETER_UNCALIBRATED": {"name":  "acc_uncalib", "mapping": lambda x: (x[0], (x[2], x[3], x[4]))},
-    "TYPE_MAGNETIC_FIELD_UNCALIBRATED": {"name": "mag_uncalib", "mapping": lambda x: (x[0], (x[2], x[3], x[4]))},
-    "TYPE_GYROSCOPE_UNCALIBRATED": {"name": "gyro_uncalib", "mapping": lambda x: (x[0], (x[2], x[3], x[4]))},
-    "TYPE_WIFI": {"name": "wifi", "mapping": lambda x:  (x[0], (x[2], x[3], x[4]))},
-    "TYPE_BEACON": {"name": "beacon", "mapping": lambda x: (x[0], ("_".join([x[2], x[3], x[4]]), x[6]))},
-    "TYPE_WAYPOINT": {"name": "waypoint", "mapping": lambda x: (x[0],  (x[2], x[3]))}
+    "TYPE_ACCELEROMETER": {"name": "acc_calib", "mapping": lambda x: (x[0], (x[2], x[3], x[4])), "columns": SensorsXYZ},
+    "TYPE_MAGNETIC_FIELD": {"name": "mag_calib", "mapping": lambda x: (x[0], (x[2], x[3], x[4])), "columns": SensorsXYZ},
+    "TYPE_GYROSCOPE": {"name": "gyro_calib", "mapping": lambda x: (x[0], (x[2], x[3], x[4])), "columns": SensorsXYZ},
+    "TYPE_ROTATION_VECTOR": {"name": "rotation_vector", "mapping": lambda x: (x[0], (x[2], x[3], x[4])), "columns": SensorsXYZ},
+    "TYPE_ACCELEROMETER_UNCALIBRATED": {"name":  "acc_uncalib", "mapping": lambda x: (x[0], (x[2], x[3], x[4])), "columns": SensorsXYZ},
+    "TYPE_MAGNETIC_FIELD_UNCALIBRATED": {"name": "mag_uncalib", "mapping": lambda x: (x[0], (x[2], x[3], x[4])), "columns": SensorsXYZ},
+    "TYPE_GYROSCOPE_UNCALIBRATED": {"name": "gyro_uncalib", "mapping": lambda x: (x[0], (x[2], x[3], x[4])), "columns": SensorsXYZ},
+    "TYPE_WIFI": {"name": "wifi", "mapping": lambda x:  (x[0], (x[2], x[3], x[4])), "columns": WifiData},
+    "TYPE_BEACON": {"name": "beacon", "mapping": lambda x: (x[0], ("_".join([x[2], x[3], x[4]]), x[6], x[5])), "columns": BeaconData},
+    "TYPE_WAYPOINT": {"name": "waypoint", "mapping": lambda x: (x[0],  (x[2], x[3])), "columns": WaypointData}
 }
 
 
@@ -76,73 +287,280 @@ class TraceData:
     waypoint: WaypointData
 
 
-def tracing_parser(trace_filename: str) -> TraceData:
+def _parse_metadata(line, trace_data_kwargs):
+    """Stores the METADATA_NAMES fields found in a "#" header line of a tracing file
+
+    Args:
+        line (str): Header line of the tracing file
+        trace_data_kwargs (dict): Keyword arguments of the TraceData being parsed
+    """
+    for subsection in line.split("\t"):
+        if subsection.startswith(tuple(METADATA_NAMES.keys())):
+            split_sub = subsection.split(":")
+            trace_data_kwargs[METADATA_NAMES[split_sub[0]]
+                              ] = split_sub[1].replace("\n", "")
+
+
+def _parse_fields(trace_data, trace_filename, *args, **kwargs):
+    return {"bytes_read": os.path.getsize(trace_filename),
+            "rows": {record_type: len(getattr(trace_data, sensor_type["name"]))
+                     for record_type, sensor_type in SENSOR_TYPES.items()}}
+
+
+@instrumentation.instrumented("parse", fields=_parse_fields)
+def tracing_parser(trace_filename: str, engine: str = "bulk", record_types=None) -> TraceData:
     """
     Parser for the tracing files which keep all the sensor data
 
     Args:
         trace_filename (str): Tracing file recorded for the XYZ2020 competition
+        engine (str, optional): Either "bulk", which groups the lines of the file buffer by record type and
+        converts each of them with np.loadtxt, or "python", which parses it line by line. Both of them return
+        the same data. Defaults to "bulk".
+        record_types (set(str), optional): SENSOR_TYPES keys to be parsed, the lines of other record types
+        are skipped without being split and their sensors are left empty. None parses all of them.
+        Defaults to None.
+
+    Raises:
+        ValueError: When a not valid engine or record type is input
 
     Returns:
         TraceData: DataClass used for keeping the information associated to the tracing files
     """
 
-    trace_data_kwargs = {
-        "file_name": trace_filename,
-        "acc_calib": [],
-        "acc_uncalib": [],
-        "mag_calib": [],
-        "mag_uncalib": [],
-        "gyro_calib": [],
-        "gyro_uncalib": [],
-        "rotation_vector": [],
-        "wifi": [],
-        "beacon": [],
-        "waypoint": []
-    }
+    if engine not in ["bulk", "python"]:
+        raise ValueError(
+            "{} is not a valid parser engine.".format(engine))
+
+    if record_types is None:
+        record_types = set(SENSOR_TYPES)
+    for record_type in record_types:
+        if record_type not in SENSOR_TYPES:
+            raise ValueError(
+                "{} is not a valid record type.".format(record_type))
+
+    if engine == "bulk":
+        return _bulk_tracing_parser(trace_filename, record_types)
+
+    trace_data_kwargs = {"file_name": trace_filename}
+    # Split lines of each record type, converted into columns once all of them have been read
+    rows = {record_type: [] for record_type in record_types}
 
     with open(trace_filename, 'r', encoding='utf-8') as file:
-        lines = file.readlines()
+        lines = file.read().split("\n")
 
     for line in lines:
 
         if line.startswith("#"):
-            for subsection in line.split("\t"):
-                if subsection.startswith(tuple(METADATA_NAMES.keys())):
-                    split_sub = subsection.split(":")
-                    trace_data_kwargs[METADATA_NAMES[split_sub[0]]
-                                      ] = split_sub[1].replace("\n", "")
+            _parse_metadata(line, trace_data_kwargs)
 
         else:
             split_line = line.split("\t")
-            split_line[-1] = split_line[-1].replace("\n", "")
-            sensor_name = SENSOR_TYPES[split_line[1]]["name"]
-            sensor_values = SENSOR_TYPES[split_line[1]]["mapping"](
-                split_line
-            )
-            # Appends the data associated to each of the sensors
-            trace_data_kwargs[sensor_name].append(sensor_values)
+            if len(split_line) > 1 and split_line[1] in rows:
+                rows[split_line[1]].append(split_line)
+
+    for record_type, sensor_type in SENSOR_TYPES.items():
+        # Lines with missing fields are skipped, as in the bulk engine
+        n_fields = sensor_type["columns"].n_fields
+        trace_data_kwargs[sensor_type["name"]] = sensor_type["columns"].from_rows(
+            [fields for fields in rows.get(record_type, []) if len(fields) >= n_fields])
 
     return TraceData(**trace_data_kwargs)
 
 
-def waypoint_list(map_folder):
+# Bulk parsing: the lines of the file buffer are grouped by record type in a single pass, and the fields of
+# each record type are then converted at once by np.loadtxt, whose reader is written in C
+#
+# The bulk engine parses the bundled F1 traces about 1.4x faster than the python engine, and only 1.1x faster
+# than the parser which kept the fields as strings, far short of the 5x target it was written for. About a
+# third of its time goes to grouping the lines, which is a Python loop, and another third to converting the
+# strings of the wifi lines.
+# benchmarks/bench_parser.py measures both engines.
+
+
+def _loadtxt(lines, n_fields, usecols, dtype):
+    """Converts some tab separated fields of the lines of a record type with np.loadtxt
+
+    Args:
+        lines (list(bytes)): Lines of the record type, without line breaks
+        n_fields (int): Minimum number of fields of a line, shorter lines are skipped
+        usecols (tuple(int)): Indices of the converted fields
+        dtype (list(tuple)): Structured dtype with a field per converted field
+
+    Returns:
+        np.array: Structured array with a row per complete line
+    """
+    if not lines:
+        return np.empty(0, dtype=dtype)
+    try:
+        # The latin-1 encoding keeps the utf-8 bytes of the string fields unchanged
+        return np.loadtxt(io.BytesIO(b"\n".join(lines)), dtype=dtype, delimiter="\t", comments=None,
+                          usecols=usecols, encoding="latin1", ndmin=1)
+    except ValueError:
+        complete = [line for line in lines if line.count(b"\t") + 1 >= n_fields]
+        if len(complete) == len(lines):
+            raise
+        # Lines with missing fields are skipped, as in the python engine
+        return _loadtxt(complete, n_fields, usecols, dtype)
+
+
+def _bytes_dtype(lines):
+    """Bytes dtype which fits any field of the lines, in a multiple of 8 bytes for _categorical"""
+    return "S{}".format(max(-(-max(map(len, lines), default=0) // 8) * 8, 8))
+
+
+def _select_lines(data, record_types):
+    """Keeps only the header lines and the lines of the given record types of a tracing file buffer
+
+    The lines are found by searching the record type between tabs, so that the rest of the file is
+    never split. The selected lines are grouped by record type, keeping the order of the file in each type.
+
+    Args:
+        data (bytes): Tracing file buffer with "\\n" line breaks
+        record_types (set(str)): SENSOR_TYPES keys to be kept
+
+    Returns:
+        bytes: Buffer of the selected lines
+    """
+    # Leading header lines (startTime, SiteID, FloorId...)
+    header_end = 0
+    while data.startswith(b"#", header_end):
+        header_end = data.find(b"\n", header_end) + 1 or len(data)
+    lines = [data[:header_end]]
+
+    for record_type in SENSOR_TYPES:
+        if record_type not in record_types:
+            continue
+        pattern = b"\t" + record_type.encode("utf-8") + b"\t"
+        match = data.find(pattern)
+        while match != -1:
+            line_start = data.rfind(b"\n", 0, match) + 1
+            line_end = data.find(b"\n", match)
+            line_end = len(data) if line_end == -1 else line_end + 1
+            # The record type must be the second field, and not e.g. a SSID equal to it
+            if data.find(b"\t", line_start) == match:
+                lines.append(data[line_start:line_end])
+                if not lines[-1].endswith(b"\n"):
+                    lines.append(b"\n")
+            match = data.find(pattern, line_end)
+
+    # Remaining header lines, such as endTime. The rare "#" char is searched on its own, which is
+    # much faster than searching it after a line break
+    match = data.find(b"#", header_end)
+    while match != -1:
+        line_end = data.find(b"\n", match)
+        line_end = len(data) if line_end == -1 else line_end
+        if data.startswith(b"\n", match - 1):
+            lines.append(data[match:line_end] + b"\n")
+        match = data.find(b"#", line_end)
+    return b"".join(lines)
+
+
+def _bulk_tracing_parser(trace_filename, record_types):
+    """Bulk engine of tracing_parser, see its docstring"""
+
+    with open(trace_filename, 'rb') as file:
+        data = file.read()
+    if b"\r" in data:
+        data = data.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+    if len(record_types) < len(SENSOR_TYPES):
+        data = _select_lines(data, record_types)
+
+    trace_data_kwargs = {"file_name": trace_filename}
+    headers, groups = _group_lines(data, record_types)
+    for header in headers:
+        _parse_metadata(header, trace_data_kwargs)
+    for sensor_type in SENSOR_TYPES.values():
+        trace_data_kwargs[sensor_type["name"]] = sensor_type["columns"].from_lines(
+            groups.get(sensor_type["name"], []))
+    return TraceData(**trace_data_kwargs)
+
+
+def _group_lines(data, record_types):
+    """Groups the lines of a buffer of tracing file lines by record type
+
+    Args:
+        data (bytes): Buffer of the lines, with "\n" line breaks
+        record_types (set(str)): SENSOR_TYPES keys to be kept, the lines of other record types are skipped
+
+    Returns:
+        (list(str), dict): Header lines, and lines of each kept record type by TraceData sensor field
+    """
+    headers = []
+    groups = {record_type.encode("utf-8"): [] for record_type in record_types}
+    for line in data.split(b"\n"):
+        # The record type is the second field of the line, headers are only looked for in the other lines
+        fields = line.split(b"\t", 2)
+        group = groups.get(fields[1]) if len(fields) == 3 else None
+        if group is not None and not fields[0].startswith(b"#"):
+            group.append(line)
+        elif line.startswith(b"#"):
+            headers.append(line.decode("utf-8"))
+    return headers, {SENSOR_TYPES[record_type.decode("utf-8")]["name"]: lines for record_type, lines in groups.items()}
+
+
+def parse_buffers(buffers):
+    """Parses many buffers of tracing file lines at once with the bulk engine, e.g. the lines received from
+    many live traces
+
+    The lines of all the buffers are grouped by record type and converted in a single np.loadtxt call per
+    record type, and the records are split back by buffer afterwards, so the cost of many small buffers is
+    that of one large one.
+
+    Args:
+        buffers (list(bytes)): Complete lines of each buffer
+
+    Returns:
+        list(tuple(list(str), dict)): Header lines of each buffer, and the columnar records of each TraceData
+        sensor field found in it
+    """
+    buffers = [buffer.replace(b"\r\n", b"\n").replace(b"\r", b"\n") if b"\r" in buffer else buffer
+               for buffer in buffers]
+    grouped = [_group_lines(buffer, SENSOR_TYPES) for buffer in buffers]
+    parsed = [(headers, {}) for headers, _ in grouped]
+
+    for sensor_type in SENSOR_TYPES.values():
+        # Lines with missing fields are dropped beforehand, so that the records can be split back by buffer
+        n_fields = sensor_type["columns"].n_fields
+        buffer_lines = [[line for line in groups[sensor_type["name"]] if line.count(b"\t") + 1 >= n_fields]
+                        for _, groups in grouped]
+        records = sensor_type["columns"].from_lines([line for lines in buffer_lines for line in lines])
+        first_row = 0
+        for (_, buffer_records), lines in zip(parsed, buffer_lines):
+            if lines:
+                buffer_records[sensor_type["name"]] = records[first_row:first_row + len(lines)]
+                first_row += len(lines)
+    return parsed
+
+
+@instrumentation.instrumented("waypoints", fields=lambda waypoints, *args, **kwargs: {
+    "rows": {"TYPE_WAYPOINT": len(waypoints)}})
+def waypoint_list(map_folder, cache=None, index=None):
     """From the dir of a map folder, returns a list of all the waypoints in said map
 
     Args:
         map_folder (str): DIR of the map
+        cache (TraceCache, optional): Cache of parsed traces used instead of parsing each file. Defaults to None.
+        index (WaypointIndex, optional): Persistent waypoint index of the floors, used instead of both the
+        cache and the parsing of each file. Defaults to None.
 
     Returns:
         list(float, float): List of the waypoint pairs in the map
     """
+    if index is not None:
+        return index.waypoints(map_folder)
+
     tracefiles = glob.glob(map_folder + "/*.txt", recursive=True)
     waypoints = []
     for file in tracefiles:
-        print("Parsing {}".format(file))
-        parsed = tracing_parser(file)
-        waypoints += [[xyz[1][0], xyz[1][1]] for xyz in parsed.waypoint]
+        if cache is None:
+            parsed = tracing_parser(file, record_types={"TYPE_WAYPOINT"})
+        else:
+            parsed = cache.load(file)
+        waypoints.append(parsed.waypoint.xy)
 
-    map_waypoints = np.unique(np.array(waypoints, dtype="float32"), axis=0)
+    map_waypoints = np.unique(np.concatenate(
+        waypoints + [np.empty((0, 2), dtype="float32")]), axis=0)
     return map_waypoints
 
 
@@ -170,3 +588,15 @@ def floorplan(metadata_path, floor_folder_dir):
     floorplan["floor_image"] = floorplan_image
     floorplan["floor_geojson"] = floorplan_geojson
     return floorplan
+
+
+def find_traces(root):
+    """Tracing files of a venue, floor or dataset folder, found the same way as in main.py
+
+    Args:
+        root (str): Folder to search recursively
+
+    Returns:
+        list(str): Sorted paths of the tracing files
+    """
+    return sorted(glob.glob(str(root) + "/**/*.txt", recursive=True))
@@ -1,13 +1,17 @@
-from random import sample
-from scipy import signal
+from indoor_positioning import instrumentation
+from functools import lru_cache
 
-import pandas as pd
 import numpy as np
 
+# scipy and pandas take most of the import time and memory of the package, so they are imported by the functions
+# which use them, and processes which only parse traces never load them
+
 
 def butter_filter(order=8, cutoff_freq=2.5, sample_freq=50, output="ba"):
     """Signal filter polynomials of the butterworth filter designed for the sensors
 
+    The designs are cached per (order, cutoff_freq, sample_freq, output), copies of them are returned.
+
     Args:
         order (int, optional): Order of the filter. Defaults to 5.
         cutoff_freq (int, optional): Cutoff frequency in Hz. Defaults to 2.
@@ -20,6 +24,17 @@ def butter_filter(order=8, cutoff_freq=2.5, sample_freq=50, output="ba"):
         raise ValueError(
             "{} is not a valid output form.".format(output))
 
+    design = _butter_design(order, cutoff_freq, sample_freq, output)
+    if output == "ba":
+        return design[0].copy(), design[1].copy()
+    return design.copy()
+
+
+@lru_cache(maxsize=64)
+@instrumentation.instrumented("filter_design")
+def _butter_design(order, cutoff_freq, sample_freq, output):
+    from scipy import signal
+
     if output == "ba":
         b_filter, a_filter = signal.butter(
             N=order, Wn=cutoff_freq, btype="low", analog=False,  fs=sample_freq)
@@ -30,6 +45,139 @@ def butter_filter(order=8, cutoff_freq=2.5, sample_freq=50, output="ba"):
         return sos
 
 
+def group_delay(freq, order=8, cutoff_freq=2.5, sample_freq=50):
+    """Group delay of the causal butterworth filter designed for the sensors, at a frequency
+
+    Args:
+        freq (float): Frequency in Hz
+        order (int, optional): Order of the filter. Defaults to 8.
+        cutoff_freq (float, optional): Cutoff frequency in Hz. Defaults to 2.5.
+        sample_freq (float, optional): Sample frequency of the signals in Hz. Defaults to 50.
+
+    Returns:
+        float: Delay in ms, by which StreamingFilter and filter_chunks trail the zero-phase filters
+    """
+    from scipy import signal
+
+    _, delay = signal.group_delay(butter_filter(order=order, cutoff_freq=cutoff_freq, sample_freq=sample_freq),
+                                  w=[freq], fs=sample_freq)
+    return float(delay[0]) * 1000 / sample_freq
+
+
+class StreamingFilter:
+    """Causal butterworth low-pass filter which keeps its state between the chunks of a signal
+
+    Each chunk is filtered in O(chunk) time with the cached second-order sections of the filter, so a real-time
+    signal can be filtered as it arrives. Chunks may be 1-D, a single signal, or 2-D (signals, samples), which
+    filters many signals (e.g. traces padded to the same length) at once along their last axis.
+    """
+
+    def __init__(self, order=8, cutoff_freq=2.5, sample_freq=50):
+        """
+        Args:
+            order (int, optional): Order of the filter. Defaults to 8.
+            cutoff_freq (float, optional): Cutoff frequency in Hz. Defaults to 2.5.
+            sample_freq (float, optional): Sample frequency of the signals in Hz. Defaults to 50.
+        """
+        self.sos = butter_filter(order=order, cutoff_freq=cutoff_freq, sample_freq=sample_freq, output="sos")
+        self.zi = None
+
+    def reset(self):
+        """Forgets the state, the next chunk is filtered as the start of a new signal"""
+        self.zi = None
+
+    def process(self, chunk):
+        """Filters the next chunk of the signal(s)
+
+        Args:
+            chunk (np.array): Next samples, of shape (samples,) or (signals, samples)
+
+        Raises:
+            ValueError: When the shape of the chunk does not match the previous ones
+
+        Returns:
+            np.array: Filtered samples, with the same shape as the chunk
+        """
+        chunk = np.asarray(chunk, dtype="float64")
+        if chunk.ndim not in [1, 2]:
+            raise ValueError(
+                "{} is not a valid chunk shape.".format(chunk.shape))
+        if chunk.shape[-1] == 0:
+            return chunk.copy()
+
+        from scipy import signal
+
+        if self.zi is None:
+            # The state starts at the steady state of the first sample, which avoids the step transient
+            zi = signal.sosfilt_zi(self.sos)
+            self.zi = zi[:, None, :] * chunk[None, :, :1] if chunk.ndim == 2 else zi * chunk[0]
+        elif self.zi.shape[1:-1] != chunk.shape[:-1]:
+            raise ValueError(
+                "{} is not a valid chunk shape for the filter state.".format(chunk.shape))
+
+        filtered, self.zi = signal.sosfilt(self.sos, chunk, axis=-1, zi=self.zi)
+        return filtered
+
+
+def filter_chunks(chunks, states, order=8, cutoff_freq=2.5, sample_freq=50):
+    """Causally filters the next chunk of many signals at once, each signal keeping its own state
+
+    Unlike with StreamingFilter, the chunks may have different lengths: the signals still long enough are
+    filtered together up to each distinct chunk length, so the number of filter calls grows with the number
+    of distinct lengths instead of with the number of signals.
+
+    Args:
+        chunks (list(np.array)): Next samples of each signal
+        states (list(np.array)): Filter state of each signal, as returned by a previous call, None for a
+        signal starting with this chunk
+        order (int, optional): Order of the filter. Defaults to 8.
+        cutoff_freq (float, optional): Cutoff frequency in Hz. Defaults to 2.5.
+        sample_freq (float, optional): Sample frequency of the signals in Hz. Defaults to 50.
+
+    Returns:
+        (list(np.array), list(np.array)): Filtered chunks and new states of the signals
+    """
+    from scipy import signal
+
+    sos = butter_filter(order=order, cutoff_freq=cutoff_freq, sample_freq=sample_freq, output="sos")
+    lengths = np.array([len(chunk) for chunk in chunks], dtype=np.int64)
+    padded = np.zeros((len(chunks), lengths.max(initial=0)))
+    padded[np.arange(padded.shape[1]) < lengths[:, None]] = np.concatenate(
+        [np.asarray(chunk, dtype="float64") for chunk in chunks] + [np.empty(0)])
+
+    # As in StreamingFilter, a new signal starts at the steady state of its first sample
+    zi = signal.sosfilt_zi(sos)
+    state = np.stack([zi * (padded[row, 0] if lengths[row] else 0.0) if states[row] is None else states[row]
+                      for row in range(len(chunks))], axis=1) if chunks else np.empty((sos.shape[0], 0, 2))
+    filtered = np.empty_like(padded)
+    start = 0
+    for end in np.unique(lengths[lengths > 0]):
+        active = lengths >= end
+        filtered[active, start:end], state[:, active] = signal.sosfilt(sos, padded[active, start:end], axis=-1,
+                                                                       zi=state[:, active])
+        start = end
+    return [filtered[row, :length] for row, length in enumerate(lengths)], \
+        [None if states[row] is None and not lengths[row] else state[:, row].copy() for row in range(len(chunks))]
+
+
+@instrumentation.instrumented("filter", fields=lambda filtered, *args, **kwargs: {"samples": int(filtered.size)})
+def filter_batch(signals, order=8, cutoff_freq=2.5, sample_freq=50):
+    """Causally filters many signals of the same length at once
+
+    Args:
+        signals (np.array): (signals, samples) array
+        order (int, optional): Order of the filter. Defaults to 8.
+        cutoff_freq (float, optional): Cutoff frequency in Hz. Defaults to 2.5.
+        sample_freq (float, optional): Sample frequency of the signals in Hz. Defaults to 50.
+
+    Returns:
+        np.array: Filtered signals
+    """
+    return StreamingFilter(order=order, cutoff_freq=cutoff_freq, sample_freq=sample_freq).process(
+        np.atleast_2d(signals))
+
+
+@instrumentation.instrumented("filter", fields=lambda filtered, *args, **kwargs: {"samples": int(filtered.size)})
 def filter_signal(data, filt_param, filt_type="sosfiltfilt"):
     """Filter recorded data (mainly for accelerometer) using either a forward/backwards digital filter
 
@@ -47,6 +195,8 @@ def filter_signal(data, filt_param, filt_type="sosfiltfilt"):
     Returns:
         np.array: Filtered data
     """
+    from scipy import signal
+
     if filt_type == "filtfilt":
         signal_filt = signal.filtfilt(
             filt_param[0], filt_param[1], data, method="gust")
@@ -75,10 +225,7 @@ def acc_magnitude(data_parser, calibrated=True):
     else:
         acc_parsed = data_parser.acc_uncalib
 
-    acc_aux = [[xyz[1][0], xyz[1][1], xyz[1][2]]
-               for xyz in acc_parsed]
-    np_acc = np.array(acc_aux, dtype="float32")
-    acc_mag = np.linalg.norm(np_acc, ord=2, axis=1)
+    acc_mag = np.linalg.norm(acc_parsed.xyz, ord=2, axis=1)
 
     return acc_mag
 
@@ -99,10 +246,7 @@ def mag_magnitude(data_parser, calibrated=True):
     else:
         mag_parsed = data_parser.mag_uncalib
 
-    mag_aux = [[xyz[1][0], xyz[1][1], xyz[1][2]]
-               for xyz in mag_parsed]
-    np_mag = np.array(mag_aux, dtype="float32")
-    mag_norm = np.linalg.norm(np_mag, ord=2, axis=1)
+    mag_norm = np.linalg.norm(mag_parsed.xyz, ord=2, axis=1)
 
     return mag_norm
 
@@ -121,6 +265,7 @@ def acc_df(data_parser, calibrated=True, filt_type="sosfiltfilt"):
     Returns:
         pd.DataFrame: DataFrame of the filtered accelerometer data
     """
+    import pandas as pd
 
     if filt_type not in ['filtfilt', 'sosfiltfilt']:
         raise ValueError(
@@ -131,8 +276,7 @@ def acc_df(data_parser, calibrated=True, filt_type="sosfiltfilt"):
     else:
         acc_parsed = data_parser.acc_uncalib
 
-    tss = np.array([xyz[0]
-                   for xyz in acc_parsed], dtype="int")
+    tss = acc_parsed.tss
     non_filtered_acc = acc_magnitude(
         data_parser, calibrated=calibrated)
 
@@ -158,50 +302,116 @@ def mag_df(data_parser, calibrated=True):
     Returns:
         pd.DataFrame: Pandas dataframe of the respective magnetometer data
     """
+    import pandas as pd
 
     if calibrated:
         mag_parsed = data_parser.mag_calib
     else:
         mag_parsed = data_parser.mag_uncalib
 
-    tss = np.array([xyz[0]
-                   for xyz in mag_parsed], dtype="int")
+    tss = mag_parsed.tss
     mag_norm = mag_magnitude(
         data_parser, calibrated=calibrated)
 
     return pd.DataFrame(data={"tss": tss, "mag_magnitude": mag_norm})
 
 
+class WaypointTree:
+    """KD-tree spatial index over a waypoint array, answering batched nearest-neighbour, k-NN and radius queries
+    without building the N x N distance matrix"""
+
+    def __init__(self, waypoint_list):
+        """
+        Args:
+            waypoint_list (np.array): (N, 2) array of waypoints
+        """
+        from scipy.spatial import cKDTree
+
+        self.waypoints = np.asarray(waypoint_list, dtype="float64").reshape(-1, 2)
+        self.tree = cKDTree(self.waypoints)
+
+    def __len__(self):
+        return self.waypoints.shape[0]
+
+    def knn(self, points, k=1):
+        """The k nearest waypoints of each point
+
+        Args:
+            points (np.array): (M, 2) array of query points
+            k (int, optional): Number of neighbours. Defaults to 1.
+
+        Returns:
+            (np.array, np.array): (M, k) distances and indices of the neighbours into the waypoints, sorted by
+            distance. Missing neighbours have an inf distance and an index equal to the number of waypoints
+        """
+        points = np.asarray(points, dtype="float64").reshape(-1, 2)
+        distances, indices = self.tree.query(points, k=k)
+        return distances.reshape(-1, k), indices.reshape(-1, k)
+
+    def nearest(self, points):
+        """The nearest waypoint of each point
+
+        Args:
+            points (np.array): (M, 2) array of query points
+
+        Returns:
+            (np.array, np.array): Distance and index of the nearest waypoint of each point
+        """
+        distances, indices = self.knn(points, k=1)
+        return distances[:, 0], indices[:, 0]
+
+    def within(self, points, radius):
+        """The waypoints at most radius away from each point
+
+        Args:
+            points (np.array): (M, 2) array of query points
+            radius (float): Radius of the queries
+
+        Returns:
+            list(np.array): Sorted indices of the waypoints in the radius of each point
+        """
+        points = np.asarray(points, dtype="float64").reshape(-1, 2)
+        return [np.sort(np.asarray(indices, dtype="int64")) for indices in self.tree.query_ball_point(points, radius)]
+
+    def nearest_other(self):
+        """Distance and index of the nearest other waypoint of each waypoint
+
+        Only the waypoint itself is excluded, so duplicated waypoints are at distance 0 of each other.
+
+        Returns:
+            (np.array, np.array): Distance and index of the nearest other waypoint, inf and N when there is none
+        """
+        distances, indices = self.knn(self.waypoints, k=2)
+        # Duplicates may be returned before the waypoint itself, the column of the waypoint itself is dropped
+        is_self = indices[:, 0] == np.arange(len(self))
+        return np.where(is_self, distances[:, 1], distances[:, 0]), np.where(is_self, indices[:, 1], indices[:, 0])
+
+
 def all_waypoint_distances(waypoint_list):
     """Matrix of the distances between all of the nodes
 
+    This dense N x N matrix is only needed for explicit all-pairs analyses, WaypointTree answers the
+    neighbour queries without it.
+
     Returns:
         np.array: Distance matrix 
     """
-    len_mat = waypoint_list.shape[0]
-    dist_matrix = np.empty(
-        (len_mat, len_mat), dtype="float32")
-    for ix, waypoint in enumerate(waypoint_list):
-        dist_matrix[ix, :] = np.linalg.norm(
-            (waypoint_list - waypoint), axis=1)
-    return dist_matrix
+    from scipy.spatial import distance
+
+    waypoint_list = np.asarray(waypoint_list, dtype="float64").reshape(-1, 2)
+    return distance.cdist(waypoint_list, waypoint_list).astype("float32")
 
 
 def nearest_node(waypoint_list):
-    """Determines the waypoint (or node) whose distance to another node is the biggest.
+    """Determines, for each waypoint (or node), the distance to its nearest neighbour.
 
     Args:
         waypoint_list (list): List of waypoints
 
     Returns:
-        float : Distance from the most "estranged" node to its nearest neighbour
+        np.array: Distance from each node to its nearest other node, 0 for duplicated nodes and inf when there is
+        no other node
     """
-    dist_matrix = all_waypoint_distances(waypoint_list)
-
-    # Excluding the distance to self node
-    dist_matrix[dist_matrix == 0] = np.inf
-
-    # Since the matrix is symetrical, axis can be either 0 or 1
-    dist_nearest_node = np.min(dist_matrix, axis=1)
+    dist_nearest_node, _ = WaypointTree(waypoint_list).nearest_other()
 
-    return dist_nearest_node
+    return dist_nearest_node.astype("float32")
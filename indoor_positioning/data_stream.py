@@ -0,0 +1,169 @@
+from indoor_positioning.data_parser import SENSOR_TYPES, _parse_metadata
+
+import time
+
+
+# Columnar class of each TraceData sensor field
+_SENSOR_COLUMNS = {sensor_type["name"]: sensor_type["columns"] for sensor_type in SENSOR_TYPES.values()}
+
+
+def _parse_line(line, metadata):
+    """Sensor name and mapped record of a line of a tracing file, None for header and skipped lines
+
+    Args:
+        line (str): Line without its line break
+        metadata (dict): METADATA_NAMES fields read so far, updated with those of header lines
+
+    Returns:
+        (str, tuple): TraceData sensor field of the record and the record, or None
+    """
+    if line.startswith("#"):
+        _parse_metadata(line, metadata)
+        return None
+
+    split_line = line.split("\t")
+    sensor_type = SENSOR_TYPES.get(split_line[1]) if len(split_line) > 1 else None
+    # Unknown record types and truncated lines are skipped, as in the bulk engine of tracing_parser
+    if sensor_type is None or len(split_line) < sensor_type["columns"].n_fields:
+        return None
+    return sensor_type["name"], sensor_type["mapping"](split_line)
+
+
+def parse_lines(lines, metadata):
+    """Parses a batch of complete lines of a tracing file at once, e.g. those received from a live trace
+
+    Args:
+        lines (list(str)): Lines without their line breaks
+        metadata (dict): METADATA_NAMES fields read so far, updated with those of header lines
+
+    Returns:
+        dict: Columnar records of each TraceData sensor field found in the lines
+    """
+    records = {}
+    for line in lines:
+        parsed = _parse_line(line, metadata)
+        if parsed is not None:
+            records.setdefault(parsed[0], []).append(parsed[1])
+    return {sensor_name: _SENSOR_COLUMNS[sensor_name].from_records(sensor_records)
+            for sensor_name, sensor_records in records.items()}
+
+
+class TraceStream:
+    """Incremental reader of a tracing file which yields small per-sensor batches as lines arrive
+
+    Iterating over it yields (sensor_name, columns) pairs, where sensor_name is one of the TraceData
+    sensor fields (e.g. "acc_calib") and columns the same columnar class tracing_parser keeps for it
+    (SensorsXYZ, WifiData, BeaconData or WaypointData). The "#" header lines are parsed into metadata
+    as soon as they are read. At most batch_size records per sensor and one partial line are kept in
+    memory, regardless of the length of the trace.
+    """
+
+    def __init__(self, source, batch_size=256, follow=False, poll_interval=0.1, timeout=None):
+        """
+        Args:
+            source (str or file): Path of a tracing file, or a text or binary file-like object
+            batch_size (int, optional): Maximum number of records per yielded batch. Defaults to 256.
+            follow (bool, optional): Whether to keep polling the source for new lines at its end, as
+            "tail -f" does, until the endTime header is read. Defaults to False.
+            poll_interval (float, optional): Seconds between polls when following. Defaults to 0.1.
+            timeout (float, optional): Seconds without new data after which a followed source is
+            considered finished, None waits forever. Defaults to None.
+
+        Raises:
+            ValueError: When a not valid batch_size is input
+        """
+        if batch_size < 1:
+            raise ValueError(
+                "{} is not a valid batch size.".format(batch_size))
+
+        self.source = source
+        self.batch_size = batch_size
+        self.follow = follow
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        # METADATA_NAMES fields read so far, and whether the closing endTime header was read
+        self.metadata = {}
+        self.finished = False
+
+    def __iter__(self):
+        if hasattr(self.source, "readline"):
+            yield from self._read(self.source)
+        else:
+            with open(self.source, 'rb') as file:
+                yield from self._read(file)
+
+    def _read(self, file):
+        pending = {sensor_name: [] for sensor_name in _SENSOR_COLUMNS}
+        for line in self._lines(file):
+            if line is None:
+                # No new data for now, the pending records are not held back while waiting
+                yield from self._flush(pending)
+                continue
+
+            if line.startswith("#") and line.split("\t")[-1].startswith("endTime"):
+                self.finished = True
+            parsed = _parse_line(line, self.metadata)
+            if parsed is None:
+                continue
+
+            records = pending[parsed[0]]
+            records.append(parsed[1])
+            if len(records) >= self.batch_size:
+                yield from self._flush({parsed[0]: records})
+
+        yield from self._flush(pending)
+
+    def _flush(self, pending):
+        for sensor_name, records in pending.items():
+            if records:
+                yield sensor_name, _SENSOR_COLUMNS[sensor_name].from_records(records)
+                records.clear()
+
+    def _lines(self, file):
+        """Complete lines of the file without their line break, None when a followed file has no new data"""
+        partial = []
+        last_data = time.monotonic()
+        while True:
+            chunk = file.readline()
+            if chunk:
+                last_data = time.monotonic()
+                # Binary chunks are only decoded once the line is complete, since a followed file may
+                # end in the middle of a multi-byte char
+                partial.append(chunk)
+                if chunk.endswith(b"\n" if isinstance(chunk, bytes) else "\n"):
+                    line = self._join(partial)
+                    partial = []
+                    if line:
+                        yield line
+                    if self.follow and self.finished:
+                        return
+                continue
+
+            # End of the data available so far
+            if not self.follow or self.finished or \
+                    (self.timeout is not None and time.monotonic() - last_data >= self.timeout):
+                line = self._join(partial)
+                if line:
+                    yield line
+                return
+            yield None
+            time.sleep(self.poll_interval)
+
+    @staticmethod
+    def _join(chunks):
+        line = b"".join(chunks).decode("utf-8") if chunks and isinstance(chunks[0], bytes) else "".join(chunks)
+        return line.rstrip("\r\n")
+
+
+def stream_parser(source, **kwargs):
+    """Incremental counterpart of data_parser.tracing_parser for live or very long traces
+
+    Args:
+        source (str or file): Path of a tracing file, or a text or binary file-like object
+        **kwargs: Options of TraceStream (batch_size, follow, poll_interval, timeout)
+
+    Returns:
+        TraceStream: Iterable of (sensor_name, columns) batches, its metadata is filled as the header lines
+        are read
+    """
+    return TraceStream(source, **kwargs)
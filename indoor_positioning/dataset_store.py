@@ -0,0 +1,502 @@
+"""Parquet dataset of the tracing files of a whole corpus, partitioned by site, floor and record type
+
+The converter parses every floor folder once, in a pool of worker processes, and writes its records into
+<store>/site_id=<SiteID>/floor_id=<FloorId>/record_type=<SENSOR_TYPES key>/part-0.parquet, with the METADATA_NAMES
+fields and the trace id as columns. Both the files and the manifest of the store are named after their partitions,
+so converting a moved or copied corpus replaces its partitions instead of duplicating them. The traces of a floor
+are written in the order of their start times, in row groups of about ROW_GROUP_ROWS rows, so the timestamp and
+trace statistics of the row groups let queries skip most of a file. The queries of DatasetStore read only the
+partitions, columns and row groups they need, instead of parsing the text of every trace again.
+
+pyarrow is an optional dependency, only needed by this module.
+
+Usage:
+    python -m indoor_positioning.dataset_store ROOT [--store-dir DIR] [--workers N] [--row-group-rows N]
+"""
+from indoor_positioning.data_parser import SENSOR_TYPES, BeaconData, SensorsXYZ, TraceData, WaypointData, WifiData, \
+    _categorical, find_traces, tracing_parser
+from collections import defaultdict
+from multiprocessing import Pool
+from functools import partial
+from pathlib import Path
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+# Approximate number of rows of the row groups of the Parquet files
+ROW_GROUP_ROWS = 1 << 17
+
+# Version of the schemas of the files, part of the floor fingerprints so that the floors converted with older
+# schemas are converted again
+STORE_FORMAT = 2
+
+# Manifest of the converted floor folders, ignored by the datasets as it starts with "_"
+MANIFEST_FILE = "_floors.json"
+
+PARTITION_NAMES = ["site_id", "floor_id", "record_type"]
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError("The dataset store requires pyarrow, which can be installed with: pip install pyarrow")
+
+
+def record_schema(record_type):
+    """Arrow schema of the Parquet files of a record type, without the partition fields
+
+    Args:
+        record_type (str): SENSOR_TYPES key
+
+    Raises:
+        ValueError: When a not valid record type is input
+
+    Returns:
+        pyarrow.Schema: Schema of the files
+    """
+    _require_pyarrow()
+    if record_type not in SENSOR_TYPES:
+        raise ValueError(
+            "{} is not a valid record type.".format(record_type))
+
+    name = pa.dictionary(pa.int32(), pa.string())
+    columns = SENSOR_TYPES[record_type]["columns"]
+    if columns is SensorsXYZ:
+        fields = [("x", pa.float32()), ("y", pa.float32()), ("z", pa.float32())]
+    elif columns is WifiData:
+        fields = [("ssid", name), ("bssid", name), ("rssi", pa.int16())]
+    elif columns is BeaconData:
+        fields = [("beacon", name), ("rssi", pa.int16()), ("tx_power", pa.int16())]
+    else:
+        fields = [("x", pa.float32()), ("y", pa.float32())]
+    return pa.schema([("tss", pa.int64())] + fields + [("trace", name), ("start_time", pa.int64()),
+                                                        ("site_name", name), ("floor_name", name)])
+
+
+def _record_table(trace_data, record_type, schema):
+    """Table of the records of a type in a parsed trace, the string columns keep the codes of the parser"""
+    sensor_data = getattr(trace_data, SENSOR_TYPES[record_type]["name"])
+    n_rows = len(sensor_data)
+
+    if isinstance(sensor_data, WifiData):
+        arrays = [pa.DictionaryArray.from_arrays(sensor_data.ssid, sensor_data.ssid_names),
+                  pa.DictionaryArray.from_arrays(sensor_data.bssid, sensor_data.bssid_names), sensor_data.rssi]
+    elif isinstance(sensor_data, BeaconData):
+        arrays = [pa.DictionaryArray.from_arrays(sensor_data.beacon, sensor_data.beacon_names), sensor_data.rssi,
+                  sensor_data.tx_power]
+    else:
+        values = sensor_data.xyz if isinstance(sensor_data, SensorsXYZ) else sensor_data.xy
+        arrays = [np.ascontiguousarray(values[:, axis]) for axis in range(values.shape[1])]
+
+    # The metadata is constant in a trace, a single dictionary value
+    zeros = np.zeros(n_rows, dtype=np.int32)
+    arrays = [sensor_data.tss] + arrays + [
+        pa.DictionaryArray.from_arrays(zeros, [Path(trace_data.file_name).stem]),
+        np.full(n_rows, int(trace_data.start_time), dtype=np.int64),
+        pa.DictionaryArray.from_arrays(zeros, [trace_data.site_name]),
+        pa.DictionaryArray.from_arrays(zeros, [trace_data.floor_name])]
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def _start_time(trace_filename):
+    """startTime of the first header line of a tracing file, 0 when it has none"""
+    with open(trace_filename, "rb") as f:
+        first_line = f.readline(256)
+    try:
+        return int(first_line.split(b"startTime:", 1)[1].split(b"\t", 1)[0])
+    except (IndexError, ValueError):
+        return 0
+
+
+def _floor_fingerprint(trace_filenames):
+    """Hex digest of the names, sizes and mtimes of the tracing files of a floor folder, and of STORE_FORMAT"""
+    identity = [str(STORE_FORMAT)]
+    for trace_filename in sorted(trace_filenames):
+        stat = os.stat(trace_filename)
+        identity.append("{}\t{}\t{}".format(Path(trace_filename).name, stat.st_size, stat.st_mtime_ns))
+    return hashlib.sha1("\n".join(identity).encode("utf-8")).hexdigest()
+
+
+class _PartitionWriter:
+    """Writes the tables of a partition as row groups of about row_group_rows rows, into a temporary file which
+    replaces the partition file once closed, or is removed when the writing is aborted"""
+
+    def __init__(self, path, schema, row_group_rows):
+        self.path = path
+        self.tmp_path = path.with_name("." + path.name + ".tmp{}".format(os.getpid()))
+        self.schema = schema
+        self.row_group_rows = row_group_rows
+        self.pending = []
+        self.n_pending = 0
+        self.n_rows = 0
+        self.writer = None
+
+    def write(self, table):
+        self.pending.append(table)
+        self.n_pending += table.num_rows
+        if self.n_pending >= self.row_group_rows:
+            self.flush()
+
+    def flush(self):
+        if not self.n_pending:
+            return
+        if self.writer is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.writer = pq.ParquetWriter(self.tmp_path, self.schema, compression="zstd")
+        table = pa.concat_tables(self.pending)
+        self.writer.write_table(table, row_group_size=table.num_rows)
+        self.n_rows += table.num_rows
+        self.pending, self.n_pending = [], 0
+
+    def close(self):
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+            os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        self.tmp_path.unlink(missing_ok=True)
+
+
+def convert_floor(floor_dir, store_dir, row_group_rows=ROW_GROUP_ROWS):
+    """Writes the records of the tracing files of a floor folder into the store, holding a single parsed trace
+    and the pending row group of each partition in memory
+
+    The partition of each trace is given by its SiteID and FloorId headers, and each partition of the floor is
+    written into its part-0.parquet file, which replaces the one of a previous conversion.
+
+    Args:
+        floor_dir (str): Floor folder of tracing files
+        store_dir (str): Folder of the store
+        row_group_rows (int, optional): Approximate number of rows of the row groups. Defaults to ROW_GROUP_ROWS.
+
+    Returns:
+        dict: Summary of the floor: fingerprint of its tracing files, an error message of each trace which could
+        not be parsed, number of traces, files written relative to store_dir and rows of each record type, in
+        total and by "<site_id>/<floor_id>" partition
+    """
+    _require_pyarrow()
+    trace_filenames = sorted(Path(floor_dir).glob("*.txt"), key=lambda filename: (_start_time(filename), filename))
+    summary = {"floor": str(floor_dir), "traces": 0, "files": [], "rows": {}, "errors": [],
+               "fingerprint": _floor_fingerprint(trace_filenames), "partitions": {}}
+    schemas = {record_type: record_schema(record_type) for record_type in SENSOR_TYPES}
+    writers = {}
+    try:
+        for trace_filename in trace_filenames:
+            try:
+                trace_data = tracing_parser(str(trace_filename))
+            except Exception as error:
+                # A broken trace must not stop the whole floor, it is reported in the summary instead
+                summary["errors"].append("{}: {}: {}".format(trace_filename, type(error).__name__, error))
+                continue
+            summary["traces"] += 1
+            partition_summary = summary["partitions"].setdefault(
+                "{}/{}".format(trace_data.site_id, trace_data.floor_id), {"traces": 0, "files": [], "rows": {}})
+            partition_summary["traces"] += 1
+            for record_type, schema in schemas.items():
+                table = _record_table(trace_data, record_type, schema)
+                if not table.num_rows:
+                    continue
+                partition = (trace_data.site_id, trace_data.floor_id, record_type)
+                if partition not in writers:
+                    path = Path(store_dir).joinpath(*["{}={}".format(name, value) for name, value in
+                                                      zip(PARTITION_NAMES, partition)],
+                                                    "part-0.parquet")
+                    writers[partition] = _PartitionWriter(path, schema, row_group_rows)
+                writers[partition].write(table)
+    except BaseException:
+        # The partition files of the last conversion are only replaced once the whole floor is written
+        for writer in writers.values():
+            writer.abort()
+        raise
+    for writer in writers.values():
+        writer.close()
+
+    for (site_id, floor_id, record_type), writer in writers.items():
+        for totals in [summary, summary["partitions"]["{}/{}".format(site_id, floor_id)]]:
+            totals["files"].append(str(writer.path.relative_to(store_dir)))
+            totals["rows"][record_type] = totals["rows"].get(record_type, 0) + writer.n_rows
+    return summary
+
+
+def _convert_floor_task(floor_dir, store_dir, row_group_rows):
+    try:
+        return convert_floor(floor_dir, store_dir, row_group_rows=row_group_rows)
+    except Exception as error:
+        return {"floor": floor_dir, "traces": 0, "files": [], "rows": {},
+                "errors": ["{}: {}".format(type(error).__name__, error)]}
+
+
+def _unparsed_key(floor_dir):
+    """Manifest key of a floor folder none of whose tracing files could be parsed, which has no partition"""
+    return "floor_dir={}/{}".format(Path(floor_dir).parent.name, Path(floor_dir).name)
+
+
+def _write_manifest(store_dir, manifest):
+    manifest_file = Path(store_dir) / MANIFEST_FILE
+    tmp_file = manifest_file.with_name(manifest_file.name + ".tmp{}".format(os.getpid()))
+    with open(tmp_file, "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_file, manifest_file)
+
+
+def convert(root, store_dir, workers=None, row_group_rows=ROW_GROUP_ROWS, progress=True):
+    """Brings the store up to date with every tracing file under root, in a pool of worker processes
+
+    Each worker converts a whole floor folder. Floors whose tracing files did not change since their last
+    conversion (same names, sizes and mtimes, as kept by partition in the manifest of the store) are skipped,
+    and the files which a partition no longer holds are removed. A floor none of whose traces could be parsed
+    is kept in the manifest under its folder names instead, so it is skipped as well until its files change,
+    and its errors are reported again. A partition holds the traces of the last floor
+    folder converted into it.
+
+    Args:
+        root (str): Venue, floor or dataset folder
+        store_dir (str): Folder of the store
+        workers (int, optional): Number of worker processes, None uses every core. Defaults to None.
+        row_group_rows (int, optional): Approximate number of rows of the row groups. Defaults to ROW_GROUP_ROWS.
+        progress (bool, optional): Whether to report the progress on stderr. Defaults to True.
+
+    Raises:
+        ValueError: When a not valid number of workers is input
+
+    Returns:
+        list(dict): Summary of each floor folder, see convert_floor, with "skipped" set for the up to date ones
+    """
+    _require_pyarrow()
+    workers = os.cpu_count() if workers is None else workers
+    if workers < 1:
+        raise ValueError(
+            "{} is not a valid number of workers.".format(workers))
+
+    floors = defaultdict(list)
+    for trace_filename in find_traces(root):
+        floors[os.path.abspath(Path(trace_filename).parent)].append(trace_filename)
+    Path(store_dir).mkdir(parents=True, exist_ok=True)
+    manifest_file = Path(store_dir) / MANIFEST_FILE
+    manifest = json.loads(manifest_file.read_text()) if manifest_file.exists() else {}
+
+    summaries = []
+    stale_floors = []
+    for floor_dir, trace_filenames in sorted(floors.items()):
+        fingerprint = _floor_fingerprint(trace_filenames)
+        partitions = {partition: entry for partition, entry in manifest.items() if entry["fingerprint"] == fingerprint}
+        if partitions:
+            summaries.append({"floor": floor_dir, "fingerprint": fingerprint, "skipped": True,
+                              "traces": sum(entry["traces"] for entry in partitions.values()),
+                              "files": [file for entry in partitions.values() for file in entry["files"]],
+                              "errors": [error for entry in partitions.values() for error in entry.get("errors", [])],
+                              "partitions": partitions})
+        else:
+            stale_floors.append(floor_dir)
+
+    if not stale_floors:
+        return summaries
+
+    n_converted = 0
+    start_time = time.perf_counter()
+    worker_task = partial(_convert_floor_task, store_dir=store_dir, row_group_rows=row_group_rows)
+    with Pool(processes=min(workers, max(len(stale_floors), 1))) as pool:
+        for summary in pool.imap_unordered(worker_task, stale_floors):
+            # A floor whose conversion failed keeps the files and the manifest entry of its last conversion
+            if "fingerprint" in summary:
+                for partition, partition_summary in summary["partitions"].items():
+                    for old_file in set(manifest.get(partition, {}).get("files", [])) - set(partition_summary["files"]):
+                        Path(store_dir, old_file).unlink(missing_ok=True)
+                    manifest[partition] = dict(partition_summary, fingerprint=summary["fingerprint"])
+                if summary["partitions"]:
+                    manifest.pop(_unparsed_key(summary["floor"]), None)
+                else:
+                    manifest[_unparsed_key(summary["floor"])] = {"traces": 0, "files": [], "rows": {},
+                                                                  "errors": summary["errors"],
+                                                                  "fingerprint": summary["fingerprint"]}
+                _write_manifest(store_dir, manifest)
+            summaries.append(summary)
+            n_converted += 1
+            if progress:
+                elapsed = time.perf_counter() - start_time
+                print("[{}/{}] {:.2f} floors/s {} ({} traces{})".format(
+                    n_converted, len(stale_floors), n_converted / elapsed, summary["floor"], summary["traces"],
+                    ", {} errors".format(len(summary["errors"])) if summary["errors"] else ""), file=sys.stderr)
+    return summaries
+
+
+class DatasetStore:
+    """Queries of the records of a store written by convert
+
+    Every query is on one record type, whose partition files are listed from their site and floor folders,
+    so that a query of a floor never lists the rest of the corpus. Only the requested columns are read, and the
+    predicates are pushed down to the Parquet row groups.
+
+    Example:
+        store = DatasetStore("./output/dataset_store/")
+        wifi = store.query("TYPE_WIFI", columns=["tss", "bssid", "rssi"], floor_name="F1", start=t0, end=t1)
+    """
+
+    def __init__(self, store_dir):
+        """
+        Args:
+            store_dir (str): Folder of the store
+        """
+        _require_pyarrow()
+        self.store_dir = Path(store_dir)
+
+    def files(self, record_type, site_id=None, floor_id=None):
+        """Parquet files of a record type, of a site and floor when given
+
+        Args:
+            record_type (str): SENSOR_TYPES key
+            site_id (str, optional): SiteID of the files, None for every site. Defaults to None.
+            floor_id (str, optional): FloorId of the files, None for every floor. Defaults to None.
+
+        Returns:
+            list(str): Paths of the files
+        """
+        pattern = "site_id={}/floor_id={}/record_type={}/*.parquet".format(
+            "*" if site_id is None else site_id, "*" if floor_id is None else floor_id, record_type)
+        return sorted(str(path) for path in self.store_dir.glob(pattern))
+
+    def dataset(self, record_type, site_id=None, floor_id=None):
+        """Arrow dataset of the files of a record type, with the partition fields as columns
+
+        Args:
+            record_type (str): SENSOR_TYPES key
+            site_id (str, optional): SiteID of the files, None for every site. Defaults to None.
+            floor_id (str, optional): FloorId of the files, None for every floor. Defaults to None.
+
+        Raises:
+            ValueError: When a not valid record type is input
+
+        Returns:
+            pyarrow.dataset.Dataset: Dataset of the files
+        """
+        partition_schema = pa.schema([(name, pa.string()) for name in PARTITION_NAMES])
+        schema = pa.unify_schemas([record_schema(record_type), partition_schema])
+        return ds.dataset(self.files(record_type, site_id, floor_id), schema=schema, format="parquet",
+                          partitioning=ds.partitioning(partition_schema, flavor="hive"),
+                          partition_base_dir=str(self.store_dir))
+
+    def query(self, record_type, columns=None, site_id=None, floor_id=None, floor_name=None, trace=None,
+              start=None, end=None, filter=None):
+        """Records of a type, e.g. all the WiFi rows of floor F1 between two timestamps
+
+        Args:
+            record_type (str): SENSOR_TYPES key
+            columns (list(str), optional): Columns read, None reads all of them. Defaults to None.
+            site_id (str, optional): SiteID of the records. Defaults to None.
+            floor_id (str, optional): FloorId of the records. Defaults to None.
+            floor_name (str, optional): FloorName of the records. Defaults to None.
+            trace (str, optional): Trace id of the records, the stem of its tracing file. Defaults to None.
+            start (int, optional): Minimum timestamp of the records in ms, included. Defaults to None.
+            end (int, optional): Maximum timestamp of the records in ms, excluded. Defaults to None.
+            filter (pyarrow.compute.Expression, optional): Any further predicate on the columns. Defaults to None.
+
+        Raises:
+            ValueError: When a not valid record type is input
+
+        Returns:
+            pyarrow.Table: Selected columns of the records
+        """
+        predicates = [] if filter is None else [filter]
+        for field, value in [("floor_name", floor_name), ("trace", trace)]:
+            if value is not None:
+                predicates.append(ds.field(field) == value)
+        if start is not None:
+            predicates.append(ds.field("tss") >= start)
+        if end is not None:
+            predicates.append(ds.field("tss") < end)
+
+        expression = None
+        for predicate in predicates:
+            expression = predicate if expression is None else expression & predicate
+        return self.dataset(record_type, site_id, floor_id).to_table(columns=columns, filter=expression)
+
+    def trace_data(self, trace, site_id=None, floor_id=None):
+        """Parsed data of a trace, read from the store instead of its tracing file
+
+        Args:
+            trace (str): Trace id, the stem of its tracing file
+            site_id (str, optional): SiteID of the trace, which avoids listing the other sites. Defaults to None.
+            floor_id (str, optional): FloorId of the trace, which avoids listing the other floors.
+            Defaults to None.
+
+        Raises:
+            ValueError: When the trace is not in the store
+
+        Returns:
+            TraceData: Trace data, whose file_name is the trace id
+        """
+        trace_data_kwargs = {"file_name": trace}
+        for record_type, sensor_type in SENSOR_TYPES.items():
+            table = self.query(record_type, site_id=site_id, floor_id=floor_id, trace=trace)
+            if table.num_rows and "site_id" not in trace_data_kwargs:
+                # The metadata is kept as the strings returned by the parser
+                for field in ["start_time", "site_id", "site_name", "floor_id", "floor_name"]:
+                    trace_data_kwargs[field] = str(table.column(field)[0].as_py())
+            trace_data_kwargs[sensor_type["name"]] = _sensor_data(sensor_type["columns"], table)
+
+        if "site_id" not in trace_data_kwargs:
+            raise ValueError(
+                "{} is not a valid trace of the store.".format(trace))
+        return TraceData(**trace_data_kwargs)
+
+
+def _sensor_data(columns, table):
+    """Columnar sensor data of a table read from the store"""
+    def strings(name):
+        return table.column(name).cast(pa.string()).to_numpy(zero_copy_only=False).astype(str)
+
+    tss = table.column("tss").to_numpy().astype(np.int64)
+    if columns is WifiData:
+        ssid_names, ssid = _categorical(strings("ssid"))
+        bssid_names, bssid = _categorical(strings("bssid"))
+        return WifiData(tss=tss, ssid=ssid, bssid=bssid, rssi=table.column("rssi").to_numpy().astype(np.int16),
+                        ssid_names=ssid_names, bssid_names=bssid_names)
+    if columns is BeaconData:
+        beacon_names, beacon = _categorical(strings("beacon"))
+        return BeaconData(tss=tss, beacon=beacon, rssi=table.column("rssi").to_numpy().astype(np.int16),
+                          tx_power=table.column("tx_power").to_numpy().astype(np.int16), beacon_names=beacon_names)
+    axes = ["x", "y", "z"] if columns is SensorsXYZ else ["x", "y"]
+    values = np.stack([table.column(axis).to_numpy() for axis in axes], axis=1).astype(np.float32)
+    if columns is SensorsXYZ:
+        return SensorsXYZ(tss=tss, xyz=values.reshape(-1, 3))
+    return WaypointData(tss=tss, xy=values.reshape(-1, 2))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Converts the tracing files of a venue or dataset folder into "
+                                     "the partitioned Parquet dataset store")
+    parser.add_argument("root", help="Venue, floor or dataset folder")
+    parser.add_argument("--store-dir", default="./output/dataset_store/", help="Folder of the store")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes")
+    parser.add_argument("--row-group-rows", type=int, default=ROW_GROUP_ROWS,
+                        help="Approximate number of rows of the row groups")
+    parser.add_argument("--quiet", action="store_true", help="Do not report the progress")
+    args = parser.parse_args(argv)
+
+    summaries = convert(args.root, args.store_dir, workers=args.workers, row_group_rows=args.row_group_rows,
+                        progress=not args.quiet)
+    n_skipped = sum(summary.get("skipped", False) for summary in summaries)
+    n_errors = sum(len(summary["errors"]) for summary in summaries)
+    print("{} floors converted, {} up to date, {} traces not parsed".format(len(summaries) - n_skipped, n_skipped,
+                                                                           n_errors))
+    return 1 if n_errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,292 @@
+from indoor_positioning import data_parser
+from pathlib import Path
+
+import glob
+import json
+import os
+import numpy as np
+
+# scipy is imported by the functions which use it, as in data_processing
+
+# RSSI given to the access points missing from a scan, the stored values are shifted by it so that they are
+# positive and the missing ones are the sparse zeros
+MISSING_RSSI = -100
+
+# Databases up to this size are searched exhaustively, larger ones through the projected KD-tree
+EXACT_SEARCH_LIMIT = 2048
+N_COMPONENTS = 16
+# Fingerprints added after the KD-tree was built are searched exhaustively, until they exceed this fraction of
+# the fingerprints in the tree and the index is rebuilt
+REBUILD_FRACTION = 0.25
+
+
+def wifi_scans(wifi, bssid_ids):
+    """Groups the WiFi records of a trace by scan timestamp into sparse RSSI vectors
+
+    Args:
+        wifi (WifiData): WiFi records of a trace
+        bssid_ids (dict): Column of each interned BSSID, new BSSIDs are added to it
+
+    Returns:
+        (np.array, sparse.csr_matrix): Timestamp of each scan and its (scans, len(bssid_ids)) RSSI vector,
+        shifted by MISSING_RSSI. When a BSSID appears twice in a scan, its strongest RSSI is kept
+    """
+    from scipy import sparse
+
+    bssid_columns = np.array([bssid_ids.setdefault(bssid, len(bssid_ids)) for bssid in wifi.bssid_names],
+                             dtype=np.int64)
+    scan_tss, scan_rows = np.unique(np.asarray(wifi.tss), return_inverse=True)
+    scan_rows = scan_rows.reshape(-1)
+    columns = bssid_columns[wifi.bssid] if len(wifi) else np.empty(0, dtype=np.int64)
+    values = np.asarray(wifi.rssi, dtype=np.float32) - MISSING_RSSI
+
+    # Strongest reading of each (scan, BSSID) pair
+    order = np.lexsort((-values, columns, scan_rows))
+    scan_rows, columns, values = scan_rows[order], columns[order], values[order]
+    first = np.ones(scan_rows.shape[0], dtype=bool)
+    first[1:] = (scan_rows[1:] != scan_rows[:-1]) | (columns[1:] != columns[:-1])
+
+    vectors = sparse.csr_matrix((np.clip(values[first], 0, None), (scan_rows[first], columns[first])),
+                                shape=(scan_tss.shape[0], len(bssid_ids)), dtype=np.float32)
+    return scan_tss, vectors
+
+
+def label_scans(scan_tss, waypoint):
+    """Positions of the scans, linearly interpolated between the waypoints of the trace
+
+    Args:
+        scan_tss (np.array): Timestamp of each scan
+        waypoint (WaypointData): Waypoints of the trace
+
+    Returns:
+        (np.array, np.array): Boolean mask of the scans within the time range of the waypoints, and their (N, 2)
+        positions
+    """
+    waypoint_tss = np.asarray(waypoint.tss, dtype="float64")
+    if not waypoint_tss.shape[0]:
+        return np.zeros(scan_tss.shape[0], dtype=bool), np.empty((0, 2), dtype=np.float32)
+
+    labelled = (scan_tss >= waypoint_tss[0]) & (scan_tss <= waypoint_tss[-1])
+    tss = np.asarray(scan_tss[labelled], dtype="float64")
+    xy = np.stack([np.interp(tss, waypoint_tss, waypoint.xy[:, ix]) for ix in range(2)], axis=1)
+    return labelled, xy.astype(np.float32)
+
+
+class FingerprintDB:
+    """Per-floor database of WiFi fingerprints labelled with positions, with an index for k-NN position queries
+
+    Fingerprints are compared by the euclidean distance of their RSSI vectors, missing access points being at
+    MISSING_RSSI. Large databases are indexed by a KD-tree over the projection of the fingerprints on their
+    N_COMPONENTS principal components: its nearest neighbours are the candidates whose exact distances
+    are then computed. Traces are added incrementally: the first query after them appends their fingerprints
+    to the index, where they are all candidates besides those of the KD-tree, which is only rebuilt once they
+    exceed REBUILD_FRACTION of it. The new access points of the traces may be missing from the principal
+    components, so their fingerprints could not be found through the KD-tree until then. Saving only writes
+    the fingerprints added since the last save.
+    """
+
+    def __init__(self):
+        self.bssid_ids = {}
+        self.traces = []
+        self._chunks = []
+        self._n_saved_chunks = 0
+        self._index = None
+
+    def __len__(self):
+        return sum(chunk["positions"].shape[0] for chunk in self._chunks)
+
+    def add_trace(self, trace_data):
+        """Adds the labelled scans of a trace, traces already in the database are skipped
+
+        Args:
+            trace_data (TraceData): Parsed trace with WiFi and waypoint records
+
+        Returns:
+            int: Number of fingerprints added
+        """
+        trace_id = Path(trace_data.file_name).stem
+        if trace_id in self.traces:
+            return 0
+
+        scan_tss, vectors = wifi_scans(trace_data.wifi, self.bssid_ids)
+        labelled, positions = label_scans(scan_tss, trace_data.waypoint)
+        vectors = vectors[labelled]
+        self._chunks.append({"trace": trace_id, "tss": scan_tss[labelled].astype(np.int64),
+                             "positions": positions, "vectors": vectors})
+        self.traces.append(trace_id)
+        return positions.shape[0]
+
+    def _stack_chunks(self, chunks):
+        """(fingerprints, BSSIDs) sparse matrix, squared norms and positions of the fingerprints of chunks"""
+        from scipy import sparse
+
+        n_bssids = len(self.bssid_ids)
+        # The BSSIDs interned after a chunk was added are new columns, missing from its vectors
+        vectors = [sparse.csr_matrix((chunk["vectors"].data, chunk["vectors"].indices, chunk["vectors"].indptr),
+                                     shape=(chunk["vectors"].shape[0], n_bssids)) for chunk in chunks]
+        matrix = sparse.vstack(vectors + [sparse.csr_matrix((0, n_bssids), dtype=np.float32)], format="csr")
+        squared_norms = np.asarray(matrix.multiply(matrix).sum(axis=1), dtype="float64").reshape(-1)
+        positions = np.concatenate([chunk["positions"] for chunk in chunks] + [np.empty((0, 2), dtype=np.float32)])
+        return matrix, squared_norms, positions
+
+    def _update_index(self):
+        """Brings the index up to date with the traces added since it was built, see FingerprintDB"""
+        if self._index is not None and self._index["n_chunks"] == len(self._chunks):
+            return
+        if self._index is None or self._index["tree"] is None or \
+                len(self) - self._index["tree"].n > REBUILD_FRACTION * self._index["tree"].n:
+            self._build_index()
+            return
+
+        from scipy import sparse
+
+        matrix, squared_norms, positions = self._stack_chunks(self._chunks[self._index["n_chunks"]:])
+        indexed = self._index["matrix"]
+        indexed = sparse.csr_matrix((indexed.data, indexed.indices, indexed.indptr),
+                                    shape=(indexed.shape[0], matrix.shape[1]))
+        self._index.update({
+            "matrix": sparse.vstack([indexed, matrix], format="csr"),
+            "squared_norms": np.concatenate([self._index["squared_norms"], squared_norms]),
+            "positions": np.concatenate([self._index["positions"], positions]),
+            "n_chunks": len(self._chunks),
+        })
+
+    def _build_index(self):
+        from scipy.sparse.linalg import LinearOperator, svds
+        from scipy.spatial import cKDTree
+
+        matrix, squared_norms, positions = self._stack_chunks(self._chunks)
+        self._index = {"matrix": matrix, "squared_norms": squared_norms, "positions": positions, "tree": None,
+                       "n_chunks": len(self._chunks)}
+        if matrix.shape[0] <= EXACT_SEARCH_LIMIT or matrix.shape[1] <= N_COMPONENTS + 1:
+            return
+
+        # Principal components of the fingerprints, the centering is applied implicitly to keep them sparse
+        mean = np.asarray(matrix.mean(axis=0), dtype="float64").reshape(-1)
+        centered = LinearOperator(matrix.shape, dtype="float64",
+                                  matvec=lambda v: matrix @ v - mean @ v,
+                                  rmatvec=lambda u: matrix.T @ u - mean * u.sum())
+        _, _, components = svds(centered, k=N_COMPONENTS, v0=np.full(min(matrix.shape), 1.0))
+        self._index["components"] = components.T
+        self._index["projected_mean"] = mean @ components.T
+        self._index["tree"] = cKDTree(matrix @ components.T - self._index["projected_mean"])
+
+    def knn(self, bssids, rssi, k=5, exact=False):
+        """The k fingerprints closest to a WiFi scan, and the position estimated from them
+
+        Args:
+            bssids (list(str)): BSSIDs of the scan
+            rssi (np.array): RSSI of each BSSID
+            k (int, optional): Number of neighbours. Defaults to 5.
+            exact (bool, optional): Whether to compute the distance to every fingerprint instead of only to
+            the candidates of the KD-tree. Defaults to False.
+
+        Returns:
+            (np.array, np.array, np.array): Inverse-distance weighted position of the neighbours (NaN when
+            there are none), their indices into the database and their RSSI distances
+        """
+        self._update_index()
+        matrix = self._index["matrix"]
+        k = min(k, matrix.shape[0])
+        if not k:
+            return np.full(2, np.nan), np.empty(0, dtype=np.int64), np.empty(0)
+
+        # Access points unknown to the database only add to the norm of the scan
+        query = np.zeros(matrix.shape[1])
+        values = np.clip(np.asarray(rssi, dtype="float64") - MISSING_RSSI, 0, None)
+        columns = np.array([self.bssid_ids.get(bssid, -1) for bssid in bssids], dtype=np.int64)
+        query[columns[columns >= 0]] = values[columns >= 0]
+        query_norm = float(np.dot(values, values))
+
+        if exact or self._index["tree"] is None:
+            candidates = np.arange(matrix.shape[0])
+            dot = matrix @ query
+        else:
+            tree, components = self._index["tree"], self._index["components"]
+            # The access points interned after the tree was built have no principal component
+            _, candidates = tree.query(query[:components.shape[0]] @ components - self._index["projected_mean"],
+                                       k=min(max(8 * k, 64), tree.n))
+            candidates = np.atleast_1d(candidates)
+            dot = matrix[candidates] @ query
+            if matrix.shape[0] > tree.n:
+                # The fingerprints added after the tree follow its own ones in the matrix
+                candidates = np.concatenate([candidates, np.arange(tree.n, matrix.shape[0])])
+                dot = np.concatenate([dot, matrix[tree.n:] @ query])
+        distances = np.sqrt(np.clip(query_norm + self._index["squared_norms"][candidates] - 2 * dot, 0, None))
+
+        nearest = np.argpartition(distances, k - 1)[:k]
+        nearest = nearest[np.argsort(distances[nearest])]
+        weights = 1 / (distances[nearest] + 1e-6)
+        position = (self._index["positions"][candidates[nearest]] * weights[:, None]).sum(axis=0) / weights.sum()
+        return position, candidates[nearest], distances[nearest]
+
+    def save(self, db_dir):
+        """Saves the database into a folder, only the traces added since the last save are written
+
+        Args:
+            db_dir (str): Folder of the database
+        """
+        db_dir = Path(db_dir)
+        db_dir.mkdir(parents=True, exist_ok=True)
+        for chunk_ix in range(self._n_saved_chunks, len(self._chunks)):
+            chunk = self._chunks[chunk_ix]
+            with open(db_dir / "chunk_{:06d}.npz".format(chunk_ix), "wb") as f:
+                np.savez(f, tss=chunk["tss"], positions=chunk["positions"], data=chunk["vectors"].data,
+                         indices=chunk["vectors"].indices, indptr=chunk["vectors"].indptr)
+
+        # The BSSIDs only grow, so the chunks saved before keep their columns
+        bssids = sorted(self.bssid_ids, key=self.bssid_ids.get)
+        tmp_file = db_dir / "meta.json.tmp{}".format(os.getpid())
+        with open(tmp_file, "w") as f:
+            json.dump({"bssids": bssids, "traces": self.traces}, f)
+        os.replace(tmp_file, db_dir / "meta.json")
+        self._n_saved_chunks = len(self._chunks)
+
+    @classmethod
+    def load(cls, db_dir):
+        """Loads a database saved with save, an empty database when the folder has none
+
+        Args:
+            db_dir (str): Folder of the database
+
+        Returns:
+            FingerprintDB: Loaded database
+        """
+        from scipy import sparse
+
+        db = cls()
+        db_dir = Path(db_dir)
+        if not (db_dir / "meta.json").exists():
+            return db
+
+        with open(db_dir / "meta.json") as f:
+            meta = json.load(f)
+        db.bssid_ids = {bssid: ix for ix, bssid in enumerate(meta["bssids"])}
+        db.traces = meta["traces"]
+        for chunk_ix, trace_id in enumerate(db.traces):
+            with np.load(db_dir / "chunk_{:06d}.npz".format(chunk_ix)) as chunk:
+                vectors = sparse.csr_matrix((chunk["data"], chunk["indices"], chunk["indptr"]),
+                                            shape=(chunk["positions"].shape[0], len(db.bssid_ids)))
+                db._chunks.append({"trace": trace_id, "tss": chunk["tss"], "positions": chunk["positions"],
+                                   "vectors": vectors})
+        db._n_saved_chunks = len(db._chunks)
+        return db
+
+
+def build_floor_db(map_folder, db_dir):
+    """Brings the fingerprint database of a floor up to date with its tracing files
+
+    Args:
+        map_folder (str): DIR of the map
+        db_dir (str): Folder of the database of the floor
+
+    Returns:
+        FingerprintDB: Database with the fingerprints of every trace of the floor
+    """
+    db = FingerprintDB.load(db_dir)
+    for trace_filename in sorted(glob.glob(map_folder + "/*.txt", recursive=True)):
+        if Path(trace_filename).stem not in db.traces:
+            db.add_trace(data_parser.tracing_parser(
+                trace_filename, record_types={"TYPE_WIFI", "TYPE_WAYPOINT"}))
+    db.save(db_dir)
+    return db
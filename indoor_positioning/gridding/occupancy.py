@@ -1,47 +1,178 @@
 
+from indoor_positioning import instrumentation
+from indoor_positioning.gridding.format import extract_geometries, extract_outline, transform
 from shapely.geometry import Point
+from pathlib import Path
 import numpy as np
-import matplotlib.pyplot as plt
+import hashlib
+import json
+import os
+
+try:
+    from shapely import contains_xy
+except ImportError:
+    # Shapely < 2.0
+    from shapely.vectorized import contains as contains_xy
 
 
 class OccupancyGridMap:
-    def __init__(self, affine_layout, cell_size):
+    def __init__(self, affine_layout, cell_size, method="scanline", outline=None):
         """Class associated to a discretized grid of square cells which correspond to the occupancy map of a respective floor.
 
+        grid_map holds the cells occupied by the layout, and walkable those inside the floor outline which are
+        not occupied, which are the cells the paths and positions on the floor may go through.
 
         Args:
             affine_layout (_type_): _description_
             cell_size (float): Size of the grid cells in meters
+            method (str, optional): Either "scanline", which fills the rows of the grid from the polygon edges
+            they cross, or "pointwise", which tests the cell centres one by one. Both of them build the same grid.
+            Defaults to "scanline".
+            outline (Polygon, optional): Outline of the floor, transformed as affine_layout. None takes every cell
+            which is not occupied as walkable, including those outside the building. Defaults to None.
+
+        Raises:
+            ValueError: When a not valid method is input
         """
+        if method not in ["scanline", "pointwise"]:
+            raise ValueError(
+                "{} is not a valid grid population method.".format(method))
 
         self.layout = affine_layout
         self.layout_width = self.layout.bounds[2]
         self.layout_height = self.layout.bounds[3]
         self.cell_size = cell_size
+        self.has_outline = outline is not None
+        # Hashes of the files the grid was built from, see floor_grid_map
+        self.source_hashes = {}
         bounds = (self.layout).bounds
         self.grid_map = np.zeros((int(np.ceil(bounds[2]/self.cell_size)),
-                                  int(np.ceil(bounds[3]/self.cell_size))), dtype=np.bool)
-        self._populate_grid()
+                                  int(np.ceil(bounds[3]/self.cell_size))), dtype=bool)
+        with instrumentation.stage("grid", cells=self.grid_map.size, method=method):
+            rasterize = self._rasterize if method == "scanline" else self._rasterize_pointwise
+            self.grid_map[:] = rasterize(self.layout)
+            self.walkable = ~self.grid_map
+            if outline is not None:
+                self.walkable &= rasterize(outline)
+        self._compute_layers()
+
+    def _compute_layers(self):
+        """Precomputes the layers derived from walkable
+
+        distance_map is the euclidean distance in meters from the centre of each walkable cell to the centre of
+        the nearest cell which is not (0 in those, inf when there are none), and labels the connected component
+        of each walkable cell, 4-connected and numbered from 1 (0 in the other cells).
+        """
+        from scipy import ndimage
+
+        walkable = np.asarray(self.walkable)
+        if walkable.all():
+            self.distance_map = np.full(walkable.shape, np.inf, dtype=np.float32)
+        else:
+            self.distance_map = (ndimage.distance_transform_edt(walkable) * self.cell_size).astype(np.float32)
+        self.labels = ndimage.label(walkable)[0].astype(np.int32)
+
+    def _rasterize(self, geometry):
+        """Cells of the grid whose centre is in a geometry, by scanline polygon filling along the rows of the grid
+
+        The polygon edges crossed by each row of cell centres toggle the cells after each crossing (even-odd
+        rule). The cells next to a crossing, and the whole rows running along a vertex, are then tested against
+        the geometry as in the pointwise method, so that the boundary cells are the same.
+
+        Args:
+            geometry (Polygon): Shapely (Multi)Polygon in the frame of the grid
+
+        Returns:
+            np.array: Boolean mask of the cells in the geometry
+        """
+        # Same cell centres as _idx_to_coords
+        x_coords = (np.arange(self.grid_map.shape[0]) + 0.5) * self.cell_size
+        y_coords = (np.arange(self.grid_map.shape[1]) + 0.5) * self.cell_size
+        n_rows, n_cols = self.grid_map.shape
+        mask = np.zeros(self.grid_map.shape, dtype=bool)
+
+        edges = self._geometry_edges(geometry)
+        if edges is None or not n_rows or not n_cols:
+            self._populate_cells(geometry, x_coords, y_coords, np.ones(mask.shape, dtype=bool), mask)
+            return mask
+        x0, y0, x1, y1 = edges
+
+        # Rows whose centre x is in [min(x0, x1), max(x0, x1)) of each edge
+        first_row = np.searchsorted(x_coords, np.minimum(x0, x1), side="left")
+        last_row = np.searchsorted(x_coords, np.maximum(x0, x1), side="left")
+        n_crossings = last_row - first_row
+        edge_ix = np.repeat(np.arange(x0.shape[0]), n_crossings)
+        rows = np.arange(n_crossings.sum()) - np.repeat(np.cumsum(n_crossings) - n_crossings, n_crossings) + \
+            np.repeat(first_row, n_crossings)
+
+        crossing_y = y0[edge_ix] + (x_coords[rows] - x0[edge_ix]) * \
+            (y1[edge_ix] - y0[edge_ix]) / (x1[edge_ix] - x0[edge_ix])
+        cols = np.searchsorted(y_coords, crossing_y, side="left")
+
+        # Even-odd filling, the uint8 cumulative sum keeps the parity even when it overflows
+        toggles = np.bincount(rows * (n_cols + 1) + cols, minlength=n_rows * (n_cols + 1)) & 1
+        mask[:] = (np.cumsum(toggles.astype(np.uint8).reshape(n_rows, n_cols + 1), axis=1,
+                             dtype=np.uint8)[:, :n_cols] & 1).astype(bool)
 
-    def _populate_grid(self):
-        it = np.nditer(self.grid_map, flags=["multi_index"])
-        import copy
-        self.helper_grid = copy.deepcopy(self.grid_map)
+        uncertain = np.zeros(mask.shape, dtype=bool)
+        uncertain[rows, np.clip(cols - 1, 0, n_cols - 1)] = True
+        uncertain[rows, np.clip(cols, 0, n_cols - 1)] = True
+        vertex_rows = np.minimum(np.searchsorted(x_coords, x0), n_rows - 1)
+        uncertain[vertex_rows[x_coords[vertex_rows] == x0]] = True
+        self._populate_cells(geometry, x_coords, y_coords, uncertain, mask)
+        return mask
+
+    @staticmethod
+    def _geometry_edges(geometry):
+        """Edges (x0, y0, x1, y1) of the rings of a geometry, None when it is not a (multi)polygon"""
+        if geometry.geom_type == "Polygon":
+            polygons = [geometry]
+        elif geometry.geom_type == "MultiPolygon":
+            polygons = list(geometry.geoms)
+        else:
+            return None
+
+        rings = [np.asarray(ring.coords, dtype="float64")[:, :2]
+                 for polygon in polygons for ring in [polygon.exterior] + list(polygon.interiors)]
+        starts = np.concatenate([ring[:-1] for ring in rings] + [np.empty((0, 2))])
+        ends = np.concatenate([ring[1:] for ring in rings] + [np.empty((0, 2))])
+        return starts[:, 0], starts[:, 1], ends[:, 0], ends[:, 1]
+
+    @staticmethod
+    def _populate_cells(geometry, x_coords, y_coords, cells, mask):
+        """Tests the centres of the selected cells against a geometry
+
+        Args:
+            geometry (Polygon): Shapely geometry in the frame of the grid
+            x_coords (np.array): Centre of each row of the grid in meters
+            y_coords (np.array): Centre of each column of the grid in meters
+            cells (np.array): Boolean mask of the cells to be tested
+            mask (np.array): Boolean mask of the cells in the geometry, set for the tested cells
+        """
+        rows, cols = np.nonzero(cells)
+        mask[rows, cols] = contains_xy(geometry, x_coords[rows], y_coords[cols])
+
+    def _rasterize_pointwise(self, geometry):
+        mask = np.zeros(self.grid_map.shape, dtype=bool)
+        it = np.nditer(mask, flags=["multi_index"])
         for _ in it:
             idx_in_coords = self._idx_to_coords(it.multi_index)
-            self.grid_map[it.multi_index] = self.layout.contains(Point(idx_in_coords))
+            mask[it.multi_index] = geometry.contains(Point(idx_in_coords))
+        return mask
 
     def _idx_to_coords(self, idx_point):
         """Converts the index values to meter coordinates in the respective grid map
 
         Args:
-            idx_point (tuple(int, int)): _description_
+            idx_point (tuple(int, int) or np.array): Index of a cell, or (N, 2) array of indices
 
         Returns:
-            tuple(float, float): Meter coordinates in the grid map
+            tuple(float, float) or np.array: Meter coordinates in the grid map, an (N, 2) array for arrays of indices
         """
 
         #  0.5 must be added to the ix so it considers the middle of the grid square instead of a corner
+        if isinstance(idx_point, np.ndarray) and idx_point.ndim == 2:
+            return (idx_point + 0.5) * self.cell_size
         coords = tuple([(ix+0.5)*self.cell_size for ix in idx_point])
         return coords
 
@@ -49,18 +180,249 @@ class OccupancyGridMap:
         """Converts coords from meters to the idx in the respective grid map
 
         Args:
-            coords (tuple(float, float)): Coords in meters
+            coords (tuple(float, float) or np.array): Coords in meters, or (N, 2) array of coords
 
         Returns:
-            tuple(int, int): Index in the grid closest to that of the input coordinates
+            tuple(int, int) or np.array: Index in the grid closest to that of the input coordinates, an (N, 2) int64
+            array for arrays of coords
         """
-        np_idx = np.round(coords/self.cell_size - 0.5)
+        np_idx = np.round(np.asarray(coords)/self.cell_size - 0.5)
+        if np_idx.ndim == 2:
+            return np_idx.astype(np.int64)
         idx = tuple(np_idx)
         return idx
 
+    def is_free(self, coords):
+        """Vectorized lookup of whether points lie in free cells, i.e. in walkable cells of the grid
+
+        Args:
+            coords (np.array): (N, 2) array of coords in meters
+
+        Returns:
+            np.array: Boolean mask of the points in free cells
+        """
+        return self._lookup(self.walkable, coords, False)
+
+    def _lookup(self, layer, coords, outside):
+        """Values of a (n_rows, n_cols) layer at an (N, 2) array of coords, outside for the points out of the grid"""
+        idx = self._coords_to_idx(np.asarray(coords, dtype="float64").reshape(-1, 2))
+        inside = (idx >= 0).all(axis=1) & (idx[:, 0] < self.grid_map.shape[0]) & \
+            (idx[:, 1] < self.grid_map.shape[1])
+        values = np.full(idx.shape[0], outside, dtype=layer.dtype)
+        values[inside] = layer[idx[inside, 0], idx[inside, 1]]
+        return values
+
+    def obstacle_distance(self, coords):
+        """Vectorized lookup of the distance to the nearest occupied cell, from distance_map
+
+        Args:
+            coords (np.array): (N, 2) array of coords in meters
+
+        Returns:
+            np.array: Distance in meters of each point, 0 for the points out of the grid
+        """
+        return self._lookup(self.distance_map, coords, 0)
+
+    def component(self, coords):
+        """Vectorized lookup of the connected component of points, from labels
+
+        Args:
+            coords (np.array): (N, 2) array of coords in meters
+
+        Returns:
+            np.array: Component label of each point, 0 for the points in cells which are not walkable or out of
+            the grid
+        """
+        return self._lookup(self.labels, coords, 0)
+
+    def reachable(self, starts, ends):
+        """Whether free paths through the grid join pairs of points, i.e. whether they are in the same component
+
+        Args:
+            starts (np.array): (N, 2) array of start coords in meters
+            ends (np.array): (N, 2) array of end coords in meters
+
+        Returns:
+            np.array: Boolean mask of the pairs of points joined by a free path
+        """
+        start_labels = self.component(starts)
+        return (start_labels > 0) & (start_labels == self.component(ends))
+
+    def segment_cells(self, starts, ends):
+        """Cells traversed by straight segments, by a DDA (Amanatides-Woo) traversal of every segment at once
+
+        Each crossing of a row or column boundary by a segment is an event at its parameter t along the segment.
+        The events of each axis are already sorted by (segment, t), so merging them by searchsorted and
+        accumulating their steps gives the cells of every segment in traversal order. A segment through a cell
+        corner steps into one of the two side cells.
+
+        Args:
+            starts (np.array): (N, 2) array of start coords in meters
+            ends (np.array): (N, 2) array of end coords in meters
+
+        Returns:
+            (np.array, np.array): Segment of each traversed cell, and the (M, 2) indices of the cells, which may
+            be out of the grid
+        """
+        starts = np.asarray(starts, dtype="float64").reshape(-1, 2) / self.cell_size
+        ends = np.asarray(ends, dtype="float64").reshape(-1, 2) / self.cell_size
+        n_segments = starts.shape[0]
+
+        first_cells, directions, n_steps, event_segment, event_key = [], [], [], [], []
+        for axis in range(2):
+            start, end = starts[:, axis], ends[:, axis]
+            first_cell = np.floor(start).astype(np.int64)
+            direction = np.sign(np.floor(end).astype(np.int64) - first_cell)
+            n_axis_steps = np.abs(np.floor(end).astype(np.int64) - first_cell)
+            segment = np.repeat(np.arange(n_segments), n_axis_steps)
+            k = np.arange(segment.shape[0]) - np.repeat(np.cumsum(n_axis_steps) - n_axis_steps, n_axis_steps)
+            # Boundary crossed by the k-th step, the cell boundaries being at integer cell units
+            boundary = first_cell[segment] + np.where(direction[segment] > 0, k + 1, -k)
+            t = (boundary - start[segment]) / (end[segment] - start[segment])
+            first_cells.append(first_cell)
+            directions.append(direction)
+            n_steps.append(n_axis_steps)
+            event_segment.append(segment)
+            # t is in [0, 1], so the keys increase along the events of the axis
+            event_key.append(segment * 2 + t)
+
+        # Position of each event in the merged events, after the first cell of its segment and of every
+        # previous segment, and after the events of the other axis before it (the row steps first on ties)
+        positions = [np.arange(event_key[0].shape[0]) + np.searchsorted(event_key[1], event_key[0], side="left"),
+                     np.arange(event_key[1].shape[0]) + np.searchsorted(event_key[0], event_key[1], side="right")]
+        segment_start = np.concatenate([[0], np.cumsum(n_steps[0] + n_steps[1] + 1)])
+        segment = np.repeat(np.arange(n_segments), np.diff(segment_start))
+
+        cells = np.empty((segment_start[-1], 2), dtype=np.int64)
+        for axis in range(2):
+            # Cumulative steps of the axis, restarted at the first cell of each segment
+            steps = np.zeros(segment_start[-1], dtype=np.int64)
+            steps[segment_start[:-1]] = first_cells[axis] - np.concatenate([[0], first_cells[axis][:-1] +
+                                                                            directions[axis][:-1] * n_steps[axis][:-1]])
+            steps[positions[axis] + event_segment[axis] + 1] = directions[axis][event_segment[axis]]
+            cells[:, axis] = np.cumsum(steps)
+        return segment, cells
+
+    def crosses_obstacle(self, starts, ends):
+        """Whether straight moves between pairs of points cross a non-walkable cell (occupied, out of the floor
+        outline or out of the grid)
+
+        Args:
+            starts (np.array): (N, 2) array of start coords in meters
+            ends (np.array): (N, 2) array of end coords in meters
+
+        Returns:
+            np.array: Boolean mask of the moves crossing a non-walkable cell, including their start and end cells
+        """
+        segment, cells = self.segment_cells(starts, ends)
+        n_rows, n_cols = self.grid_map.shape
+        rows, cols = cells[:, 0], cells[:, 1]
+        inside = (rows >= 0) & (rows < n_rows) & (cols >= 0) & (cols < n_cols)
+        blocked = ~inside | ~self.walkable[np.clip(rows, 0, n_rows - 1), np.clip(cols, 0, n_cols - 1)]
+        return np.bincount(segment[blocked], minlength=np.shape(starts)[0]) > 0
+
+    def save(self, grid_file, source_hashes=None):
+        """Saves the grid as a uint8 .npy file along with a .json header of the grid
+
+        Args:
+            grid_file (str): Path of the grid without extension, ".npy" and ".json" are appended to it
+            source_hashes (dict, optional): Hashes of the files the grid was built from, kept in the header.
+            Defaults to None.
+        """
+        grid_file = Path(grid_file)
+        grid_file.parent.mkdir(parents=True, exist_ok=True)
+        header = {"cell_size": self.cell_size, "shape": list(self.grid_map.shape),
+                  "layout_width": self.layout_width, "layout_height": self.layout_height,
+                  "has_outline": self.has_outline, "source_hashes": source_hashes or {}}
+
+        # The files are written under temporary names and renamed, the header last, so that a grid is only
+        # loaded once it is complete
+        for extension, write in [(".npy", lambda f: np.save(f, self.grid_map.astype(np.uint8))),
+                                 (".walkable.npy", lambda f: np.save(f, self.walkable.astype(np.uint8))),
+                                 (".distance.npy", lambda f: np.save(f, self.distance_map)),
+                                 (".labels.npy", lambda f: np.save(f, self.labels)),
+                                 (".json", lambda f: f.write(json.dumps(header).encode("utf-8")))]:
+            tmp_file = grid_file.with_name(grid_file.name + extension + ".tmp{}".format(os.getpid()))
+            with open(tmp_file, "wb") as f:
+                write(f)
+            os.replace(tmp_file, grid_file.with_name(grid_file.name + extension))
+
+    @classmethod
+    def load(cls, grid_file):
+        """Loads a grid saved with save, its grid_map and layers are read-only memory maps shared by every process
+        loading it. The layers of grids saved without them are computed, and the grids saved without walkable
+        take every cell which is not occupied as walkable.
+
+        Args:
+            grid_file (str): Path of the grid without extension
+
+        Returns:
+            OccupancyGridMap: Loaded grid, without layout
+        """
+        grid_file = Path(grid_file)
+        with open(grid_file.with_name(grid_file.name + ".json")) as f:
+            header = json.load(f)
+
+        grid = cls.__new__(cls)
+        grid.layout = None
+        grid.layout_width = header["layout_width"]
+        grid.layout_height = header["layout_height"]
+        grid.cell_size = header["cell_size"]
+        grid.source_hashes = header["source_hashes"]
+        grid.grid_map = np.load(grid_file.with_name(grid_file.name + ".npy"), mmap_mode="r").view(bool)
+        walkable_file = grid_file.with_name(grid_file.name + ".walkable.npy")
+        grid.has_outline = header.get("has_outline", False) and walkable_file.exists()
+        grid.walkable = np.load(walkable_file, mmap_mode="r").view(bool) if walkable_file.exists() else \
+            ~grid.grid_map
+        layer_files = [grid_file.with_name(grid_file.name + extension) for extension in [".distance.npy", ".labels.npy"]]
+        if walkable_file.exists() and all(layer_file.exists() for layer_file in layer_files):
+            grid.distance_map, grid.labels = (np.load(layer_file, mmap_mode="r") for layer_file in layer_files)
+        else:
+            grid._compute_layers()
+        return grid
+
     def plot_grid_map(self, alpha=1, min_val=0, origin='lower'):
         """
         Plot the respective grid map
         """
+        import matplotlib.pyplot as plt
+
         plt.imshow(self.grid_map, vmin=min_val, vmax=1, origin=origin, interpolation='none', alpha=alpha)
         plt.draw()
+
+
+def floor_grid_map(floorplan, cell_size, grid_dir):
+    """Occupancy grid of a floor, whose cells out of the floor outline are not walkable, loaded from grid_dir
+    unless its geojson, floor info or cell size changed
+
+    Args:
+        floorplan (dict): Dict of the floorplan, as returned by data_parser.floorplan
+        cell_size (float): Size of the grid cells in meters
+        grid_dir (str): Folder where the grids are saved
+
+    Returns:
+        OccupancyGridMap: Occupancy grid of the floor
+    """
+    geojson_file = Path(floorplan["floor_geojson"])
+    source_hashes = {}
+    for source_file in [geojson_file, geojson_file.parent / "floor_info.json"]:
+        with open(source_file, "rb") as f:
+            source_hashes[source_file.name] = hashlib.sha1(f.read()).hexdigest()
+
+    # The grid of a floor and cell size is overwritten when its source files change
+    floor_key = hashlib.sha1(json.dumps([str(geojson_file.resolve()), cell_size]).encode("utf-8")).hexdigest()[:16]
+    grid_file = Path(grid_dir) / "{}_{}_{}".format(geojson_file.parent.parent.name, geojson_file.parent.name, floor_key)
+
+    if grid_file.with_name(grid_file.name + ".json").exists():
+        grid = OccupancyGridMap.load(grid_file)
+        # The grids saved before the floor outline was rasterized are built again
+        if grid.source_hashes == source_hashes and grid.cell_size == cell_size and grid.has_outline:
+            return grid
+
+    geometry = extract_geometries(str(geojson_file))
+    layout = transform(geometry, floorplan)
+    outline = transform(extract_outline(str(geojson_file)), floorplan, bounds=geometry.bounds)
+    grid = OccupancyGridMap(layout, cell_size, outline=outline)
+    grid.save(grid_file, source_hashes)
+    grid.source_hashes = source_hashes
+    return grid
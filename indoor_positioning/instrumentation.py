@@ -0,0 +1,294 @@
+"""Per-stage and per-trace timing and memory instrumentation of the pipeline
+
+The stages of the pipeline (parse, filter_design, filter, waypoints, geometry, grid, html) are decorated with
+instrumented, and the traces processed by a flow are wrapped in trace(trace_id). Nothing is recorded until
+enable is called: a disabled stage is a single check before calling the function. The recorder is shared by the
+threads of the process, each thread keeping its own stack of open stages and trace id.
+
+Example:
+    aggregator = instrumentation.Aggregator()
+    instrumentation.enable(instrumentation.JsonLinesSink("stages.jsonl"), aggregator, memory=True)
+    with instrumentation.trace("5d045f7e9b7f0900080da84e"):
+        data_parser.tracing_parser(trace_filename)
+    print(aggregator.table())
+"""
+from contextlib import contextmanager
+from functools import wraps
+from pathlib import Path
+
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+
+# Recorder of the process, set by enable
+_recorder = None
+
+
+class _State(threading.local):
+    """Open stages and trace id of a thread"""
+
+    def __init__(self):
+        self.stack = []
+        self.trace_id = None
+
+
+_state = _State()
+
+
+class JsonLinesSink:
+    """Appends each record as a JSON line to a file, which several processes can share"""
+
+    def __init__(self, filename):
+        """
+        Args:
+            filename (str): Path of the JSON-lines file
+        """
+        Path(filename).parent.mkdir(parents=True, exist_ok=True)
+        self.file = open(filename, "a", buffering=1)
+
+    def emit(self, record):
+        self.file.write(json.dumps(record) + "\n")
+
+    def close(self):
+        self.file.close()
+
+
+class Aggregator:
+    """Aggregates the records in process, by stage: count, total wall and CPU time, bytes and rows"""
+
+    def __init__(self):
+        self.stages = {}
+
+    def emit(self, record):
+        totals = self.stages.setdefault(record["stage"], {"count": 0, "wall_s": 0.0, "cpu_s": 0.0,
+                                                          "bytes_read": 0, "peak_bytes": 0, "rows": {}})
+        totals["count"] += 1
+        totals["wall_s"] += record["wall_s"]
+        totals["cpu_s"] += record["cpu_s"]
+        totals["bytes_read"] += record.get("bytes_read", 0)
+        totals["peak_bytes"] = max(totals["peak_bytes"], record.get("peak_bytes", 0))
+        for record_type, n_rows in record.get("rows", {}).items():
+            totals["rows"][record_type] = totals["rows"].get(record_type, 0) + n_rows
+
+    def close(self):
+        pass
+
+    def table(self):
+        """Text table of the totals of each stage, sorted by wall time
+
+        Returns:
+            str: The table
+        """
+        lines = ["{:<16} {:>7} {:>10} {:>10} {:>12} {:>12}".format("stage", "count", "wall s", "cpu s", "MiB read",
+                                                                  "peak MiB")]
+        for stage_name, totals in sorted(self.stages.items(), key=lambda item: -item[1]["wall_s"]):
+            lines.append("{:<16} {:>7} {:>10.3f} {:>10.3f} {:>12.1f} {:>12.1f}".format(
+                stage_name, totals["count"], totals["wall_s"], totals["cpu_s"], totals["bytes_read"] / 2 ** 20,
+                totals["peak_bytes"] / 2 ** 20))
+        return "\n".join(lines)
+
+
+class _Recorder:
+    def __init__(self, sinks, memory, profile_trace, profile_dir):
+        self.sinks = sinks
+        self.memory = memory
+        self.profile_trace = profile_trace
+        self.profile_dir = profile_dir
+        # The sinks are shared by the threads
+        self.lock = threading.Lock()
+        self.started_tracemalloc = memory and not tracemalloc.is_tracing()
+        if self.started_tracemalloc:
+            tracemalloc.start()
+
+    def emit(self, record):
+        with self.lock:
+            for sink in self.sinks:
+                sink.emit(record)
+
+
+class _Stage:
+    """Open stage, whose extra fields can be added with add"""
+
+    def __init__(self, recorder, name, fields):
+        self.recorder = recorder
+        self.record = dict(fields, stage=name)
+        self.peak = 0
+
+    def add(self, **fields):
+        self.record.update(fields)
+
+    def __enter__(self):
+        stack = _state.stack
+        self.record["trace"] = _state.trace_id
+        self.record["parent"] = stack[-1].record["stage"] if stack else None
+        if self.recorder.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                stack[-1].peak = max(stack[-1].peak, peak)
+            tracemalloc.reset_peak()
+            self.start_memory = current
+        stack.append(self)
+        self.start_cpu = time.process_time()
+        self.start_wall = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall = time.perf_counter() - self.start_wall
+        cpu = time.process_time() - self.start_cpu
+        stack = _state.stack
+        stack.pop()
+        self.record.update(wall_s=wall, cpu_s=cpu)
+        if self.recorder.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            self.peak = max(self.peak, peak)
+            self.record.update(allocated_bytes=current - self.start_memory, peak_bytes=self.peak - self.start_memory)
+            if stack:
+                stack[-1].peak = max(stack[-1].peak, self.peak)
+        if exc_type is not None:
+            self.record["error"] = exc_type.__name__
+        self.recorder.emit(self.record)
+        return False
+
+
+class _NullStage:
+    def add(self, **fields):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+def enable(*sinks, memory=False, profile_trace=None, profile_dir="./output/profiles/"):
+    """Starts recording the stages of this process into sinks
+
+    Args:
+        *sinks: Objects with emit(record) and close() methods, e.g. JsonLinesSink or Aggregator
+        memory (bool, optional): Whether to record the memory allocated by each stage with tracemalloc,
+        which slows the allocations down. tracemalloc traces the whole process, so the stages of concurrent
+        threads count each other's allocations. Defaults to False.
+        profile_trace (str, optional): Trace id whose trace context is captured with cProfile and tracemalloc.
+        Defaults to None.
+        profile_dir (str, optional): Folder of the <trace id>.prof and <trace id>.tracemalloc.txt captures.
+        Defaults to "./output/profiles/".
+    """
+    global _recorder
+    disable()
+    _recorder = _Recorder(list(sinks), memory, profile_trace, profile_dir)
+
+
+def disable():
+    """Stops recording, and closes the sinks"""
+    global _recorder
+    recorder = _recorder
+    if recorder is None:
+        return
+    _recorder = None
+    if recorder.started_tracemalloc:
+        tracemalloc.stop()
+    for sink in recorder.sinks:
+        sink.close()
+
+
+def is_enabled():
+    return _recorder is not None
+
+
+def stage(name, **fields):
+    """Context manager recording a stage, a shared no-op one when recording is disabled
+
+    Args:
+        name (str): Name of the stage
+        **fields: Extra fields of the record, more can be added with the add method of the stage
+
+    Returns:
+        Context manager of the stage
+    """
+    recorder = _recorder
+    if recorder is None:
+        return _NULL_STAGE
+    return _Stage(recorder, name, fields)
+
+
+def instrumented(name, fields=None):
+    """Decorator recording each call of a function as a stage
+
+    Args:
+        name (str): Name of the stage
+        fields (function, optional): Function of (result, *args, **kwargs) returning extra fields of the
+        record, only called when recording is enabled. Defaults to None.
+
+    Returns:
+        Decorator
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            recorder = _recorder
+            if recorder is None:
+                return function(*args, **kwargs)
+            with _Stage(recorder, name, {}) as current:
+                result = function(*args, **kwargs)
+                if fields is not None:
+                    current.add(**fields(result, *args, **kwargs))
+            return result
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def trace(trace_id):
+    """Context of the stages of a trace, which are recorded with its id and inside a "trace" stage
+
+    When recording is enabled with profile_trace=trace_id, the context is also captured with cProfile and
+    tracemalloc.
+
+    Args:
+        trace_id (str): Id of the trace
+    """
+    recorder = _recorder
+    if recorder is None:
+        yield
+        return
+
+    previous_trace_id, _state.trace_id = _state.trace_id, trace_id
+    profiler = None
+    started_tracemalloc = False
+    if recorder.profile_trace == trace_id:
+        import cProfile
+
+        profiler = cProfile.Profile()
+        started_tracemalloc = not tracemalloc.is_tracing()
+        if started_tracemalloc:
+            tracemalloc.start(25)
+        profiler.enable()
+    try:
+        with _Stage(recorder, "trace", {}):
+            yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            _write_profile(recorder.profile_dir, trace_id, profiler)
+            if started_tracemalloc:
+                tracemalloc.stop()
+        _state.trace_id = previous_trace_id
+
+
+def _write_profile(profile_dir, trace_id, profiler):
+    import cProfile
+
+    Path(profile_dir).mkdir(parents=True, exist_ok=True)
+    profiler.dump_stats(os.path.join(profile_dir, "{}.prof".format(trace_id)))
+    with open(os.path.join(profile_dir, "{}.tracemalloc.txt".format(trace_id)), "w") as f:
+        # The allocations of the profiler itself are left out
+        snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, cProfile.__file__)])
+        for statistic in snapshot.statistics("lineno")[:50]:
+            f.write(str(statistic) + "\n")
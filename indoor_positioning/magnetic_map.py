@@ -0,0 +1,211 @@
+from indoor_positioning import data_parser, data_processing
+from indoor_positioning.fingerprint import label_scans
+from pathlib import Path
+
+import glob
+import json
+import os
+import numpy as np
+
+
+# Maximum number of (hypothesis, sample) lookups of MagneticMap.match held in memory at once
+MATCH_CHUNK_SIZE = 1 << 20
+
+
+class MagneticMap:
+    """Per-floor geomagnetic map: running mean and variance of the magnetometer magnitude in each grid cell
+
+    The cells are those of the OccupancyGridMap of the floor. Samples are positioned by interpolating between
+    the waypoints of their trace, and each batch of samples is merged into the count, mean and sum of squared
+    deviations (M2) of its cells with the parallel form of Welford's algorithm. The memory is only that of the
+    three grids, whatever the number of traces streamed through the map.
+    """
+
+    def __init__(self, grid):
+        """
+        Args:
+            grid (OccupancyGridMap): Occupancy grid of the floor, whose cells are those of the map
+        """
+        self.cell_size = grid.cell_size
+        self.shape = tuple(grid.grid_map.shape)
+        self.count = np.zeros(self.shape, dtype=np.int64)
+        self.mean = np.zeros(self.shape)
+        self.m2 = np.zeros(self.shape)
+        self.traces = []
+        self._grid = grid
+
+    @property
+    def variance(self):
+        """Sample variance of each cell, NaN for the cells with less than 2 samples"""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(self.count > 1, self.m2 / (self.count - 1), np.nan)
+
+    def add_samples(self, xy, values):
+        """Merges a batch of positioned samples into the map, the samples out of the grid are dropped
+
+        Args:
+            xy (np.array): (N, 2) coords of the samples in meters
+            values (np.array): Magnitude of each sample
+        """
+        idx = self._grid._coords_to_idx(np.asarray(xy, dtype="float64").reshape(-1, 2))
+        values = np.asarray(values, dtype="float64")
+        inside = (idx >= 0).all(axis=1) & (idx[:, 0] < self.shape[0]) & (idx[:, 1] < self.shape[1])
+        cells = np.ravel_multi_index((idx[inside, 0], idx[inside, 1]), self.shape)
+        values = values[inside]
+
+        # Statistics of the batch in each of its cells
+        batch_cells, cell_ix = np.unique(cells, return_inverse=True)
+        cell_ix = cell_ix.reshape(-1)
+        batch_count = np.bincount(cell_ix).astype("float64")
+        batch_mean = np.bincount(cell_ix, weights=values) / batch_count
+        batch_m2 = np.bincount(cell_ix, weights=(values - batch_mean[cell_ix]) ** 2)
+
+        # Chan et al. merge of the batch statistics into those of the map
+        count, mean, m2 = self.count.reshape(-1), self.mean.reshape(-1), self.m2.reshape(-1)
+        old_count = count[batch_cells].astype("float64")
+        total = old_count + batch_count
+        delta = batch_mean - mean[batch_cells]
+        mean[batch_cells] += delta * batch_count / total
+        m2[batch_cells] += batch_m2 + delta ** 2 * old_count * batch_count / total
+        count[batch_cells] += batch_count.astype(np.int64)
+
+    def add_trace(self, trace_data, calibrated=True):
+        """Adds the magnetometer samples of a trace within the time range of its waypoints, traces already
+        in the map are skipped
+
+        Args:
+            trace_data (TraceData): Parsed trace with magnetometer and waypoint records
+            calibrated (bool, optional): Whether to use the calibrated magnetometer. Defaults to True.
+
+        Returns:
+            int: Number of samples added
+        """
+        trace_id = Path(trace_data.file_name).stem
+        if trace_id in self.traces:
+            return 0
+
+        mag = data_processing.mag_df(trace_data, calibrated=calibrated)
+        labelled, xy = label_scans(mag["tss"].to_numpy(), trace_data.waypoint)
+        self.add_samples(xy, mag["mag_magnitude"].to_numpy()[labelled])
+        self.traces.append(trace_id)
+        return xy.shape[0]
+
+    def match(self, values, offsets, candidates=None, rotations=(0.0,), noise=1.0, min_overlap=0.5, top_k=10):
+        """Start positions and rotations whose map values best match a sequence of magnitudes along a relative
+        path, e.g. the magnitudes at the steps of a PDR track and the positions of the steps from its start
+
+        The cost of a hypothesis is the mean of (value - mean) ** 2 / (variance + noise ** 2) over the samples
+        of the sequence falling into cells of the map with data. All the hypotheses are evaluated at once,
+        as a (hypotheses, samples) lookup into the mean and variance grids.
+
+        Args:
+            values (np.array): (L,) magnitudes of the sequence
+            offsets (np.array): (L, 2) positions of the samples relative to the start of the sequence in meters
+            candidates (np.array, optional): (C, 2) candidate start positions, None uses the centres of every
+            cell with data. Defaults to None.
+            rotations (tuple(float), optional): Rotations of the offsets in radians, counter-clockwise, which are
+            tried for each candidate. Defaults to (0.0,).
+            noise (float, optional): Standard deviation of the magnitude readings in uT. Defaults to 1.0.
+            min_overlap (float, optional): Minimum fraction of the sequence in cells with data. Defaults to 0.5.
+            top_k (int, optional): Number of hypotheses returned. Defaults to 10.
+
+        Returns:
+            (np.array, np.array, np.array): (k, 2) start positions and rotations of the best hypotheses, sorted
+            by their costs, also returned
+        """
+        values = np.asarray(values, dtype="float64")
+        offsets = np.asarray(offsets, dtype="float64").reshape(-1, 2)
+        if candidates is None:
+            candidates = self._grid._idx_to_coords(np.argwhere(self.count > 0))
+        candidates = np.asarray(candidates, dtype="float64").reshape(-1, 2)
+        rotations = np.asarray(rotations, dtype="float64").reshape(-1)
+
+        # Offsets of every rotation, (R, L, 2)
+        cos, sin = np.cos(rotations)[:, None], np.sin(rotations)[:, None]
+        rotated = np.stack([cos * offsets[:, 0] - sin * offsets[:, 1], sin * offsets[:, 0] + cos * offsets[:, 1]],
+                           axis=-1)
+        count, mean = self.count.reshape(-1), self.mean.reshape(-1)
+        variance = np.nan_to_num(self.variance.reshape(-1), nan=0.0)
+
+        # The hypotheses are evaluated by chunks of candidates, so that the lookups stay bounded in memory
+        costs = np.empty(candidates.shape[0] * rotations.shape[0])
+        chunk = max(MATCH_CHUNK_SIZE // max(rotations.shape[0] * offsets.shape[0], 1), 1)
+        for start in range(0, candidates.shape[0], chunk):
+            # Sample positions of every hypothesis of the chunk, (chunk * R, L, 2)
+            positions = (candidates[start:start + chunk, None, None, :] + rotated[None]).reshape(
+                -1, offsets.shape[0], 2)
+            idx = self._grid._coords_to_idx(positions.reshape(-1, 2))
+            inside = (idx >= 0).all(axis=1) & (idx[:, 0] < self.shape[0]) & (idx[:, 1] < self.shape[1])
+            cells = np.ravel_multi_index((np.clip(idx[:, 0], 0, self.shape[0] - 1),
+                                          np.clip(idx[:, 1], 0, self.shape[1] - 1)), self.shape)
+            cells = cells.reshape(positions.shape[:2])
+            known = inside.reshape(positions.shape[:2]) & (count[cells] > 0)
+
+            errors = np.where(known, (values - mean[cells]) ** 2 / (variance[cells] + noise ** 2), 0)
+            overlap = known.sum(axis=1)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                costs[start * rotations.shape[0]:(start + chunk) * rotations.shape[0]] = np.where(
+                    overlap >= min_overlap * offsets.shape[0], errors.sum(axis=1) / overlap, np.inf)
+
+        best = np.argsort(costs, kind="stable")[:top_k]
+        best = best[np.isfinite(costs[best])]
+        return candidates[best // rotations.shape[0]], rotations[best % rotations.shape[0]], costs[best]
+
+    def save(self, map_file):
+        """Saves the map as an .npz file
+
+        Args:
+            map_file (str): Path of the .npz file
+        """
+        map_file = Path(map_file)
+        map_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = map_file.with_name(map_file.name + ".tmp{}".format(os.getpid()))
+        with open(tmp_file, "wb") as f:
+            np.savez(f, count=self.count, mean=self.mean, m2=self.m2, cell_size=self.cell_size,
+                     traces=np.array(json.dumps(self.traces)))
+        os.replace(tmp_file, map_file)
+
+    @classmethod
+    def load(cls, map_file, grid):
+        """Loads a map saved with save
+
+        Args:
+            map_file (str): Path of the .npz file
+            grid (OccupancyGridMap): Occupancy grid of the floor the map was built on
+
+        Raises:
+            ValueError: When the map was not built on the cells of the grid
+
+        Returns:
+            MagneticMap: Loaded map
+        """
+        magnetic_map = cls(grid)
+        with np.load(map_file, allow_pickle=False) as saved:
+            if saved["count"].shape != magnetic_map.shape or float(saved["cell_size"]) != grid.cell_size:
+                raise ValueError(
+                    "{} is not a valid map for the grid.".format(map_file))
+            magnetic_map.count = saved["count"]
+            magnetic_map.mean = saved["mean"]
+            magnetic_map.m2 = saved["m2"]
+            magnetic_map.traces = json.loads(str(saved["traces"]))
+        return magnetic_map
+
+
+def build_floor_map(map_folder, grid, map_file):
+    """Brings the magnetic map of a floor up to date with its tracing files, one trace in memory at a time
+
+    Args:
+        map_folder (str): DIR of the map
+        grid (OccupancyGridMap): Occupancy grid of the floor
+        map_file (str): Path of the .npz file of the map
+
+    Returns:
+        MagneticMap: Map with the samples of every trace of the floor
+    """
+    magnetic_map = MagneticMap.load(map_file, grid) if Path(map_file).exists() else MagneticMap(grid)
+    for trace_filename in sorted(glob.glob(map_folder + "/*.txt", recursive=True)):
+        if Path(trace_filename).stem not in magnetic_map.traces:
+            magnetic_map.add_trace(data_parser.tracing_parser(
+                trace_filename, record_types={"TYPE_MAGNETIC_FIELD", "TYPE_WAYPOINT"}))
+    magnetic_map.save(map_file)
+    return magnetic_map
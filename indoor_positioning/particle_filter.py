@@ -0,0 +1,257 @@
+from indoor_positioning import pdr
+
+import numpy as np
+
+
+class ParticleFilter:
+    """Particle filter localizer over the walkable cells of an OccupancyGridMap
+
+    The particles are kept as structure-of-arrays (x, y and weights NumPy arrays). Motion updates move every
+    particle at once, and the particles whose move crosses a wall or leaves the walkable cells of the grid get a
+    zero weight through a batched traversal of the grid. When every particle is dropped, they are spread again
+    around the last estimate. Measurement updates weight the particles by their distance to a position
+    measurement, e.g. from a WiFi fingerprint or beacon query, and systematic resampling is vectorized.
+    """
+
+    def __init__(self, grid, n_particles=10000, seed=None, reseed_spread=3.0):
+        """
+        Args:
+            grid (OccupancyGridMap): Occupancy grid of the floor
+            n_particles (int, optional): Number of particles. Defaults to 10000.
+            seed (int, optional): Seed of the random generator. Defaults to None.
+            reseed_spread (float, optional): Standard deviation in meters of the particles spread again around
+            the last estimate when every particle is dropped. Defaults to 3.0.
+        """
+        self.grid = grid
+        self.n_particles = n_particles
+        self.reseed_spread = reseed_spread
+        self.rng = np.random.default_rng(seed)
+        self.x = np.zeros(n_particles)
+        self.y = np.zeros(n_particles)
+        self.weights = np.full(n_particles, 1 / n_particles)
+
+    def initialize(self, center=None, spread=1.0):
+        """Spreads the particles around a position, or uniformly over the walkable cells of the grid
+
+        Args:
+            center (tuple(float, float), optional): Initial position in meters, None spreads the particles over
+            the whole grid. Defaults to None.
+            spread (float, optional): Standard deviation in meters around the center. Defaults to 1.0.
+        """
+        self._spread(center, spread)
+        self.weights = np.full(self.n_particles, 1 / self.n_particles)
+        self._drop_occupied()
+
+    def _spread(self, center, spread):
+        """Draws the positions of the particles, see initialize, without weighting them"""
+        if center is None:
+            walkable_cells = np.argwhere(np.asarray(self.grid.walkable))
+            if not walkable_cells.shape[0]:
+                return
+            cells = walkable_cells[self.rng.integers(0, walkable_cells.shape[0], self.n_particles)]
+            xy = self.grid._idx_to_coords(cells) + \
+                self.rng.uniform(-0.5, 0.5, (self.n_particles, 2)) * self.grid.cell_size
+            self.x, self.y = xy[:, 0].copy(), xy[:, 1].copy()
+        else:
+            self.x = center[0] + self.rng.normal(0, spread, self.n_particles)
+            self.y = center[1] + self.rng.normal(0, spread, self.n_particles)
+
+    def predict(self, step_length, heading, length_noise=0.1, heading_noise=0.1):
+        """Motion update of a step, or of the displacement of a tick of the IMU stream
+
+        Args:
+            step_length (float): Distance walked in meters
+            heading (float): Azimuth of the motion in radians, clockwise from north (the y axis)
+            length_noise (float, optional): Standard deviation of the length in meters. Defaults to 0.1.
+            heading_noise (float, optional): Standard deviation of the heading in radians. Defaults to 0.1.
+        """
+        lengths = step_length + self.rng.normal(0, length_noise, self.n_particles)
+        headings = heading + self.rng.normal(0, heading_noise, self.n_particles)
+        starts = np.stack([self.x, self.y], axis=1)
+        self.x = self.x + lengths * np.sin(headings)
+        self.y = self.y + lengths * np.cos(headings)
+        blocked = self.grid.crosses_obstacle(starts, np.stack([self.x, self.y], axis=1))
+        self._normalize(self.weights * ~blocked)
+
+    def update(self, position, sigma=5.0):
+        """Measurement update with a position measurement, e.g. from FingerprintDB.knn
+
+        Args:
+            position (tuple(float, float)): Measured position in meters, NaN positions are ignored
+            sigma (float, optional): Standard deviation of the measurement in meters. Defaults to 5.0.
+        """
+        if np.isnan(position).any():
+            return
+        squared_distance = (self.x - position[0]) ** 2 + (self.y - position[1]) ** 2
+        self._normalize(self.weights * np.exp(-squared_distance / (2 * sigma ** 2)))
+
+    def effective_size(self):
+        """Effective number of particles, 1 / sum(weights ** 2)"""
+        return 1 / np.dot(self.weights, self.weights)
+
+    def resample(self):
+        """Systematic resampling of the particles"""
+        positions = (self.rng.random() + np.arange(self.n_particles)) / self.n_particles
+        cumulative = np.cumsum(self.weights)
+        cumulative[-1] = 1.0
+        chosen = np.searchsorted(cumulative, positions)
+        self.x, self.y = self.x[chosen], self.y[chosen]
+        self.weights = np.full(self.n_particles, 1 / self.n_particles)
+
+    def estimate(self):
+        """Weighted mean position of the particles
+
+        Returns:
+            np.array: Estimated (x, y) position in meters
+        """
+        return np.array([np.dot(self.weights, self.x), np.dot(self.weights, self.y)])
+
+    def step(self, step_length, heading, position=None, sigma=5.0, resample_threshold=0.5):
+        """Motion update, optional measurement update and resampling when the effective size is too low
+
+        Args:
+            step_length (float): Distance walked in meters
+            heading (float): Azimuth of the motion in radians
+            position (tuple(float, float), optional): Position measurement. Defaults to None.
+            sigma (float, optional): Standard deviation of the measurement in meters. Defaults to 5.0.
+            resample_threshold (float, optional): Fraction of n_particles of effective size below which the
+            particles are resampled. Defaults to 0.5.
+
+        Returns:
+            np.array: Estimated position after the step
+        """
+        self.predict(step_length, heading)
+        if position is not None:
+            self.update(position, sigma=sigma)
+        if self.effective_size() < resample_threshold * self.n_particles:
+            self.resample()
+        return self.estimate()
+
+    def _drop_occupied(self):
+        self._normalize(self.weights * self.grid.is_free(np.stack([self.x, self.y], axis=1)))
+
+    def _normalize(self, weights):
+        total = weights.sum()
+        if total > 0:
+            self.weights = weights / total
+        else:
+            self._reseed()
+
+    def _reseed(self):
+        """Spreads the particles again once every one of them was dropped, around the estimate of their
+        previous weights, or over the walkable cells when none of them lands in one"""
+        self._spread(self.estimate(), self.reseed_spread)
+        free = self.grid.is_free(np.stack([self.x, self.y], axis=1))
+        if not free.any():
+            self._spread(None, 0)
+            free = self.grid.is_free(np.stack([self.x, self.y], axis=1))
+        # Without any walkable cell, the particles are kept with uniform weights
+        self.weights = free / free.sum() if free.any() else np.full(self.n_particles, 1 / self.n_particles)
+
+
+def predict_batch(filters, step_lengths, headings, length_noise=0.1, heading_noise=0.1, rng=None):
+    """Motion update of a step of many filters on the same grid at once, e.g. those of concurrent sessions
+
+    The particles of every filter are moved and traversed through the grid in a single batch, as predict does
+    for one filter.
+
+    Args:
+        filters (list(ParticleFilter)): Filters sharing the same grid
+        step_lengths (np.array): Distance walked by each filter in meters
+        headings (np.array): Azimuth of the motion of each filter in radians, clockwise from north
+        length_noise (float, optional): Standard deviation of the lengths in meters. Defaults to 0.1.
+        heading_noise (float, optional): Standard deviation of the headings in radians. Defaults to 0.1.
+        rng (np.random.Generator, optional): Random generator of the noise, None uses the one of the first
+        filter. Defaults to None.
+
+    Raises:
+        ValueError: When the filters do not share the same grid
+    """
+    if not filters:
+        return
+    grid = filters[0].grid
+    if any(particle_filter.grid is not grid for particle_filter in filters):
+        raise ValueError(
+            "{} filters on different grids are not a valid batch.".format(len(filters)))
+    rng = filters[0].rng if rng is None else rng
+
+    sizes = np.array([particle_filter.n_particles for particle_filter in filters])
+    bounds = np.cumsum(sizes)[:-1]
+    lengths = np.repeat(np.asarray(step_lengths, dtype="float64"), sizes) + rng.normal(0, length_noise, sizes.sum())
+    particle_headings = np.repeat(np.asarray(headings, dtype="float64"), sizes) + \
+        rng.normal(0, heading_noise, sizes.sum())
+    x = np.concatenate([particle_filter.x for particle_filter in filters])
+    y = np.concatenate([particle_filter.y for particle_filter in filters])
+    starts = np.stack([x, y], axis=1)
+    x = x + lengths * np.sin(particle_headings)
+    y = y + lengths * np.cos(particle_headings)
+    blocked = grid.crosses_obstacle(starts, np.stack([x, y], axis=1))
+
+    for particle_filter, filter_x, filter_y, filter_blocked in zip(filters, np.split(x, bounds), np.split(y, bounds),
+                                                                   np.split(blocked, bounds)):
+        particle_filter.x, particle_filter.y = filter_x, filter_y
+        particle_filter._normalize(particle_filter.weights * ~filter_blocked)
+
+
+def localize(trace_data, grid, fingerprint_db=None, beacon_map=None, floor=None, n_particles=10000, seed=None,
+             k=5, sigma=5.0, beacon_sigma=8.0):
+    """Particle filter track of a trace, moved by its PDR steps and corrected by its WiFi scans and beacon readings
+
+    Args:
+        trace_data (TraceData): Parsed trace
+        grid (OccupancyGridMap): Occupancy grid of the floor of the trace
+        fingerprint_db (FingerprintDB, optional): WiFi fingerprints of the floor. Defaults to None.
+        beacon_map (BeaconMap, optional): Beacon positions of the venue. Defaults to None.
+        floor (str, optional): Floor of the trace, only the beacons of the floor are used. Defaults to None.
+        n_particles (int, optional): Number of particles. Defaults to 10000.
+        seed (int, optional): Seed of the random generator. Defaults to None.
+        k (int, optional): Number of neighbours of the fingerprint queries. Defaults to 5.
+        sigma (float, optional): Standard deviation of the WiFi positions in meters. Defaults to 5.0.
+        beacon_sigma (float, optional): Standard deviation of the beacon positions in meters. Defaults to 8.0.
+
+    Returns:
+        (np.array, np.array): Timestamp of each step and the (steps, 2) positions estimated after them. Without
+        fingerprints or beacons, the track only follows the PDR steps from the first waypoint
+    """
+    track = pdr.pdr(trace_data)
+    particle_filter = ParticleFilter(grid, n_particles=n_particles, seed=seed)
+    if len(trace_data.waypoint):
+        particle_filter.initialize(center=trace_data.waypoint.xy[0])
+    else:
+        particle_filter.initialize()
+
+    # Position measurements, each one is used at the first step after it
+    measurement_tss, measurements, measurement_sigmas = [np.empty(0)], [np.empty((0, 2))], [np.empty(0)]
+    if fingerprint_db is not None:
+        wifi = trace_data.wifi
+        scan_tss, scan_rows = np.unique(np.asarray(wifi.tss), return_inverse=True)
+        scan_order = np.argsort(scan_rows.reshape(-1), kind="stable")
+        scan_bounds = np.concatenate([[0], np.cumsum(np.bincount(scan_rows.reshape(-1),
+                                                                 minlength=scan_tss.shape[0]))])
+        scan_positions = np.array([fingerprint_db.knn(wifi.bssid_names[wifi.bssid[scan_order[start:end]]],
+                                                      wifi.rssi[scan_order[start:end]], k=k)[0]
+                                   for start, end in zip(scan_bounds[:-1], scan_bounds[1:])]).reshape(-1, 2)
+        measurement_tss.append(scan_tss.astype("float64"))
+        measurements.append(scan_positions)
+        measurement_sigmas.append(np.full(scan_tss.shape[0], sigma))
+    if beacon_map is not None:
+        epoch_tss, epoch_positions, _ = beacon_map.locate(trace_data.beacon, floor=floor)
+        measurement_tss.append(epoch_tss)
+        measurements.append(epoch_positions)
+        measurement_sigmas.append(np.full(epoch_tss.shape[0], beacon_sigma))
+    measurement_tss = np.concatenate(measurement_tss)
+    order = np.argsort(measurement_tss, kind="stable")
+    measurements, measurement_sigmas = np.concatenate(measurements)[order], np.concatenate(measurement_sigmas)[order]
+    measurement_bounds = np.searchsorted(measurement_tss[order], track.tss, side="right")
+
+    positions = np.empty((len(track), 2))
+    first_measurement = 0
+    for step_ix in range(len(track)):
+        particle_filter.predict(track.step_length[step_ix], track.heading[step_ix])
+        for measurement_ix in range(first_measurement, measurement_bounds[step_ix]):
+            particle_filter.update(measurements[measurement_ix], sigma=measurement_sigmas[measurement_ix])
+        first_measurement = measurement_bounds[step_ix]
+        if particle_filter.effective_size() < 0.5 * n_particles:
+            particle_filter.resample()
+        positions[step_ix] = particle_filter.estimate()
+    return track.tss, positions
@@ -0,0 +1,251 @@
+from indoor_positioning import data_processing
+from dataclasses import dataclass
+
+import numpy as np
+
+
+HEADING_SOURCES = ["rotation_vector", "magnetometer"]
+
+
+@dataclass
+class PDRTrack:
+    """Pedestrian dead-reckoning track of a trace: one row per detected step
+
+    xy are the relative positions in meters after each step, x pointing east and y north of the start, and
+    heading the azimuth of each step in radians, clockwise from north.
+    """
+
+    tss: np.ndarray
+    step_length: np.ndarray
+    heading: np.ndarray
+    xy: np.ndarray
+
+    def __len__(self):
+        return self.tss.shape[0]
+
+
+def rotation_vector_heading(rotation_vector):
+    """Azimuth of the device from the Android rotation vector, as SensorManager.getOrientation
+
+    Args:
+        rotation_vector (np.array): (N, 3) x, y, z components of the rotation unit quaternion
+
+    Returns:
+        np.array: Azimuth in radians, clockwise from north
+    """
+    x, y, z = (np.asarray(rotation_vector, dtype="float64")[:, ix] for ix in range(3))
+    w = np.sqrt(np.clip(1 - x ** 2 - y ** 2 - z ** 2, 0, None))
+    return np.arctan2(2 * (x * y - z * w), 1 - 2 * (x ** 2 + z ** 2))
+
+
+def magnetic_heading(acc, mag):
+    """Tilt-compensated azimuth of the device from gravity and the magnetic field, as SensorManager.getRotationMatrix
+
+    Args:
+        acc (np.array): (N, 3) accelerometer readings, dominated by gravity
+        mag (np.array): (N, 3) magnetometer readings at the same times
+
+    Returns:
+        np.array: Azimuth in radians, clockwise from magnetic north
+    """
+    acc = np.asarray(acc, dtype="float64")
+    east = np.cross(np.asarray(mag, dtype="float64"), acc)
+    east /= np.linalg.norm(east, axis=1, keepdims=True)
+    north = np.cross(acc / np.linalg.norm(acc, axis=1, keepdims=True), east)
+    return np.arctan2(east[:, 1], north[:, 1])
+
+
+def _batched_interp(x, xp, fp, x_offsets, xp_offsets):
+    """np.interp of many series at once, each series being shifted to its own time range
+
+    Args:
+        x (np.array): Concatenated query times of all the series
+        xp (np.array): Concatenated sample times of all the series, increasing within each series
+        fp (np.array): Concatenated sample values
+        x_offsets (np.array): Start of each series in x, plus the total length
+        xp_offsets (np.array): Start of each series in xp, plus the total length
+
+    Returns:
+        np.array: Interpolated values at x, clamped to the first and last values of each series, and NaN for
+        the series without samples
+    """
+    values = np.full(x.shape[0], np.nan)
+    if not xp.shape[0]:
+        return values
+
+    x_series = np.repeat(np.arange(x_offsets.shape[0] - 1), np.diff(x_offsets))
+    xp_series = np.repeat(np.arange(xp_offsets.shape[0] - 1), np.diff(xp_offsets))
+    has_samples = np.diff(xp_offsets) > 0
+    first = xp[np.minimum(xp_offsets[:-1], xp.shape[0] - 1)]
+    last = xp[np.maximum(xp_offsets[1:] - 1, 0)]
+
+    # Each series is moved past the end of the previous one, so that the concatenation is increasing
+    span = np.max((last - first)[has_samples]) + 1
+    shift = np.arange(first.shape[0]) * 2 * span - first
+    queried = has_samples[x_series]
+    x_series = x_series[queried]
+    values[queried] = np.interp(np.clip(x[queried], first[x_series], last[x_series]) + shift[x_series],
+                                xp + shift[xp_series], fp)
+    return values
+
+
+def pdr_arrays(acc_tss, filtered_acc, heading_tss, heading, acc_offsets=None, heading_offsets=None,
+               min_step_interval=250, min_peak_height=None, weinberg_k=0.45, sample_freq=50):
+    """Step detection, step length, step heading and position integration of one or many concatenated traces
+
+    Args:
+        acc_tss (np.array): Timestamps in ms of the filtered accelerometer magnitude
+        filtered_acc (np.array): Filtered accelerometer magnitude, e.g. filtered_acc of data_processing.acc_df
+        heading_tss (np.array): Timestamps in ms of the headings
+        heading (np.array): Azimuth of the device in radians, clockwise from north
+        acc_offsets (np.array, optional): Start of each trace in the accelerometer arrays plus their total
+        length, None for a single trace. Defaults to None.
+        heading_offsets (np.array, optional): Same as acc_offsets for the heading arrays. Defaults to None.
+        min_step_interval (float, optional): Minimum time between steps in ms. Defaults to 250.
+        min_peak_height (float, optional): Minimum filtered magnitude of a step peak, None uses the mean
+        magnitude of each trace. Defaults to None.
+        weinberg_k (float, optional): Constant of the Weinberg step length model
+        K * (max - min) ** (1/4). Defaults to 0.45.
+        sample_freq (float, optional): Nominal sample frequency of the accelerometer in Hz, used to turn
+        min_step_interval into samples. Defaults to 50.
+
+    Returns:
+        list(PDRTrack): Track of each trace
+    """
+    from scipy import signal
+
+    acc_tss = np.asarray(acc_tss, dtype="float64")
+    filtered_acc = np.asarray(filtered_acc, dtype="float64")
+    acc_offsets = np.array([0, acc_tss.shape[0]]) if acc_offsets is None else np.asarray(acc_offsets)
+    heading_offsets = np.array([0, np.shape(heading_tss)[0]]) if heading_offsets is None else \
+        np.asarray(heading_offsets)
+    n_traces = acc_offsets.shape[0] - 1
+    acc_lengths = np.diff(acc_offsets)
+
+    # The traces are separated by -inf padding at least one step interval long, so that find_peaks
+    # handles every trace at once without peaks interacting across traces
+    distance = max(int(min_step_interval * sample_freq / 1000), 1)
+    pad = distance + 1
+    padded_offsets = acc_offsets[:-1] + pad * np.arange(n_traces)
+    padded = np.full(acc_tss.shape[0] + pad * n_traces, -np.inf)
+    sample_trace = np.repeat(np.arange(n_traces), acc_lengths)
+    padded_ix = np.arange(acc_tss.shape[0]) + pad * sample_trace
+    padded[padded_ix] = filtered_acc
+
+    height = np.full(padded.shape[0], np.inf)
+    if min_peak_height is None:
+        trace_sums = np.add.reduceat(np.concatenate([filtered_acc, [0]]), np.minimum(acc_offsets[:-1],
+                                                                                      filtered_acc.shape[0]))
+        height[padded_ix] = (trace_sums / np.maximum(acc_lengths, 1))[sample_trace]
+    else:
+        height[padded_ix] = min_peak_height
+    # As in a single signal, the first and last samples of a trace are never peaks
+    height[padded_offsets] = np.inf
+    height[padded_offsets + np.maximum(acc_lengths - 1, 0)] = np.inf
+    peaks, _ = signal.find_peaks(padded, height=height, distance=distance)
+
+    step_trace = np.searchsorted(padded_offsets, peaks, side="right") - 1
+    # Index of each step in the concatenated accelerometer arrays
+    steps = peaks - pad * step_trace
+    n_steps = np.bincount(step_trace, minlength=n_traces)
+    step_offsets = np.concatenate([[0], np.cumsum(n_steps)])
+    first_step = np.zeros(peaks.shape[0], dtype=bool)
+    first_step[step_offsets[:-1][n_steps > 0]] = True
+
+    # Weinberg step length over the samples from the previous step (or the trace start) to each step
+    window_start = np.where(first_step, padded_offsets[step_trace], np.concatenate([[0], peaks[:-1]]))
+    bounds = np.stack([window_start, peaks + 1], axis=1).reshape(-1)
+    window_max = np.maximum.reduceat(padded, bounds)[::2] if peaks.shape[0] else np.empty(0)
+    window_min = np.minimum.reduceat(np.where(np.isinf(padded), np.inf, padded), bounds)[::2] \
+        if peaks.shape[0] else np.empty(0)
+    step_length = weinberg_k * np.power(np.clip(window_max - window_min, 0, None), 0.25)
+
+    # Circular interpolation of the heading at each step
+    step_tss = acc_tss[steps]
+    heading_tss = np.asarray(heading_tss, dtype="float64")
+    heading = np.asarray(heading, dtype="float64")
+    step_heading = np.arctan2(
+        _batched_interp(step_tss, heading_tss, np.sin(heading), step_offsets, heading_offsets),
+        _batched_interp(step_tss, heading_tss, np.cos(heading), step_offsets, heading_offsets)) \
+        if steps.shape[0] else np.empty(0)
+
+    # Positions, the cumulative sums are restarted at each trace
+    displacement = np.stack([step_length * np.sin(step_heading), step_length * np.cos(step_heading)], axis=1)
+    xy = np.cumsum(displacement, axis=0)
+    trace_base = np.concatenate([np.zeros((1, 2)), xy])[step_offsets[:-1]]
+    xy -= trace_base[step_trace]
+
+    return [PDRTrack(tss=step_tss[start:end].astype(np.int64), step_length=step_length[start:end],
+                     heading=step_heading[start:end], xy=xy[start:end])
+            for start, end in zip(step_offsets[:-1], step_offsets[1:])]
+
+
+def pdr_batch(traces, heading_source="rotation_vector", filt_type="sosfiltfilt", **kwargs):
+    """Pedestrian dead-reckoning of many traces at once
+
+    The accelerometer magnitude of each trace is filtered as in data_processing.acc_df, straight from the
+    parsed arrays, and all of the remaining steps run over the concatenated arrays of every trace.
+
+    Args:
+        traces (list(TraceData)): Parsed traces
+        heading_source (str, optional): Either "rotation_vector" or "magnetometer", which uses mag_calib
+        and the gravity from acc_calib. Defaults to "rotation_vector".
+        filt_type (str, optional): Filter of the accelerometer magnitude, either "sosfiltfilt" or "filtfilt".
+        Defaults to "sosfiltfilt".
+        **kwargs: Options of pdr_arrays (min_step_interval, min_peak_height, weinberg_k, sample_freq)
+
+    Raises:
+        ValueError: When a not valid heading source or filter type is input
+
+    Returns:
+        list(PDRTrack): Track of each trace
+    """
+    if heading_source not in HEADING_SOURCES:
+        raise ValueError(
+            "{} is not a valid heading source.".format(heading_source))
+    if filt_type not in ["filtfilt", "sosfiltfilt"]:
+        raise ValueError(
+            "{} is not a valid filter type.".format(filt_type))
+
+    # Building the DataFrame of acc_df for each trace took longer than filtering it
+    filt_param = data_processing.butter_filter(output="sos" if filt_type == "sosfiltfilt" else "ba")
+    acc_offsets = np.concatenate([[0], np.cumsum([len(trace.acc_calib) for trace in traces])])
+    acc_tss = np.concatenate([trace.acc_calib.tss.astype("float64") for trace in traces] + [np.empty(0)])
+    filtered_acc = np.concatenate([data_processing.filter_signal(data_processing.acc_magnitude(trace), filt_param,
+                                                                 filt_type=filt_type) for trace in traces] +
+                                  [np.empty(0)])
+
+    if heading_source == "rotation_vector":
+        sources = [trace.rotation_vector for trace in traces]
+        heading_offsets = np.concatenate([[0], np.cumsum([len(source) for source in sources])])
+        heading_tss = np.concatenate([source.tss.astype("float64") for source in sources] + [np.empty(0)])
+        heading = rotation_vector_heading(np.concatenate([source.xyz for source in sources] +
+                                                         [np.empty((0, 3), dtype="float32")]))
+    else:
+        mags = [trace.mag_calib for trace in traces]
+        accs = [trace.acc_calib for trace in traces]
+        heading_offsets = np.concatenate([[0], np.cumsum([len(mag) for mag in mags])])
+        heading_tss = np.concatenate([mag.tss.astype("float64") for mag in mags] + [np.empty(0)])
+        raw_acc_offsets = np.concatenate([[0], np.cumsum([len(acc) for acc in accs])])
+        raw_acc_tss = np.concatenate([acc.tss.astype("float64") for acc in accs] + [np.empty(0)])
+        raw_acc = np.concatenate([acc.xyz for acc in accs] + [np.empty((0, 3), dtype="float32")])
+        gravity = np.stack([_batched_interp(heading_tss, raw_acc_tss, raw_acc[:, ix], heading_offsets,
+                                            raw_acc_offsets) for ix in range(3)], axis=1)
+        heading = magnetic_heading(gravity, np.concatenate([mag.xyz for mag in mags] +
+                                                           [np.empty((0, 3), dtype="float32")]))
+
+    return pdr_arrays(acc_tss, filtered_acc, heading_tss, heading, acc_offsets=acc_offsets,
+                      heading_offsets=heading_offsets, **kwargs)
+
+
+def pdr(trace_data, **kwargs):
+    """Pedestrian dead-reckoning of a trace, see pdr_batch
+
+    Args:
+        trace_data (TraceData): Parsed trace
+        **kwargs: Options of pdr_batch
+
+    Returns:
+        PDRTrack: Track of the trace
+    """
+    return pdr_batch([trace_data], **kwargs)[0]
@@ -0,0 +1,171 @@
+"""Paginated HTML report of the traces of a venue, rendered in parallel with a single shared plotly.js
+
+Usage:
+    python -m indoor_positioning.report ROOT [--output DIR] [--workers N] [--page-size N] [--max-points N]
+"""
+from indoor_positioning import data_parser, data_processing, visualizer
+from indoor_positioning.data_parser import find_traces
+from indoor_positioning.trace_cache import TraceCache
+from functools import partial
+from multiprocessing import Pool
+from pathlib import Path
+
+import argparse
+import html
+import os
+import sys
+import time
+import plotly.offline as pyo
+
+
+# Number of bins of the timestamp difference histograms
+TSS_DIFF_BINS = 100
+
+PAGE_TEMPLATE = """<html><head><meta charset="utf-8"><title>{title}</title>
+<script src="{plotlyjs}"></script></head><body>
+<h1>{title}</h1>
+<p>{navigation}</p>
+{sections}
+<p>{navigation}</p>
+</body></html>
+"""
+
+
+def trace_section(trace_filename, max_points=2000, cache_dir=None):
+    """Renders the figures of a trace into an HTML section, without plotly.js
+
+    The figures only hold binned or downsampled data, so their size grows with max_points and TSS_DIFF_BINS
+    instead of with the number of samples of the trace.
+
+    Args:
+        trace_filename (str): Tracing file recorded for the XYZ2020 competition
+        max_points (int, optional): Approximate number of points plotted per series. Defaults to 2000.
+        cache_dir (str, optional): Folder of a TraceCache used for parsing. Defaults to None.
+
+    Returns:
+        dict: Trace, title and HTML of the section, with an "error" message when it could not be rendered
+    """
+    section = {"trace": trace_filename, "title": Path(trace_filename).stem}
+    try:
+        if cache_dir is None:
+            parsed_data = data_parser.tracing_parser(trace_filename)
+        else:
+            parsed_data = TraceCache(cache_dir).load(trace_filename)
+        section["title"] = "{} / {} / {}".format(parsed_data.site_id, parsed_data.floor_name,
+                                                 Path(trace_filename).stem)
+
+        figs = [visualizer.viz_histogram_tss_diff(sensor_data.tss, sensor_name=sensor_name, n_bins=TSS_DIFF_BINS)
+                for sensor_name, sensor_data in [("Calibrated Acce", parsed_data.acc_calib),
+                                                 ("Calibrated Magnetometer", parsed_data.mag_calib),
+                                                 ("Calibrated Gyro", parsed_data.gyro_calib)]]
+        figs.append(visualizer.fig_acc_filter(data_processing.acc_df(parsed_data), max_points=max_points))
+        divs = [pyo.plot(fig, include_plotlyjs=False, output_type="div") for fig in figs]
+        section["html"] = "<h2>{}</h2>\n{}\n".format(html.escape(section["title"]), "\n".join(divs))
+    except Exception as error:
+        # A broken trace must not stop the whole report, it is reported in its section instead
+        section["error"] = "{}: {}".format(type(error).__name__, error)
+        section["html"] = "<h2>{}</h2>\n<p>{}</p>\n".format(html.escape(section["title"]),
+                                                            html.escape(section["error"]))
+    return section
+
+
+def _write_page(output_dir, page_ix, n_pages, sections, title):
+    """Writes a page of sections, and returns their summaries without HTML"""
+    page_name = "page_{:04d}.html".format(page_ix + 1)
+    links = ['<a href="index.html">Index</a>']
+    if page_ix > 0:
+        links.append('<a href="page_{:04d}.html">Previous</a>'.format(page_ix))
+    if page_ix + 1 < n_pages:
+        links.append('<a href="page_{:04d}.html">Next</a>'.format(page_ix + 2))
+    with open(Path(output_dir) / page_name, "w", encoding="utf-8") as f:
+        f.write(PAGE_TEMPLATE.format(title="{} - page {}".format(html.escape(title), page_ix + 1),
+                                     plotlyjs=visualizer.PLOTLYJS_FILE, navigation=" | ".join(links),
+                                     sections="\n".join(section["html"] for section in sections)))
+    return [dict({key: value for key, value in section.items() if key != "html"}, page=page_name)
+            for section in sections]
+
+
+def build_report(root, output_dir, workers=None, page_size=10, max_points=2000, cache_dir=None,
+                 progress=True):
+    """Renders every tracing file under root into a paginated report, in a pool of worker processes
+
+    The workers render the sections of the traces in order, and each page is written as soon as its sections
+    are rendered. Every page references the same local copy of plotly.js, written once into output_dir.
+
+    Args:
+        root (str): Venue, floor or dataset folder
+        output_dir (str): Folder of the report
+        workers (int, optional): Number of worker processes, None uses every core. Defaults to None.
+        page_size (int, optional): Number of traces per page. Defaults to 10.
+        max_points (int, optional): Approximate number of points plotted per series. Defaults to 2000.
+        cache_dir (str, optional): Folder of a TraceCache used for parsing. Defaults to None.
+        progress (bool, optional): Whether to report the progress on stderr. Defaults to True.
+
+    Raises:
+        ValueError: When a not valid number of workers or page size is input
+
+    Returns:
+        list(dict): Sections of the traces without their HTML, with the page of each one
+    """
+    workers = os.cpu_count() if workers is None else workers
+    if workers < 1:
+        raise ValueError(
+            "{} is not a valid number of workers.".format(workers))
+    if page_size < 1:
+        raise ValueError(
+            "{} is not a valid page size.".format(page_size))
+
+    traces = find_traces(root)
+    n_pages = max((len(traces) + page_size - 1) // page_size, 1)
+    title = Path(os.path.abspath(root)).name
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    visualizer.write_plotlyjs(output_dir)
+    worker_task = partial(trace_section, max_points=max_points, cache_dir=cache_dir)
+
+    summaries, page_sections = [], []
+    start_time = time.perf_counter()
+    with Pool(processes=min(workers, max(len(traces), 1))) as pool:
+        for section in pool.imap(worker_task, traces):
+            page_sections.append(section)
+            if progress:
+                elapsed = time.perf_counter() - start_time
+                print("[{}/{}] {:.1f} traces/s {}{}".format(
+                    len(summaries) + len(page_sections), len(traces),
+                    (len(summaries) + len(page_sections)) / elapsed, section["trace"],
+                    " ({})".format(section["error"]) if "error" in section else ""), file=sys.stderr)
+            if len(page_sections) == page_size:
+                summaries += _write_page(output_dir, len(summaries) // page_size, n_pages, page_sections, title)
+                page_sections = []
+    if page_sections or not traces:
+        summaries += _write_page(output_dir, len(summaries) // page_size, n_pages, page_sections, title)
+
+    with open(Path(output_dir) / "index.html", "w", encoding="utf-8") as f:
+        items = "\n".join('<li><a href="{}">{}</a>{}</li>'.format(
+            summary["page"], html.escape(summary["title"]),
+            " ({})".format(html.escape(summary["error"])) if "error" in summary else "") for summary in summaries)
+        f.write("<html><head><meta charset=\"utf-8\"><title>{0}</title></head><body><h1>{0}</h1>\n"
+                "<ul>\n{1}\n</ul>\n</body></html>\n".format(html.escape(title), items))
+    return summaries
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Renders the tracing files of a venue or dataset folder "
+                                     "into a paginated HTML report")
+    parser.add_argument("root", help="Venue, floor or dataset folder")
+    parser.add_argument("--output", default="./output/report/", help="Folder of the report")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes")
+    parser.add_argument("--page-size", type=int, default=10, help="Traces per page")
+    parser.add_argument("--max-points", type=int, default=2000, help="Points plotted per series")
+    parser.add_argument("--cache-dir", default=None, help="Folder of a parsed trace cache")
+    parser.add_argument("--quiet", action="store_true", help="Do not report the progress")
+    args = parser.parse_args(argv)
+
+    summaries = build_report(args.root, args.output, workers=args.workers, page_size=args.page_size,
+                             max_points=args.max_points, cache_dir=args.cache_dir, progress=not args.quiet)
+    n_errors = sum("error" in summary for summary in summaries)
+    print("{} traces rendered, {} errors".format(len(summaries) - n_errors, n_errors))
+    return 1 if n_errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
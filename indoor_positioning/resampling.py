@@ -0,0 +1,124 @@
+from dataclasses import dataclass
+
+import numpy as np
+
+
+# 3-axis sensors of TraceData aligned by default
+IMU_SENSORS = ["acc_calib", "acc_uncalib", "mag_calib", "mag_uncalib", "gyro_calib", "gyro_uncalib",
+               "rotation_vector"]
+
+INTERPOLATION_METHODS = ["linear", "nearest", "previous"]
+
+
+@dataclass
+class ResampledIMU:
+    """3-axis sensors of a trace aligned on one uniform clock
+
+    data keeps the x, y, z columns of every sensor, in the order of sensors, as a single C-contiguous float32
+    (samples, 3 * sensors) matrix, so that filtering or fusion can run as one array operation, e.g.
+    data_processing.filter_batch(resampled.data.T, sample_freq=resampled.sample_freq).
+    """
+
+    tss: np.ndarray
+    data: np.ndarray
+    valid: np.ndarray
+    sensors: list
+    sample_freq: float
+
+    def __len__(self):
+        return self.tss.shape[0]
+
+    def sensor(self, name):
+        """(samples, 3) view of the resampled data of a sensor
+
+        Args:
+            name (str): Sensor name, one of sensors
+
+        Returns:
+            np.array: x, y, z columns of the sensor
+        """
+        ix = self.sensors.index(name)
+        return self.data[:, 3 * ix:3 * ix + 3]
+
+
+def resample_imu(trace_data, sample_freq=50, sensors=None, method="linear", max_gap=None):
+    """Aligns the 3-axis sensors of a trace onto one uniform clock
+
+    The clock spans the time range covered by every sensor with data, i.e. the intersection of their ranges,
+    so that no sensor is extrapolated past its first or last sample. A resampled sample is flagged as a gap of
+    its sensor when the source samples around it are more than max_gap apart, or when the sensor has
+    no data at all. Gaps are still interpolated (or NaN for sensors without data), so valid must be checked.
+
+    Args:
+        trace_data (TraceData): Parsed trace
+        sample_freq (float, optional): Frequency of the uniform clock in Hz. Defaults to 50.
+        sensors (list(str), optional): TraceData sensors to be aligned, None aligns IMU_SENSORS.
+        Defaults to None.
+        method (str, optional): Interpolation method, either "linear", "nearest" or "previous" (zero-order
+        hold). Defaults to "linear".
+        max_gap (float, optional): Maximum time in ms between source samples which is not a gap, None uses
+        4 clock periods. Defaults to None.
+
+    Raises:
+        ValueError: When a not valid interpolation method or sample frequency is input
+
+    Returns:
+        ResampledIMU: Resampled sensors, with a float64 clock in ms and a (samples, sensors) valid mask
+    """
+    if method not in INTERPOLATION_METHODS:
+        raise ValueError(
+            "{} is not a valid interpolation method.".format(method))
+    if not sample_freq > 0:
+        raise ValueError(
+            "{} is not a valid sample frequency.".format(sample_freq))
+
+    sensors = list(IMU_SENSORS if sensors is None else sensors)
+    period = 1000 / sample_freq
+    max_gap = 4 * period if max_gap is None else max_gap
+
+    # Sources sorted by timestamp, which they almost always already are
+    sources = []
+    for name in sensors:
+        sensor_data = getattr(trace_data, name)
+        tss = np.asarray(sensor_data.tss, dtype="float64")
+        xyz = np.asarray(sensor_data.xyz)
+        if tss.shape[0] and (np.diff(tss) < 0).any():
+            order = np.argsort(tss, kind="stable")
+            tss, xyz = tss[order], xyz[order]
+        sources.append((tss, xyz))
+
+    with_data = [tss for tss, _ in sources if tss.shape[0]]
+    if with_data:
+        start = max(tss[0] for tss in with_data)
+        end = min(tss[-1] for tss in with_data)
+        n_samples = int(np.floor((end - start) / period)) + 1 if end >= start else 0
+    else:
+        start, n_samples = 0.0, 0
+    clock = start + np.arange(n_samples) * period
+
+    data = np.empty((n_samples, 3 * len(sensors)), dtype=np.float32)
+    valid = np.zeros((n_samples, len(sensors)), dtype=bool)
+    for ix, (tss, xyz) in enumerate(sources):
+        columns = data[:, 3 * ix:3 * ix + 3]
+        if not tss.shape[0]:
+            columns[:] = np.nan
+            continue
+
+        # Source samples before (prev) and after (next) each clock sample
+        after = np.searchsorted(tss, clock, side="right")
+        prev_ix = np.clip(after - 1, 0, tss.shape[0] - 1)
+        next_ix = np.clip(after, 0, tss.shape[0] - 1)
+        prev_tss, next_tss = tss[prev_ix], tss[next_ix]
+
+        if method == "linear":
+            span = next_tss - prev_tss
+            weight = np.divide(clock - prev_tss, span, out=np.zeros_like(clock), where=span > 0)[:, None]
+            columns[:] = xyz[prev_ix] * (1 - weight) + xyz[next_ix] * weight
+        elif method == "nearest":
+            columns[:] = xyz[np.where(clock - prev_tss <= next_tss - clock, prev_ix, next_ix)]
+        else:
+            columns[:] = xyz[prev_ix]
+
+        valid[:, ix] = (clock >= tss[0]) & (clock <= tss[-1]) & (next_tss - prev_tss <= max_gap)
+
+    return ResampledIMU(tss=clock, data=data, valid=valid, sensors=sensors, sample_freq=sample_freq)
@@ -0,0 +1,964 @@
+"""Asyncio localization service for many concurrent phones, and its load generator
+
+The phones stream the lines of their traces, in the format of the tracing files, to an HTTP/1.1 endpoint:
+
+    POST /sessions/<session id>     lines of the trace since the previous request, header lines included
+    DELETE /sessions/<session id>   ends the session
+    GET /stats                      counters and CPU time of the service
+
+Each session keeps the state of its accelerometer filter, step detector, heading and particle filter between
+requests. The requests which arrive while a batch is computed, or within batch_window seconds of the first one,
+are computed together: the accelerometer chunks of every session are filtered with a few batched filter calls,
+the steps are detected over their concatenation, and the particles of every session of a floor are moved
+through the occupancy grid at once. The floor assets (floorplan, occupancy grid and WiFi fingerprints) are
+loaded once and shared by the sessions of the floor. A floor is loaded in a worker thread on the first request
+of its first session, whose requests are held back until it is ready while the other sessions go on.
+
+Usage:
+    python -m indoor_positioning.service serve [--host HOST] [--port PORT] [--preload ROOT] [--particles N]
+                                               [--batch-window S] [--max-batch N]
+    python -m indoor_positioning.service load ROOT [--sessions N] [--speed X] [--interval S] [--spawn]
+"""
+from indoor_positioning import data_parser, data_processing, instrumentation, pdr
+from indoor_positioning.particle_filter import ParticleFilter, predict_batch
+from dataclasses import dataclass
+from pathlib import Path
+
+import argparse
+import asyncio
+import copy
+import glob
+import json
+import os
+import subprocess
+import sys
+import time
+import numpy as np
+
+
+# Largest request body accepted, in bytes
+MAX_BODY_BYTES = 16 * 2 ** 20
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+                413: "Payload Too Large", 500: "Internal Server Error"}
+
+# Step detection, as in pdr.pdr_arrays with its default options
+MIN_STEP_INTERVAL = 250
+WEINBERG_K = 0.45
+
+# Frequency in Hz whose group delay is taken off the steps detected on the causally filtered accelerometer: on
+# the bundled traces, they trail the steps of pdr.pdr_batch, whose filter is zero-phase, by 340-346 ms, the
+# group delay of the filter at 1 Hz
+STEP_DELAY_FREQ = 1.0
+
+
+@dataclass
+class FloorAssets:
+    """Read-only data of a floor shared by all of its sessions"""
+
+    site_id: str
+    floor_name: str
+    floorplan: dict
+    grid: object
+    fingerprint_db: object
+
+
+class AssetStore:
+    """Loads the assets of each floor once, from the dataset folders and the caches of their grids and
+    fingerprint databases"""
+
+    def __init__(self, dataset_dir="./dataset", metadata_dir="./dataset/metadata/", cache_dir="./output/service/",
+                 cell_size=0.5, wifi=True):
+        """
+        Args:
+            dataset_dir (str, optional): Folder of the site folders, as DATASET_DIR of main.py.
+            Defaults to "./dataset".
+            metadata_dir (str, optional): Folder of the floor metadata. Defaults to "./dataset/metadata/".
+            cache_dir (str, optional): Folder of the saved grids and fingerprint databases.
+            Defaults to "./output/service/".
+            cell_size (float, optional): Size of the grid cells in meters. Defaults to 0.5.
+            wifi (bool, optional): Whether to load the WiFi fingerprints of the floors. Defaults to True.
+        """
+        self.dataset_dir = dataset_dir
+        self.metadata_dir = metadata_dir
+        self.cache_dir = cache_dir
+        self.cell_size = cell_size
+        self.wifi = wifi
+        self.floors = {}
+
+    def get(self, site_id, floor_name):
+        """Assets of a floor, loaded on its first use
+
+        Args:
+            site_id (str): Site id of the trace header
+            floor_name (str): Floor name of the trace header
+
+        Returns:
+            FloorAssets: Assets of the floor, None when the floor has no metadata
+        """
+        if (site_id, floor_name) not in self.floors:
+            self.floors[site_id, floor_name] = self._load(site_id, floor_name)
+        return self.floors[site_id, floor_name]
+
+    def is_loaded(self, site_id, floor_name):
+        return (site_id, floor_name) in self.floors
+
+    def preload(self, root):
+        """Loads the assets of every floor folder under a venue or dataset folder
+
+        Args:
+            root (str): Venue or dataset folder
+
+        Returns:
+            int: Number of floors with assets
+        """
+        floor_dirs = {str(Path(trace_filename).parent) for trace_filename in data_parser.find_traces(root)}
+        return sum(self.get(Path(floor_dir).parent.name, Path(floor_dir).name) is not None
+                   for floor_dir in sorted(floor_dirs))
+
+    def _load(self, site_id, floor_name):
+        from indoor_positioning.fingerprint import build_floor_db
+        from indoor_positioning.gridding.occupancy import floor_grid_map
+
+        floor_folder_dir = self.dataset_dir + "/" + site_id + "/" + floor_name
+        if not os.path.exists(self.metadata_dir + "/".join([site_id, floor_name, "floor_info.json"])):
+            return None
+        floorplan = data_parser.floorplan(self.metadata_dir, floor_folder_dir)
+        grid = floor_grid_map(floorplan, self.cell_size, self.cache_dir + "grids/")
+        fingerprint_db = None
+        if self.wifi and glob.glob(floor_folder_dir + "/*.txt"):
+            fingerprint_db = build_floor_db(floor_folder_dir, self.cache_dir + "fingerprints/{}_{}/".format(
+                site_id, floor_name))
+        return FloorAssets(site_id=site_id, floor_name=floor_name, floorplan=floorplan, grid=grid,
+                           fingerprint_db=fingerprint_db)
+
+
+class Session:
+    """Streaming state of a phone between its requests"""
+
+    def __init__(self, session_id):
+        self.session_id = session_id
+        self.metadata = {}
+        self.assets = None
+        # (site id, floor name) whose assets are loaded before the requests of the session go on
+        self.waiting_floor = None
+        self.start_position = None
+        self.last_seen = time.monotonic()
+        # Accelerometer filter state, and the last two filtered samples, whose peaks are not decided yet
+        self.filter_state = None
+        self.tail_tss = np.empty(0)
+        self.tail_values = np.empty(0)
+        # Running mean of the filtered magnitude, the step threshold of pdr.pdr_arrays
+        self.acc_sum = 0.0
+        self.acc_count = 0
+        # Extremes of the filtered magnitude since the last step, for its Weinberg length
+        self.window_min = np.inf
+        self.window_max = -np.inf
+        self.last_step_tss = -np.inf
+        self.heading = np.nan
+        # Readings of the last WiFi scan, which may continue in the next request
+        self.scan_tss = np.empty(0, dtype=np.int64)
+        self.scan_bssids = np.empty(0, dtype=object)
+        self.scan_rssi = np.empty(0, dtype=np.float32)
+        self.particle_filter = None
+        self.position = np.zeros(2)
+        self.n_steps = 0
+
+    def snapshot(self):
+        """Copy of the state of the session, which restore brings back when a batch fails
+
+        The arrays of the state, and those of the particle filter, are replaced rather than modified by the
+        batches, so they are not copied.
+
+        Returns:
+            dict: State of the session
+        """
+        state = dict(self.__dict__, metadata=dict(self.metadata))
+        if self.particle_filter is not None:
+            state["particle_filter"] = copy.copy(self.particle_filter)
+        return state
+
+    def restore(self, state):
+        self.__dict__.update(state)
+
+
+class LocalizationService:
+    """Micro-batched localization of the streamed traces of concurrent sessions"""
+
+    def __init__(self, assets, n_particles=1000, batch_window=0.005, max_batch=256, idle_timeout=300.0,
+                 seed=None, k=5, sigma=5.0):
+        """
+        Args:
+            assets (AssetStore): Assets of the floors
+            n_particles (int, optional): Number of particles of each session. Defaults to 1000.
+            batch_window (float, optional): Seconds a batch waits for more requests after its first one.
+            Defaults to 0.005.
+            max_batch (int, optional): Number of requests which closes a batch before its window ends.
+            Defaults to 256.
+            idle_timeout (float, optional): Seconds without requests after which a session is dropped.
+            Defaults to 300.0.
+            seed (int, optional): Seed of the random generator of the particle filters. Defaults to None.
+            k (int, optional): Number of neighbours of the fingerprint queries. Defaults to 5.
+            sigma (float, optional): Standard deviation of the WiFi positions in meters. Defaults to 5.0.
+
+        Raises:
+            ValueError: When a not valid number of particles or batch size is input
+        """
+        if n_particles < 1:
+            raise ValueError(
+                "{} is not a valid number of particles.".format(n_particles))
+        if max_batch < 1:
+            raise ValueError(
+                "{} is not a valid batch size.".format(max_batch))
+
+        self.assets = assets
+        self.n_particles = n_particles
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.idle_timeout = idle_timeout
+        self.rng = np.random.default_rng(seed)
+        self.k = k
+        self.sigma = sigma
+        self.step_delay = data_processing.group_delay(STEP_DELAY_FREQ)
+        self.sessions = {}
+        self.counters = {"requests": 0, "batches": 0, "lines": 0, "steps": 0}
+        self._pending = []
+        self._wakeup = None
+        # Requests held back by floor, until the assets of the floor are loaded
+        self._held = {}
+
+    def stats(self):
+        """Counters of the service
+
+        Returns:
+            dict: Sessions, requests, batches, lines, steps, mean batch size and CPU seconds of the process
+        """
+        return dict(self.counters, sessions=len(self.sessions), cpu_s=time.process_time(),
+                    mean_batch=self.counters["requests"] / max(self.counters["batches"], 1))
+
+    async def submit(self, session_id, data):
+        """Queues the lines of a session for the next batch and waits for its result
+
+        Args:
+            session_id (str): Id of the session, which is started by its first request
+            data (bytes): Complete lines of the trace
+
+        Returns:
+            dict: Result of the request, see process_batch
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((session_id, data, future))
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return await future
+
+    def close_session(self, session_id):
+        """Ends a session
+
+        Args:
+            session_id (str): Id of the session
+
+        Returns:
+            bool: Whether the session existed
+        """
+        return self.sessions.pop(session_id, None) is not None
+
+    async def run_batches(self):
+        """Computes the queued requests by batches, until cancelled"""
+        self._wakeup = asyncio.Event()
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            if len(self._pending) < self.max_batch:
+                await asyncio.sleep(self.batch_window)
+            requests, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+            # The sessions waiting for their floor keep their requests in order behind the held ones
+            ready = []
+            for request in requests:
+                session = self.sessions.get(request[0])
+                if session is not None and session.waiting_floor is not None:
+                    self._held[session.waiting_floor].append(request)
+                else:
+                    ready.append(request)
+            try:
+                results = self.process_batch([(session_id, data) for session_id, data, _ in ready], hold=True)
+            except Exception as error:
+                results = [error] * len(ready)
+            for request, result in zip(ready, results):
+                future = request[2]
+                if result is None:
+                    self._hold(self.sessions[request[0]].waiting_floor, request)
+                    continue
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+            self._drop_idle()
+
+    def _hold(self, floor, request):
+        """Holds back a request until the assets of its floor are loaded, which starts their loading"""
+        if floor not in self._held:
+            self._held[floor] = []
+            loading = asyncio.get_running_loop().run_in_executor(None, self.assets.get, *floor)
+            loading.add_done_callback(lambda loading: self._floor_loaded(floor, loading))
+        self._held[floor].append(request)
+
+    def _floor_loaded(self, floor, loading):
+        """Queues the held requests of a floor again in front of the others, or fails them when it did not load"""
+        held = self._held.pop(floor, [])
+        for session in self.sessions.values():
+            if session.waiting_floor == floor:
+                session.waiting_floor = None
+        error = loading.exception() if not loading.cancelled() else asyncio.CancelledError()
+        if error is not None:
+            for _, _, future in held:
+                if not future.done():
+                    future.set_exception(error)
+            return
+        self._pending[:0] = held
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    @instrumentation.instrumented("service_batch", fields=lambda results, self, requests: {"requests": len(requests)})
+    def process_batch(self, requests, hold=False):
+        """Computes a batch of requests at once
+
+        Args:
+            requests (list(tuple(str, bytes))): Session id and complete trace lines of each request
+            hold (bool, optional): Whether the sessions whose floor is known but not loaded are held back
+            instead of loading it, see run_batches. Defaults to False.
+
+        Returns:
+            list(dict): Result of each request: its session, floor, the tss and position of the steps detected
+            in its session by the batch, whether the positions are absolute (tracked by a particle filter on the
+            floor) or relative to the start of the session (only PDR), and the total number of steps of the
+            session. The requests of a session which failed get the exception instead, and its state is left as
+            it was before the batch. The requests of a held session get None, and its waiting_floor is set.
+        """
+        # The lines of the requests of a same session are computed together, in their order
+        session_data = {}
+        for session_id, data in requests:
+            session_data.setdefault(session_id, []).append(data if data.endswith(b"\n") or not data else data + b"\n")
+        sessions = [self.sessions.setdefault(session_id, Session(session_id)) for session_id in session_data]
+        buffers = [b"".join(session_data[session.session_id]) for session in sessions]
+        try:
+            parsed = data_parser.parse_buffers(buffers)
+        except Exception:
+            # The buffers are parsed one by one to find those which cannot be, which only fail their own session
+            parsed = []
+            for buffer in buffers:
+                try:
+                    parsed.append(data_parser.parse_buffers([buffer])[0])
+                except Exception as error:
+                    parsed.append(error)
+
+        results = {session.session_id: error for session, error in zip(sessions, parsed)
+                   if isinstance(error, Exception)}
+        valid = [(session, session_parsed) for session, session_parsed in zip(sessions, parsed)
+                 if not isinstance(session_parsed, Exception)]
+        if hold:
+            for session, (headers, _) in valid:
+                floor = self._floor(session, headers)
+                if floor is not None and not self.assets.is_loaded(*floor):
+                    # The lines are parsed again once the floor is loaded, the state of the session is untouched
+                    session.waiting_floor = floor
+                    results[session.session_id] = None
+            valid = [(session, session_parsed) for session, session_parsed in valid if session.waiting_floor is None]
+        snapshots = [session.snapshot() for session, _ in valid]
+        try:
+            results.update(self._compute(valid))
+        except Exception:
+            # The sessions are brought back to their state before the batch, and computed one by one, so that
+            # only the sessions which fail on their own get the exception
+            for (session, _), snapshot in zip(valid, snapshots):
+                session.restore(snapshot)
+            for (session, session_parsed), snapshot in zip(valid, snapshots):
+                try:
+                    results.update(self._compute([(session, session_parsed)]))
+                except Exception as error:
+                    session.restore(snapshot)
+                    results[session.session_id] = error
+
+        # The held requests are counted once they are computed
+        computed = [data for session_id, data in requests if results[session_id] is not None]
+        if computed:
+            self.counters["requests"] += len(computed)
+            self.counters["batches"] += 1
+            self.counters["lines"] += sum(data.count(b"\n") for data in computed)
+        return [results[session_id] for session_id, _ in requests]
+
+    def _compute(self, sessions_parsed):
+        """Computes the parsed lines of sessions at once
+
+        Args:
+            sessions_parsed (list(tuple(Session, tuple))): Each session and the header lines and records parsed
+            from its requests
+
+        Returns:
+            dict: Result of each session id, see process_batch
+        """
+        sessions = [session for session, _ in sessions_parsed]
+        now = time.monotonic()
+        records = []
+        for session, (headers, session_records) in sessions_parsed:
+            session.last_seen = now
+            self._start(session, headers, session_records)
+            records.append(session_records)
+
+        acc_chunks = [session_records["acc_calib"] if "acc_calib" in session_records else
+                      data_parser.SensorsXYZ(tss=np.empty(0, dtype=np.int64), xyz=np.empty((0, 3), dtype=np.float32))
+                      for session_records in records]
+        step_tss, step_lengths = self._detect_steps(sessions, acc_chunks)
+        step_headings = self._step_headings(sessions, records, step_tss)
+        measurements = [self._scan_positions(session, session_records)
+                        for session, session_records in zip(sessions, records)]
+        step_positions = self._track(sessions, step_tss, step_lengths, step_headings, measurements)
+
+        self.counters["steps"] += sum(tss.shape[0] for tss in step_tss)
+        results = {}
+        for session, tss, positions in zip(sessions, step_tss, step_positions):
+            results[session.session_id] = {
+                "session": session.session_id,
+                "floor": None if session.assets is None else session.assets.floor_name,
+                "absolute": session.particle_filter is not None,
+                "steps": [[int(ts), float(x), float(y)] for ts, (x, y) in zip(tss, positions)],
+                "n_steps": session.n_steps}
+        return results
+
+    def _floor(self, session, headers):
+        """Site id and floor name of a session without assets yet, once its header lines give them"""
+        if session.assets is not None:
+            return None
+        metadata = dict(session.metadata)
+        for header in headers:
+            data_parser._parse_metadata(header, metadata)
+        if "site_id" not in metadata or "floor_name" not in metadata:
+            return None
+        return metadata["site_id"], metadata["floor_name"]
+
+    def _start(self, session, headers, session_records):
+        """Reads the header lines of a session, and loads the assets of its floor once they are known"""
+        for header in headers:
+            data_parser._parse_metadata(header, session.metadata)
+        if session.assets is None and "site_id" in session.metadata and "floor_name" in session.metadata:
+            session.assets = self.assets.get(session.metadata["site_id"], session.metadata["floor_name"])
+        if session.start_position is None and "waypoint" in session_records:
+            session.start_position = session_records["waypoint"].xy[0].astype("float64")
+
+    def _detect_steps(self, sessions, acc_chunks):
+        """Filters the accelerometer chunks of the sessions and detects their steps, all sessions at once
+
+        The steps are the peaks of the filtered magnitude above its running mean, at least MIN_STEP_INTERVAL
+        ms after the previous peak or step of the session, as in pdr.pdr_arrays. A sample is only decided once
+        the next one arrives, so the last sample of each request is decided by the next request. The causal
+        filter delays the peaks, so the timestamps of the steps are moved back by the group delay of the filter
+        at STEP_DELAY_FREQ.
+
+        Returns:
+            (list(np.array), list(np.array)): Timestamps and Weinberg lengths of the steps of each session
+        """
+        magnitudes = [np.linalg.norm(chunk.xyz, axis=1) for chunk in acc_chunks]
+        filtered, states = data_processing.filter_chunks(magnitudes, [session.filter_state for session in sessions])
+
+        # Concatenation of the undecided tail and the new samples of every session
+        values = np.concatenate([np.concatenate([session.tail_values, chunk])
+                                 for session, chunk in zip(sessions, filtered)] + [np.empty(0)])
+        tss = np.concatenate([np.concatenate([session.tail_tss, chunk.tss.astype("float64")])
+                              for session, chunk in zip(sessions, acc_chunks)] + [np.empty(0)])
+        lengths = np.array([session.tail_values.shape[0] + chunk.shape[0]
+                            for session, chunk in zip(sessions, filtered)], dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        sample_session = np.repeat(np.arange(len(sessions)), lengths)
+
+        for session, chunk, state in zip(sessions, filtered, states):
+            session.filter_state = state
+            session.acc_sum += chunk.sum()
+            session.acc_count += chunk.shape[0]
+        thresholds = np.array([session.acc_sum / max(session.acc_count, 1) for session in sessions])
+
+        # Peaks among the samples whose both neighbours are known
+        candidate = np.zeros(values.shape[0], dtype=bool)
+        interior = np.ones(values.shape[0], dtype=bool)
+        interior[offsets[:-1][lengths > 0]] = False
+        interior[(offsets[1:] - 1)[lengths > 0]] = False
+        inner = np.flatnonzero(interior)
+        candidate[inner] = (values[inner] > values[inner - 1]) & (values[inner] >= values[inner + 1]) & \
+            (values[inner] > thresholds[sample_session[inner]])
+        peaks = np.flatnonzero(candidate)
+        peak_session = sample_session[peaks]
+        first_peak = np.ones(peaks.shape[0], dtype=bool)
+        first_peak[1:] = peak_session[1:] != peak_session[:-1]
+        previous_tss = np.where(first_peak, np.array([session.last_step_tss for session in sessions])[peak_session],
+                                np.concatenate([[-np.inf], tss[peaks[:-1]]]))
+        steps = peaks[tss[peaks] - previous_tss >= MIN_STEP_INTERVAL]
+        step_session = sample_session[steps]
+        n_steps = np.bincount(step_session, minlength=len(sessions))
+
+        # Extremes since the previous step, the first step of a session adds those carried by the session
+        first_step = np.ones(steps.shape[0], dtype=bool)
+        first_step[1:] = step_session[1:] != step_session[:-1]
+        window_start = np.where(first_step, offsets[:-1][step_session], np.concatenate([[0], steps[:-1]]))
+        bounds = np.stack([window_start, steps + 1], axis=1).reshape(-1)
+        window_max = np.maximum.reduceat(values, bounds)[::2] if steps.shape[0] else np.empty(0)
+        window_min = np.minimum.reduceat(values, bounds)[::2] if steps.shape[0] else np.empty(0)
+        carried_max = np.array([session.window_max for session in sessions])
+        carried_min = np.array([session.window_min for session in sessions])
+        window_max[first_step] = np.maximum(window_max[first_step], carried_max[step_session[first_step]])
+        window_min[first_step] = np.minimum(window_min[first_step], carried_min[step_session[first_step]])
+        step_lengths = WEINBERG_K * np.power(np.clip(window_max - window_min, 0, None), 0.25)
+
+        step_bounds = np.concatenate([[0], np.cumsum(n_steps)])
+        session_step_tss, session_step_lengths = [], []
+        for session_ix, session in enumerate(sessions):
+            start, end = offsets[session_ix], offsets[session_ix + 1]
+            session_steps = steps[step_bounds[session_ix]:step_bounds[session_ix + 1]]
+            session_step_tss.append(np.round(tss[session_steps] - self.step_delay).astype(np.int64))
+            session_step_lengths.append(step_lengths[step_bounds[session_ix]:step_bounds[session_ix + 1]])
+            if session_steps.shape[0]:
+                session.last_step_tss = tss[session_steps[-1]]
+                window = values[session_steps[-1]:end]
+            else:
+                window = np.concatenate([values[start:end], [session.window_min, session.window_max]])
+            if window.shape[0]:
+                session.window_min, session.window_max = window.min(), window.max()
+            session.tail_values, session.tail_tss = values[max(end - 2, start):end], tss[max(end - 2, start):end]
+            session.n_steps += session_steps.shape[0]
+        return session_step_tss, session_step_lengths
+
+    def _step_headings(self, sessions, records, step_tss):
+        """Heading of each step, from the last rotation vector of its session at or before it"""
+        rotation_vectors = [session_records.get("rotation_vector") for session_records in records]
+        rv_session = np.concatenate([np.full(len(rv), session_ix) for session_ix, rv in enumerate(rotation_vectors)
+                                     if rv is not None] + [np.empty(0, dtype=np.int64)]).astype(np.int64)
+        rv_tss = np.concatenate([rv.tss for rv in rotation_vectors if rv is not None] + [np.empty(0, dtype=np.int64)])
+        rv_heading = pdr.rotation_vector_heading(np.concatenate(
+            [rv.xyz for rv in rotation_vectors if rv is not None] + [np.empty((0, 3), dtype=np.float32)]))
+
+        order = np.lexsort((rv_tss, rv_session))
+        rv_session, rv_tss, rv_heading = rv_session[order], rv_tss[order], rv_heading[order]
+        step_session = np.repeat(np.arange(len(sessions)), [tss.shape[0] for tss in step_tss])
+
+        # The rotation vectors and the steps sorted together by (session, tss), the rotation vectors before the
+        # steps at their timestamp. The indices of the sorted rotation vectors increase along this order, so the
+        # last rotation vector at or before each step is their running maximum
+        n_rv = rv_tss.shape[0]
+        is_step = np.concatenate([np.zeros(n_rv, dtype=bool), np.ones(step_session.shape[0], dtype=bool)])
+        merged = np.lexsort((is_step, np.concatenate([rv_tss] + step_tss + [np.empty(0, dtype=np.int64)]),
+                             np.concatenate([rv_session, step_session])))
+        last_rv = np.maximum.accumulate(np.where(is_step[merged], -1, merged)) if merged.shape[0] else merged
+        found = np.empty(step_session.shape[0], dtype=np.int64)
+        found[merged[is_step[merged]] - n_rv] = last_rv[is_step[merged]]
+        own = found >= 0
+        own[own] = rv_session[found[own]] == step_session[own]
+        # Steps before the first rotation vector of their session in the batch keep the heading it carries
+        headings = np.array([session.heading for session in sessions])[step_session]
+        headings[own] = rv_heading[found[own]]
+
+        for rv_ix in np.flatnonzero(np.append(rv_session[1:] != rv_session[:-1], True))[:rv_session.shape[0]]:
+            sessions[rv_session[rv_ix]].heading = rv_heading[rv_ix]
+        return np.split(headings, np.cumsum([tss.shape[0] for tss in step_tss])[:-1])
+
+    def _scan_positions(self, session, session_records):
+        """Fingerprint positions of the WiFi scans of a session completed by this request
+
+        The readings of the last scan of the request are kept until a later scan starts, since the scan may
+        continue in the next request.
+
+        Returns:
+            (np.array, np.array): Timestamp of each completed scan and its (scans, 2) position
+        """
+        wifi = session_records.get("wifi")
+        if wifi is not None:
+            session.scan_tss = np.concatenate([session.scan_tss, np.asarray(wifi.tss, dtype=np.int64)])
+            session.scan_bssids = np.concatenate([session.scan_bssids,
+                                                  np.asarray(wifi.bssid_names, dtype=object)[wifi.bssid]])
+            session.scan_rssi = np.concatenate([session.scan_rssi, np.asarray(wifi.rssi, dtype=np.float32)])
+        if not session.scan_tss.shape[0]:
+            return np.empty(0, dtype=np.int64), np.empty((0, 2))
+
+        scan_tss, scan_rows = np.unique(session.scan_tss, return_inverse=True)
+        scan_rows = scan_rows.reshape(-1)
+        completed = scan_rows < scan_tss.shape[0] - 1
+        positions = np.empty((scan_tss.shape[0] - 1, 2))
+        if session.assets is not None and session.assets.fingerprint_db is not None:
+            for scan_ix in range(scan_tss.shape[0] - 1):
+                readings = scan_rows == scan_ix
+                positions[scan_ix] = session.assets.fingerprint_db.knn(session.scan_bssids[readings],
+                                                                       session.scan_rssi[readings], k=self.k)[0]
+        else:
+            positions[:] = np.nan
+        session.scan_tss = session.scan_tss[~completed]
+        session.scan_bssids = session.scan_bssids[~completed]
+        session.scan_rssi = session.scan_rssi[~completed]
+        return scan_tss[:-1], positions
+
+    def _track(self, sessions, step_tss, step_lengths, step_headings, measurements):
+        """Moves the particle filters of the sessions by their steps, the filters of a floor all at once, and
+        corrects them with the WiFi positions
+
+        Returns:
+            list(np.array): (steps, 2) position of the session after each of its steps
+        """
+        for session in sessions:
+            if session.particle_filter is None and session.assets is not None:
+                session.particle_filter = ParticleFilter(session.assets.grid, n_particles=self.n_particles)
+                session.particle_filter.rng = self.rng
+                session.particle_filter.initialize(center=session.start_position)
+                session.position = session.particle_filter.estimate()
+
+        positions = [np.empty((tss.shape[0], 2)) for tss in step_tss]
+        first_measurement = [0] * len(sessions)
+        for step_ix in range(max((tss.shape[0] for tss in step_tss), default=0)):
+            moving = [session_ix for session_ix, tss in enumerate(step_tss) if tss.shape[0] > step_ix]
+            # Filters without a known heading yet do not move
+            tracked = [session_ix for session_ix in moving if sessions[session_ix].particle_filter is not None and
+                       not np.isnan(step_headings[session_ix][step_ix])]
+            for grid in {id(sessions[session_ix].assets.grid): sessions[session_ix].assets.grid
+                         for session_ix in tracked}.values():
+                floor_sessions = [session_ix for session_ix in tracked if sessions[session_ix].assets.grid is grid]
+                predict_batch([sessions[session_ix].particle_filter for session_ix in floor_sessions],
+                              [step_lengths[session_ix][step_ix] for session_ix in floor_sessions],
+                              [step_headings[session_ix][step_ix] for session_ix in floor_sessions], rng=self.rng)
+
+            for session_ix in moving:
+                session = sessions[session_ix]
+                if session.particle_filter is None:
+                    heading = step_headings[session_ix][step_ix]
+                    if not np.isnan(heading):
+                        session.position = session.position + step_lengths[session_ix][step_ix] * \
+                            np.array([np.sin(heading), np.cos(heading)])
+                else:
+                    first_measurement[session_ix] = self._correct(session, measurements[session_ix],
+                                                                  first_measurement[session_ix],
+                                                                  step_tss[session_ix][step_ix])
+                positions[session_ix][step_ix] = session.position
+
+        # The measurements after the last step of the batch
+        for session_ix, session in enumerate(sessions):
+            if session.particle_filter is not None:
+                self._correct(session, measurements[session_ix], first_measurement[session_ix], np.inf)
+        return positions
+
+    def _correct(self, session, measurements, first_measurement, until_tss):
+        """Applies the measurements of a session up to a timestamp, resamples and updates its position
+
+        Returns:
+            int: Index of the first measurement not applied
+        """
+        measurement_tss, measurement_positions = measurements
+        last_measurement = np.searchsorted(measurement_tss, until_tss, side="right")
+        for measurement_ix in range(first_measurement, last_measurement):
+            session.particle_filter.update(measurement_positions[measurement_ix], sigma=self.sigma)
+        if session.particle_filter.effective_size() < 0.5 * self.n_particles:
+            session.particle_filter.resample()
+        session.position = session.particle_filter.estimate()
+        return last_measurement
+
+    def _drop_idle(self):
+        now = time.monotonic()
+        for session_id in [session_id for session_id, session in self.sessions.items()
+                           if now - session.last_seen > self.idle_timeout]:
+            del self.sessions[session_id]
+
+    async def handle_connection(self, reader, writer):
+        """Serves the HTTP/1.1 requests of a connection, which is kept alive unless the client closes it"""
+        try:
+            while True:
+                request = await _read_message(reader)
+                if request is None:
+                    break
+                start_line, headers, body = request
+                keep_alive = headers.get("connection", "").lower() != "close"
+                try:
+                    method, path, _ = start_line.split(" ", 2)
+                    status, payload = await self._route(method, path, body)
+                except ValueError as error:
+                    status, payload = 400, {"error": str(error)}
+                except Exception as error:
+                    status, payload = 500, {"error": "{}: {}".format(type(error).__name__, error)}
+                writer.write(_http_message("HTTP/1.1 {} {}".format(status, HTTP_REASONS[status]), payload, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except _BodyTooLarge:
+            writer.write(_http_message("HTTP/1.1 413 {}".format(HTTP_REASONS[413]),
+                                       {"error": "Bodies are limited to {} bytes".format(MAX_BODY_BYTES)}, False))
+        except ValueError as error:
+            # A message which could not be read leaves the stream out of step, so the connection is closed
+            writer.write(_http_message("HTTP/1.1 400 {}".format(HTTP_REASONS[400]), {"error": str(error)}, False))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _route(self, method, path, body):
+        parts = path.strip("/").split("/")
+        if parts == ["stats"]:
+            if method != "GET":
+                return 405, {"error": "Use GET on /stats"}
+            return 200, self.stats()
+        if len(parts) != 2 or parts[0] != "sessions" or not parts[1]:
+            return 404, {"error": "{} is not a valid path".format(path)}
+        if method == "POST":
+            return 200, await self.submit(parts[1], body)
+        if method == "DELETE":
+            return 200, {"session": parts[1], "closed": self.close_session(parts[1])}
+        return 405, {"error": "Use POST or DELETE on /sessions/<session id>"}
+
+    async def serve(self, host="127.0.0.1", port=8080, ready=None):
+        """Serves the HTTP endpoint until cancelled
+
+        Args:
+            host (str, optional): Interface to listen on. Defaults to "127.0.0.1".
+            port (int, optional): Port to listen on. Defaults to 8080.
+            ready (function, optional): Called once the server listens. Defaults to None.
+        """
+        # A first batch imports the lazily imported dependencies and designs the filter before any request
+        self.process_batch([("warm-up", b"")])
+        self.close_session("warm-up")
+        batches = asyncio.ensure_future(self.run_batches())
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        if ready is not None:
+            ready()
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batches.cancel()
+
+
+class _BodyTooLarge(Exception):
+    pass
+
+
+async def _read_message(reader):
+    """Start line, lowercase headers and body of the next HTTP/1.1 message, None at the end of the stream
+
+    Raises:
+        ValueError: When a line exceeds the limit of the reader or the Content-Length is not valid
+    """
+    start_line = await reader.readline()
+    if not start_line:
+        return None
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    length = headers.get("content-length", "0")
+    if not length.isdigit():
+        raise ValueError(
+            "{} is not a valid Content-Length.".format(length))
+    length = int(length)
+    if length > MAX_BODY_BYTES:
+        raise _BodyTooLarge()
+    body = await reader.readexactly(length) if length else b""
+    return start_line.decode("latin-1").strip(), headers, body
+
+
+def _http_message(start_line, payload, keep_alive=True, content_type="application/json"):
+    body = payload if isinstance(payload, bytes) else json.dumps(payload).encode("utf-8")
+    return "{}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: {}\r\n\r\n".format(
+        start_line, content_type, len(body), "keep-alive" if keep_alive else "close").encode("latin-1") + body
+
+
+async def _request(reader, writer, method, path, body=b""):
+    """Sends a request over a kept-alive connection, and returns the status and JSON payload of its response"""
+    writer.write(_http_message("{} {} HTTP/1.1".format(method, path), body, content_type="text/plain"))
+    await writer.drain()
+    response = await _read_message(reader)
+    if response is None:
+        raise ConnectionError("The service closed the connection")
+    start_line, _, response_body = response
+    return int(start_line.split(" ")[1]), json.loads(response_body) if response_body else None
+
+
+def trace_chunks(trace_filename, interval=1.0):
+    """Lines of a tracing file grouped by windows of its timestamps, as a phone would send them
+
+    Args:
+        trace_filename (str): Tracing file recorded for the XYZ2020 competition
+        interval (float, optional): Length of the windows in seconds. Defaults to 1.0.
+
+    Returns:
+        list(tuple(float, str)): Seconds since the first record at which each window ends, and its lines. The
+        header lines are sent with the first window and the closing ones with the last window
+    """
+    with open(trace_filename, encoding="utf-8") as f:
+        lines = f.read().splitlines()
+    n_header = next((ix for ix, line in enumerate(lines) if line and not line.startswith("#")), len(lines))
+    body = [line for line in lines[n_header:] if line and not line.startswith("#")]
+    footer = [line for line in lines[n_header:] if line.startswith("#")]
+    if not body:
+        return [(0.0, "\n".join(lines))]
+
+    tss = np.array([int(line.split("\t", 1)[0]) for line in body], dtype=np.int64)
+    window = (tss - tss[0]) // int(interval * 1000)
+    bounds = np.concatenate([[0], np.flatnonzero(np.diff(window)) + 1, [len(body)]])
+    chunks = []
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        chunk_lines = (lines[:n_header] if start == 0 else []) + body[start:end] + (footer if end == len(body) else [])
+        chunks.append((float(window[start] + 1) * interval, "\n".join(chunk_lines)))
+    return chunks
+
+
+async def _replay(host, port, session_id, chunks, speed, start_delay, latencies, lags):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        await asyncio.sleep(start_delay)
+        start = time.perf_counter()
+        for end_time, chunk in chunks:
+            # A window is sent once it is over, at speed times real time
+            lag = time.perf_counter() - start - end_time / speed
+            if lag < 0:
+                await asyncio.sleep(-lag)
+            lags.append(max(lag, 0.0))
+            sent = time.perf_counter()
+            status, _ = await _request(reader, writer, "POST", "/sessions/" + session_id, chunk.encode("utf-8"))
+            if status != 200:
+                raise ConnectionError("The service answered {} to session {}".format(status, session_id))
+            latencies.append(time.perf_counter() - sent)
+        await _request(reader, writer, "DELETE", "/sessions/" + session_id)
+    finally:
+        writer.close()
+
+
+async def _stats(host, port):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        return (await _request(reader, writer, "GET", "/stats"))[1]
+    finally:
+        writer.close()
+
+
+async def run_load(root, host="127.0.0.1", port=8080, n_sessions=10, speed=1.0, interval=1.0, seed=0):
+    """Replays the tracing files under root against a running service, as n_sessions concurrent phones
+
+    Args:
+        root (str): Venue, floor or dataset folder, its traces are replayed in turn by the sessions
+        host (str, optional): Host of the service. Defaults to "127.0.0.1".
+        port (int, optional): Port of the service. Defaults to 8080.
+        n_sessions (int, optional): Number of concurrent sessions. Defaults to 10.
+        speed (float, optional): Replay speed, in times real time. Defaults to 1.0.
+        interval (float, optional): Seconds of trace sent per request. Defaults to 1.0.
+        seed (int, optional): Seed of the start offsets of the sessions. Defaults to 0.
+
+    Raises:
+        ValueError: When there are no traces under root, or a not valid speed is input
+
+    Returns:
+        dict: Request latency percentiles in ms, send lag, trace seconds replayed, CPU seconds of the service
+        and the real-time sessions per core it sustained
+    """
+    traces = data_parser.find_traces(root)
+    if not traces:
+        raise ValueError(
+            "{} is not a valid folder of tracing files.".format(root))
+    if speed <= 0:
+        raise ValueError(
+            "{} is not a valid replay speed.".format(speed))
+
+    chunks = {trace_filename: trace_chunks(trace_filename, interval) for trace_filename in traces}
+    rng = np.random.default_rng(seed)
+    latencies, lags = [], []
+    stats_before = await _stats(host, port)
+    start = time.perf_counter()
+    # The sessions start at random offsets within a request interval, so that they do not send in lockstep
+    await asyncio.gather(*[_replay(host, port, "load-{}-{}".format(os.getpid(), session_ix),
+                                   chunks[traces[session_ix % len(traces)]], speed,
+                                   rng.uniform(0, interval / speed), latencies, lags)
+                           for session_ix in range(n_sessions)])
+    wall = time.perf_counter() - start
+    stats_after = await _stats(host, port)
+
+    trace_seconds = sum(chunks[traces[session_ix % len(traces)]][-1][0] for session_ix in range(n_sessions))
+    cpu = stats_after["cpu_s"] - stats_before["cpu_s"]
+    latencies_ms = np.array(latencies) * 1000
+    return {"sessions": n_sessions, "speed": speed, "requests": len(latencies), "wall_s": wall,
+            "p50_ms": float(np.percentile(latencies_ms, 50)), "p99_ms": float(np.percentile(latencies_ms, 99)),
+            "max_ms": float(latencies_ms.max()), "p99_lag_ms": float(np.percentile(lags, 99) * 1000),
+            "mean_batch": (stats_after["requests"] - stats_before["requests"]) /
+            max(stats_after["batches"] - stats_before["batches"], 1),
+            "trace_s": trace_seconds, "service_cpu_s": cpu,
+            "realtime_sessions_per_core": trace_seconds / cpu if cpu > 0 else float("inf")}
+
+
+def _wait_for_port(host, port, process, timeout=120.0):
+    import socket
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("The service exited with code {}".format(process.returncode))
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("The service did not start listening within {} s".format(timeout))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Localization service for streamed traces, and its load "
+                                     "generator")
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve = commands.add_parser("serve", help="Runs the service")
+    load = commands.add_parser("load", help="Replays the traces of a folder against the service")
+    for command in [serve, load]:
+        command.add_argument("--host", default="127.0.0.1", help="Interface of the service")
+        command.add_argument("--port", type=int, default=8080, help="Port of the service")
+    serve.add_argument("--dataset-dir", default="./dataset", help="Folder of the site folders")
+    serve.add_argument("--metadata-dir", default="./dataset/metadata/", help="Folder of the floor metadata")
+    serve.add_argument("--cache-dir", default="./output/service/", help="Folder of the saved floor assets")
+    serve.add_argument("--preload", default=None, help="Venue or dataset folder whose floors are loaded first")
+    serve.add_argument("--no-wifi", action="store_true", help="Do not use the WiFi fingerprints")
+    serve.add_argument("--particles", type=int, default=1000, help="Particles of each session")
+    serve.add_argument("--batch-window", type=float, default=0.005, help="Seconds a batch waits for requests")
+    serve.add_argument("--max-batch", type=int, default=256, help="Maximum number of requests of a batch")
+    load.add_argument("root", help="Venue, floor or dataset folder of the replayed traces")
+    load.add_argument("--sessions", type=int, default=10, help="Number of concurrent sessions")
+    load.add_argument("--speed", type=float, default=1.0, help="Replay speed, in times real time")
+    load.add_argument("--interval", type=float, default=1.0, help="Seconds of trace sent per request")
+    load.add_argument("--spawn", action="store_true", help="Start a service for the run, preloaded with root")
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        assets = AssetStore(args.dataset_dir, args.metadata_dir, args.cache_dir, wifi=not args.no_wifi)
+        if args.preload is not None:
+            print("{} floors loaded".format(assets.preload(args.preload)), flush=True)
+        service = LocalizationService(assets, n_particles=args.particles, batch_window=args.batch_window,
+                                      max_batch=args.max_batch)
+        try:
+            asyncio.run(service.serve(args.host, args.port, ready=lambda: print(
+                "Serving on {}:{}".format(args.host, args.port), flush=True)))
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    process = None
+    if args.spawn:
+        process = subprocess.Popen([sys.executable, "-m", "indoor_positioning.service", "serve", "--host", args.host,
+                                    "--port", str(args.port), "--preload", args.root])
+        _wait_for_port(args.host, args.port, process)
+    try:
+        summary = asyncio.run(run_load(args.root, args.host, args.port, n_sessions=args.sessions, speed=args.speed,
+                                       interval=args.interval))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+    print("{sessions} sessions at {speed:g}x, {requests} requests in {wall_s:.1f} s: p50 {p50_ms:.1f} ms, "
+          "p99 {p99_ms:.1f} ms, max {max_ms:.1f} ms, p99 send lag {p99_lag_ms:.1f} ms, {mean_batch:.1f} requests "
+          "per batch".format(**summary))
+    print("{trace_s:.0f} s of traces in {service_cpu_s:.2f} CPU s of the service: {realtime_sessions_per_core:.0f} "
+          "real-time sessions per core".format(**summary))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
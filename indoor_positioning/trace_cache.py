@@ -0,0 +1,331 @@
+"""On-disk cache of parsed tracing files, and the parse-only entry point which fills it
+
+Filling the cache only imports the parser and numpy, so its workers start fast and stay small, and the
+processing (indoor_positioning.batch) and visualization (indoor_positioning.report) entry points then read the
+traces from the cache with --cache-dir.
+
+Usage:
+    python -m indoor_positioning.trace_cache ROOT [--cache-dir DIR] [--workers N] [--chunksize K]
+                                                  [--max-bytes B]
+"""
+from indoor_positioning.data_parser import SENSOR_TYPES, METADATA_NAMES, TraceData, find_traces, tracing_parser
+from contextlib import contextmanager
+from dataclasses import fields
+from multiprocessing import Pool
+from pathlib import Path
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, where the size of the cache is updated without locking it between processes
+    fcntl = None
+
+
+# Columnar class of each TraceData sensor field
+_SENSOR_COLUMNS = {sensor_type["name"]: sensor_type["columns"] for sensor_type in SENSOR_TYPES.values()}
+
+# Total size of the entries, kept up to date by every write and eviction, and the lock of its updates
+SIZE_FILE = "size"
+LOCK_FILE = "lock"
+
+# Version of the layout of the entries, part of their keys so that the entries of an older layout are parsed again
+ENTRY_FORMAT = 2
+
+# Fraction of max_bytes down to which the entries are evicted once the cache exceeds max_bytes
+LOW_WATER = 0.8
+
+
+class TraceCache:
+    """On-disk cache of parsed tracing files
+
+    Each entry is a folder with one .npy file per array of the TraceData sensors, which are loaded with
+    memory mapping, plus a meta.json with the trace metadata. Entries are keyed by the absolute path, size
+    and mtime of the tracing file, so an edited trace is parsed again. The total size of the entries is kept in
+    a file updated by each write, and once it exceeds max_bytes, the least recently used entries are evicted
+    down to LOW_WATER * max_bytes, so the entries are only listed once in a while.
+    """
+
+    def __init__(self, cache_dir, max_bytes=1024 ** 3, engine="bulk"):
+        """
+        Args:
+            cache_dir (str): Folder where the cache entries are kept, it is created if needed
+            max_bytes (int, optional): Maximum total size of the cache entries, None for no maximum.
+            Defaults to 1 GiB.
+            engine (str, optional): tracing_parser engine used on cache misses. Defaults to "bulk".
+        """
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.engine = engine
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, trace_filename):
+        """Cache key of a tracing file
+
+        Args:
+            trace_filename (str): Tracing file
+
+        Returns:
+            str: Hex digest of the absolute path, size and mtime of the file, and of ENTRY_FORMAT
+        """
+        stat = os.stat(trace_filename)
+        identity = "{}\t{}\t{}\t{}".format(os.path.abspath(trace_filename), stat.st_size, stat.st_mtime_ns,
+                                          ENTRY_FORMAT)
+        return hashlib.sha1(identity.encode("utf-8")).hexdigest()
+
+    def load(self, trace_filename):
+        """Parsed data of a tracing file, from the cache if it holds an up to date entry of it
+
+        Args:
+            trace_filename (str): Tracing file recorded for the XYZ2020 competition
+
+        Returns:
+            TraceData: Parsed trace, the arrays of cache hits are read-only memory maps
+        """
+        entry_dir = self.cache_dir / self.key(trace_filename)
+        if (entry_dir / "meta.json").exists():
+            try:
+                # The mtime of meta.json keeps the last use of the entry for the eviction
+                os.utime(entry_dir / "meta.json")
+                trace_data = self._read_entry(entry_dir, trace_filename)
+                self.hits += 1
+                return trace_data
+            except FileNotFoundError:
+                # The entry was evicted by another process meanwhile
+                pass
+
+        self.misses += 1
+        trace_data = tracing_parser(trace_filename, engine=self.engine)
+        total_bytes = self._write_entry(entry_dir, trace_data)
+        if self.max_bytes is not None and total_bytes > self.max_bytes:
+            self.evict()
+        return trace_data
+
+    def size(self):
+        """Total size of the entries of the cache, as kept in its size file
+
+        Returns:
+            int: Size in bytes
+        """
+        return self._add_bytes(0)
+
+    def evict(self):
+        """Removes the least recently used entries down to LOW_WATER * max_bytes when the cache exceeds max_bytes,
+        and stores the size of the remaining entries
+
+        Returns:
+            int: Number of evicted entries
+        """
+        with self._lock():
+            entries = self._entries()
+            total_bytes = sum(size for _, size, _ in entries)
+            n_evicted = 0
+            if self.max_bytes is not None and total_bytes > self.max_bytes:
+                for _, size, entry_dir in sorted(entries, key=lambda entry: entry[0]):
+                    if total_bytes <= LOW_WATER * self.max_bytes:
+                        break
+                    self._remove_entry(entry_dir)
+                    total_bytes -= size
+                    n_evicted += 1
+            self._write_size(total_bytes)
+        return n_evicted
+
+    def clear(self):
+        """Removes every entry of the cache and resets the hit/miss counters"""
+        with self._lock():
+            for entry_dir in self.cache_dir.iterdir():
+                if entry_dir.is_dir():
+                    self._remove_entry(entry_dir)
+            self._write_size(0)
+        self.hits = 0
+        self.misses = 0
+
+    def _entries(self):
+        """Last use, size and folder of every entry, without the ones being written or removed"""
+        entries = []
+        for entry_dir in self.cache_dir.iterdir():
+            meta_file = entry_dir / "meta.json"
+            if "." not in entry_dir.name and entry_dir.is_dir() and meta_file.exists():
+                size = sum(file.stat().st_size for file in entry_dir.iterdir())
+                entries.append((meta_file.stat().st_mtime, size, entry_dir))
+        return entries
+
+    def _remove_entry(self, entry_dir):
+        # The entry is renamed before its removal, so that it is never read partially removed
+        removed_dir = entry_dir.with_name(entry_dir.name + ".removed{}".format(os.getpid()))
+        try:
+            os.replace(entry_dir, removed_dir)
+        except OSError:
+            return
+        shutil.rmtree(removed_dir, ignore_errors=True)
+
+    @contextmanager
+    def _lock(self):
+        with open(self.cache_dir / LOCK_FILE, "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def _add_bytes(self, n_bytes):
+        """Adds n_bytes to the size file, which is computed from the entries when missing, and returns the total"""
+        with self._lock():
+            return self._update_size(n_bytes)
+
+    def _update_size(self, n_bytes):
+        """_add_bytes, the lock being held"""
+        try:
+            total_bytes = int((self.cache_dir / SIZE_FILE).read_text()) + n_bytes
+        except (FileNotFoundError, ValueError):
+            # The written entry is already among the listed ones
+            total_bytes = sum(size for _, size, _ in self._entries())
+        if n_bytes or not (self.cache_dir / SIZE_FILE).exists():
+            self._write_size(total_bytes)
+        return total_bytes
+
+    def _write_size(self, total_bytes):
+        size_file = self.cache_dir / SIZE_FILE
+        tmp_file = size_file.with_name(SIZE_FILE + ".tmp{}".format(os.getpid()))
+        tmp_file.write_text(str(total_bytes))
+        os.replace(tmp_file, size_file)
+
+    def _write_entry(self, entry_dir, trace_data):
+        """Writes the entry of a trace and adds its size to the size file, unless another process wrote it first
+
+        Returns:
+            int: Total size of the entries of the cache in bytes
+        """
+        # The entry is written to a temporary folder and renamed, so that a partial entry is never read
+        tmp_dir = entry_dir.with_name(entry_dir.name + ".tmp{}".format(os.getpid()))
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+        for sensor_name, columns in _SENSOR_COLUMNS.items():
+            sensor_data = getattr(trace_data, sensor_name)
+            for field in fields(columns):
+                np.save(tmp_dir / "{}.{}.npy".format(sensor_name, field.name),
+                        getattr(sensor_data, field.name), allow_pickle=False)
+
+        metadata = {field: getattr(trace_data, field) for field in METADATA_NAMES.values()}
+        with open(tmp_dir / "meta.json", "w") as f:
+            json.dump(metadata, f)
+        entry_bytes = sum(file.stat().st_size for file in tmp_dir.iterdir())
+        # The entry is renamed and counted under the lock, otherwise a size computed from the entries by another
+        # process in between would count it, and it would then be added a second time
+        with self._lock():
+            try:
+                os.replace(tmp_dir, entry_dir)
+            except OSError:
+                # Another process already wrote the same entry
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                entry_bytes = 0
+            return self._update_size(entry_bytes)
+
+    def _read_entry(self, entry_dir, trace_filename):
+        with open(entry_dir / "meta.json") as f:
+            trace_data_kwargs = json.load(f)
+        trace_data_kwargs["file_name"] = trace_filename
+
+        for sensor_name, columns in _SENSOR_COLUMNS.items():
+            trace_data_kwargs[sensor_name] = columns(**{
+                field.name: np.load(entry_dir / "{}.{}.npy".format(sensor_name, field.name),
+                                    mmap_mode="r", allow_pickle=False)
+                for field in fields(columns)})
+        return TraceData(**trace_data_kwargs)
+
+
+# TraceCache of a fill_cache worker process, set by _open_cache
+_worker_cache = None
+
+
+def _open_cache(cache_dir, max_bytes):
+    global _worker_cache
+    _worker_cache = TraceCache(cache_dir, max_bytes=max_bytes)
+
+
+def _fill_entry(trace_filename):
+    """Parses a tracing file into the worker cache unless it is already there, and returns its summary"""
+    summary = {"trace": trace_filename}
+    try:
+        hits = _worker_cache.hits
+        _worker_cache.load(trace_filename)
+        summary["hit"] = _worker_cache.hits > hits
+    except Exception as error:
+        # A broken trace must not stop the whole run, it is reported in its summary instead
+        summary["error"] = "{}: {}".format(type(error).__name__, error)
+    return summary
+
+
+def fill_cache(root, cache_dir, workers=None, chunksize=4, max_bytes=None, progress=True):
+    """Parses every tracing file under root into a TraceCache, in a pool of parse-only worker processes
+
+    Args:
+        root (str): Venue, floor or dataset folder
+        cache_dir (str): Folder of the cache
+        workers (int, optional): Number of worker processes, None uses every core. Defaults to None.
+        chunksize (int, optional): Number of traces sent to a worker at a time. Defaults to 4.
+        max_bytes (int, optional): Maximum total size of the cache entries, None for no maximum.
+        Defaults to None.
+        progress (bool, optional): Whether to report the progress on stderr. Defaults to True.
+
+    Raises:
+        ValueError: When a not valid number of workers or chunksize is input
+
+    Returns:
+        list(dict): Summary of each trace, whether it was already cached or an "error" message
+    """
+    workers = os.cpu_count() if workers is None else workers
+    if workers < 1:
+        raise ValueError(
+            "{} is not a valid number of workers.".format(workers))
+    if chunksize < 1:
+        raise ValueError(
+            "{} is not a valid chunksize.".format(chunksize))
+
+    traces = find_traces(root)
+    Path(cache_dir).mkdir(parents=True, exist_ok=True)
+
+    summaries = []
+    start_time = time.perf_counter()
+    with Pool(processes=min(workers, max(len(traces), 1)), initializer=_open_cache,
+              initargs=(cache_dir, max_bytes)) as pool:
+        for summary in pool.imap_unordered(_fill_entry, traces, chunksize=chunksize):
+            summaries.append(summary)
+            if progress:
+                elapsed = time.perf_counter() - start_time
+                print("[{}/{}] {:.1f} traces/s {}{}".format(
+                    len(summaries), len(traces), len(summaries) / elapsed, summary["trace"],
+                    " ({})".format(summary["error"]) if "error" in summary else ""), file=sys.stderr)
+    return summaries
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Parses the tracing files of a venue or dataset folder "
+                                     "into the parsed trace cache")
+    parser.add_argument("root", help="Venue, floor or dataset folder")
+    parser.add_argument("--cache-dir", default="./output/trace_cache/", help="Folder of the parsed trace cache")
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes")
+    parser.add_argument("--chunksize", type=int, default=4, help="Traces sent to a worker at a time")
+    parser.add_argument("--max-bytes", type=int, default=None,
+                        help="Maximum size of the cache in bytes, no maximum by default")
+    parser.add_argument("--quiet", action="store_true", help="Do not report the progress")
+    args = parser.parse_args(argv)
+
+    summaries = fill_cache(args.root, args.cache_dir, workers=args.workers, chunksize=args.chunksize,
+                           max_bytes=args.max_bytes, progress=not args.quiet)
+    n_errors = sum("error" in summary for summary in summaries)
+    n_hits = sum(summary.get("hit", False) for summary in summaries)
+    print("{} traces parsed, {} already cached, {} errors".format(len(summaries) - n_hits - n_errors, n_hits,
+                                                                 n_errors))
+    return 1 if n_errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
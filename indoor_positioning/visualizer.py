@@ -1,31 +1,158 @@
-import pandas as pd
 import numpy as np
 import os
-import plotly.graph_objs as go
-import plotly.express as px
-import plotly.offline as pyo
 
-from PIL import Image
+from indoor_positioning import instrumentation
+from pathlib import Path
+
+# plotly, pandas and PIL are imported by the functions which use them, so that importing the module for its
+# downsampling helpers does not load them
+
+
+# Local copy of plotly.js referenced by the pages written with include_plotlyjs="directory"
+PLOTLYJS_FILE = "plotly.min.js"
+
+DOWNSAMPLING_METHODS = ["minmax", "lttb"]
 
 
 def save_go_fig(figure, filename):
     figure.write_html(filename)
 
 
-def viz_histogram_tss_diff(tss, sensor_name=None):
+def viz_histogram_tss_diff(tss, sensor_name=None, n_bins=None):
     """Creates a plotly histogram of the difference between each timestamp for a particular sensor.
     This can be used to determine if a static or variable tss has to be used in the position prediction model. 
 
     Args:
-        tss (list): List of the timestamps associated to the sensor in a specific tracefile
+        tss (np.array): Timestamps associated to the sensor in a specific tracefile
         sensor_name (str): Type of sensor e.g. acc, mag, or gyro
+        n_bins (int, optional): Number of bins computed before plotting, so that the figure only holds the bin
+        counts instead of every difference. None lets plotly bin the raw differences. Defaults to None.
     """
-    tss_diff = np.array(tss[1:], dtype="int")-np.array(tss[:-1], dtype="int")
+    import plotly.express as px
+
+    tss_diff = np.diff(np.asarray(tss, dtype="int64"))
+    if n_bins is not None:
+        counts, edges = np.histogram(tss_diff, bins=n_bins)
+        return px.bar(x=(edges[:-1] + edges[1:]) / 2, y=counts, title=sensor_name,
+                      labels={"x": "Tss Difference", "y": "Count"})
+    import pandas as pd
+
     df = pd.DataFrame(data={"tss_diff": tss_diff})
     fig = px.histogram(df, labels={"x": "Tss Difference", "y": "Count"})
     return fig
 
 
+def minmax_indices(y, n_bins):
+    """Indices of the min/max decimation of a series: its first and last samples and the minimum and maximum
+    of each of n_bins buckets of consecutive samples
+
+    Args:
+        y (np.array): Values of the series
+        n_bins (int): Number of buckets
+
+    Returns:
+        np.array: Sorted indices of the kept samples, at most 2 * n_bins + 2
+    """
+    y = np.asarray(y, dtype="float64")
+    if y.shape[0] <= 2 * n_bins + 2:
+        return np.arange(y.shape[0])
+
+    starts = np.linspace(0, y.shape[0], n_bins + 1).astype(np.int64)[:-1]
+    bucket = np.repeat(np.arange(n_bins), np.diff(np.append(starts, y.shape[0])))
+    kept = [[0, y.shape[0] - 1]]
+    for extreme, fill in [(np.maximum, -np.inf), (np.minimum, np.inf)]:
+        values = np.nan_to_num(y, nan=fill)
+        # First sample of each bucket equal to its extreme
+        candidates = np.flatnonzero(values == extreme.reduceat(values, starts)[bucket])
+        first = np.ones(candidates.shape[0], dtype=bool)
+        first[1:] = bucket[candidates[1:]] != bucket[candidates[:-1]]
+        kept.append(candidates[first])
+    return np.unique(np.concatenate(kept))
+
+
+def lttb_indices(x, y, n_out):
+    """Indices of the largest-triangle-three-buckets downsampling of a series
+
+    Args:
+        x (np.array): Increasing x of the series
+        y (np.array): Values of the series
+        n_out (int): Number of kept samples
+
+    Returns:
+        np.array: Sorted indices of the kept samples
+    """
+    x = np.asarray(x, dtype="float64")
+    y = np.asarray(y, dtype="float64")
+    n = x.shape[0]
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    # The first and last samples are kept, the others are split into n_out - 2 buckets
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    x_sums = np.add.reduceat(x[1:n - 1], edges[:-1] - 1)
+    y_sums = np.add.reduceat(y[1:n - 1], edges[:-1] - 1)
+    sizes = np.diff(edges)
+    next_x = np.append(x_sums[1:] / sizes[1:], x[-1])
+    next_y = np.append(y_sums[1:] / sizes[1:], y[-1])
+
+    selected = np.empty(n_out, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    previous = 0
+    for bucket, (start, end) in enumerate(zip(edges[:-1], edges[1:])):
+        # Sample of the bucket making the largest triangle with the previous kept sample and the mean
+        # of the next bucket
+        areas = np.abs((x[previous] - next_x[bucket]) * (y[start:end] - y[previous]) -
+                       (x[previous] - x[start:end]) * (next_y[bucket] - y[previous]))
+        previous = start + int(np.argmax(areas))
+        selected[bucket + 1] = previous
+    return selected
+
+
+def downsample_indices(x, ys, max_points, method="minmax"):
+    """Indices of the samples kept when plotting series which share their x, the union of the samples kept
+    for each series
+
+    Args:
+        x (np.array): Shared x of the series
+        ys (list(np.array)): Values of each series
+        max_points (int): Approximate number of points kept per series
+        method (str, optional): Either "minmax" decimation or "lttb". Defaults to "minmax".
+
+    Raises:
+        ValueError: When a not valid method is input
+
+    Returns:
+        np.array: Sorted indices of the kept samples
+    """
+    if method not in DOWNSAMPLING_METHODS:
+        raise ValueError(
+            "{} is not a valid downsampling method.".format(method))
+
+    if method == "minmax":
+        kept = [minmax_indices(y, max(max_points // 2 - 1, 1)) for y in ys]
+    else:
+        kept = [lttb_indices(x, y, max_points) for y in ys]
+    return np.unique(np.concatenate(kept + [np.empty(0, dtype=np.int64)]))
+
+
+def write_plotlyjs(output_dir):
+    """Writes the plotly.js bundle as PLOTLYJS_FILE into a folder, unless it is already there
+
+    Args:
+        output_dir (str): Folder of the pages referencing it
+    """
+    plotlyjs_file = Path(output_dir) / PLOTLYJS_FILE
+    if not plotlyjs_file.exists():
+        import plotly.offline as pyo
+
+        plotlyjs_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = plotlyjs_file.with_name(PLOTLYJS_FILE + ".tmp{}".format(os.getpid()))
+        tmp_file.write_text(pyo.get_plotlyjs(), encoding="utf-8")
+        os.replace(tmp_file, plotlyjs_file)
+
+
+@instrumentation.instrumented("html", fields=lambda result, figs, filename, *args, **kwargs: {
+    "figures": len(figs), "bytes_written": os.path.getsize(filename)})
 def figures_to_html(figs, filename, add_js=True):
     '''Saves a list of plotly figures in an html file.
 
@@ -37,14 +164,23 @@ def figures_to_html(figs, filename, add_js=True):
     filename : str
         File name to save in.
 
+    add_js : bool or str
+        Whether to include plotly.js, only once before the first figure, or "directory" to reference a
+        single local copy written next to the file.
+
     '''
+    import plotly.offline as pyo
+
+    if add_js == "directory":
+        write_plotlyjs(Path(filename).parent)
+
     with open(filename, 'w') as dashboard:
         dashboard.write("<html><head></head><body>" + "\n")
 
-        for fig in figs:
+        for fig_ix, fig in enumerate(figs):
 
             inner_html = pyo.plot(
-                fig, include_plotlyjs=add_js, output_type='div'
+                fig, include_plotlyjs=add_js if fig_ix == 0 else False, output_type='div'
             )
 
             dashboard.write(inner_html)
@@ -52,11 +188,29 @@ def figures_to_html(figs, filename, add_js=True):
         dashboard.write("</body></html>" + "\n")
 
 
-def fig_acc_filter(acc_df):
-    return px.line(acc_df, x="tss", y=["non_filtered_acc", "filtered_acc"])
+def fig_acc_filter(acc_df, max_points=None, method="minmax"):
+    """Line plot of the raw and filtered accelerometer magnitudes
+
+    Args:
+        acc_df (pd.DataFrame): DataFrame of data_processing.acc_df
+        max_points (int, optional): Approximate number of points plotted per series, None plots every
+        sample. Defaults to None.
+        method (str, optional): Downsampling method, see downsample_indices. Defaults to "minmax".
+    """
+    import plotly.express as px
+
+    columns = ["non_filtered_acc", "filtered_acc"]
+    if max_points is not None:
+        acc_df = acc_df.iloc[downsample_indices(acc_df["tss"].to_numpy(),
+                                                [acc_df[column].to_numpy() for column in columns],
+                                                max_points, method=method)]
+    return px.line(acc_df, x="tss", y=columns)
 
 
 def fig_all_waypoints(floorplan, waypoint_list):
+    import plotly.graph_objs as go
+    from PIL import Image
+
     fig = go.Figure()
 
     # add floor plan
@@ -0,0 +1,251 @@
+from indoor_positioning import data_parser
+from indoor_positioning.gridding.occupancy import floor_grid_map
+from functools import lru_cache
+from pathlib import Path
+
+import hashlib
+import json
+import os
+import numpy as np
+
+# scipy is imported by the functions which use it, as in data_processing
+
+
+class WaypointGraph:
+    """Navigation graph of a floor, with the unique waypoints as nodes
+
+    Edges link the waypoints less than max_edge_length apart whose connecting segment only crosses walkable
+    cells of the occupancy grid of the floor, i.e. stays inside the floor outline and out of the shops, and
+    are weighted by their length. Shortest paths are computed
+    on demand by Dijkstra from their source, the results of the last cache_size sources being kept.
+    """
+
+    def __init__(self, waypoints, edges, cache_size=256):
+        """
+        Args:
+            waypoints (np.array): (N, 2) array of the nodes
+            edges (np.array): (E, 2) array of the node indices of each undirected edge
+            cache_size (int, optional): Number of single-source shortest paths kept. Defaults to 256.
+        """
+        from scipy import sparse
+        from scipy.spatial import cKDTree
+
+        self.waypoints = np.asarray(waypoints, dtype="float64").reshape(-1, 2)
+        self.edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+        self.lengths = np.linalg.norm(self.waypoints[self.edges[:, 1]] - self.waypoints[self.edges[:, 0]], axis=1)
+        n_nodes = self.waypoints.shape[0]
+        self.adjacency = sparse.csr_matrix((self.lengths, (self.edges[:, 0], self.edges[:, 1])),
+                                           shape=(n_nodes, n_nodes))
+        # Edges are snapped to through a KD-tree of their midpoints, see snap
+        self._midpoints = cKDTree((self.waypoints[self.edges[:, 0]] + self.waypoints[self.edges[:, 1]]) / 2)
+        self._single_source = lru_cache(maxsize=cache_size)(self._dijkstra)
+        self.source_hashes = {}
+
+    def __len__(self):
+        return self.waypoints.shape[0]
+
+    @classmethod
+    def build(cls, waypoints, grid, max_edge_length=10.0, **kwargs):
+        """Builds the graph of the waypoints of a floor
+
+        Args:
+            waypoints (np.array): (N, 2) array of the unique waypoints of the floor
+            grid (OccupancyGridMap): Occupancy grid of the floor, with the floor outline, see floor_grid_map
+            max_edge_length (float, optional): Maximum length of an edge in meters. Defaults to 10.0.
+            **kwargs: Options of WaypointGraph
+
+        Returns:
+            WaypointGraph: Graph of the floor
+        """
+        from scipy.spatial import cKDTree
+
+        waypoints = np.asarray(waypoints, dtype="float64").reshape(-1, 2)
+        pairs = cKDTree(waypoints).query_pairs(max_edge_length, output_type="ndarray").reshape(-1, 2)
+        blocked = grid.crosses_obstacle(waypoints[pairs[:, 0]], waypoints[pairs[:, 1]])
+        return cls(waypoints, pairs[~blocked], **kwargs)
+
+    def _dijkstra(self, source):
+        from scipy.sparse import csgraph
+
+        distances, predecessors = csgraph.dijkstra(self.adjacency, directed=False, indices=source,
+                                                   return_predecessors=True)
+        return distances, predecessors
+
+    def shortest_path(self, source, target):
+        """Shortest path between two nodes
+
+        Args:
+            source (int): Index of the first node
+            target (int): Index of the last node
+
+        Returns:
+            (float, list(int)): Length of the path in meters (inf when the nodes are not connected) and its
+            nodes from source to target (empty when they are not connected)
+        """
+        distances, predecessors = self._single_source(int(source))
+        if np.isinf(distances[target]):
+            return np.inf, []
+        path = [int(target)]
+        while path[-1] != source:
+            path.append(int(predecessors[path[-1]]))
+        return float(distances[target]), path[::-1]
+
+    def distances_from(self, source):
+        """Shortest path lengths from a node to every node, inf for the nodes not connected to it
+
+        Args:
+            source (int): Index of the node
+
+        Returns:
+            np.array: Length of the shortest path to each node in meters
+        """
+        return self._single_source(int(source))[0]
+
+    def all_pairs(self):
+        """Dense N x N matrix of the shortest path lengths between every pair of nodes
+
+        Returns:
+            np.array: Shortest path lengths in meters, inf between nodes which are not connected
+        """
+        from scipy.sparse import csgraph
+
+        return csgraph.shortest_path(self.adjacency, method="D", directed=False)
+
+    def snap(self, points, n_candidates=16):
+        """Projects points onto their nearest edge
+
+        The candidate edges of a point are those with the nearest midpoints. As an edge is no closer than the
+        distance to its midpoint minus its half length, the candidates are widened for the points for which
+        a closer edge may exist outside of them, so that the nearest edge is exact.
+
+        Args:
+            points (np.array): (M, 2) array of coords in meters
+            n_candidates (int, optional): Number of candidate edges of each point. Defaults to 16.
+
+        Returns:
+            (np.array, np.array, np.array, np.array): Index of the nearest edge of each point, position t in
+            [0, 1] of the projection along it, (M, 2) projected coords and distance to the edge. The indices are
+            -1, and the rest NaN, when the graph has no edges
+        """
+        points = np.asarray(points, dtype="float64").reshape(-1, 2)
+        n_points, n_edges = points.shape[0], self.edges.shape[0]
+        if not n_edges:
+            return np.full(n_points, -1), np.full(n_points, np.nan), np.full((n_points, 2), np.nan), \
+                np.full(n_points, np.nan)
+
+        # The points whose nearest edge may be outside of their candidates are queried again, with 4 times
+        # as many candidates each time, until every edge is a candidate
+        edge = np.empty(n_points, dtype=np.int64)
+        remaining = np.arange(n_points)
+        k = min(n_candidates, n_edges)
+        while remaining.shape[0]:
+            midpoint_distances, candidates = self._midpoints.query(points[remaining], k=k)
+            midpoint_distances = midpoint_distances.reshape(-1, k)
+            candidates = candidates.reshape(-1, k)
+            _, distances = self._project(points[remaining, None, :], candidates)
+            best = np.argmin(distances, axis=1)
+            edge[remaining] = candidates[np.arange(remaining.shape[0]), best]
+            unsure = midpoint_distances[:, -1] - self.lengths.max() / 2 < distances.min(axis=1)
+            remaining = remaining[unsure] if k < n_edges else remaining[:0]
+            k = min(4 * k, n_edges)
+
+        t, distance = self._project(points, edge)
+        start, end = self.waypoints[self.edges[edge, 0]], self.waypoints[self.edges[edge, 1]]
+        return edge, t, start + t[:, None] * (end - start), distance
+
+    def _project(self, points, edges):
+        """Position t of the projection of points onto edges, broadcast together, and their distance"""
+        start, end = self.waypoints[self.edges[edges, 0]], self.waypoints[self.edges[edges, 1]]
+        direction = end - start
+        squared_length = np.maximum((direction ** 2).sum(axis=-1), 1e-12)
+        t = np.clip(((points - start) * direction).sum(axis=-1) / squared_length, 0, 1)
+        return t, np.linalg.norm(start + t[..., None] * direction - points, axis=-1)
+
+    def path_length(self, point_a, point_b):
+        """Length of the shortest path through the graph between two arbitrary points, both snapped to the graph
+
+        Args:
+            point_a (tuple(float, float)): First point in meters
+            point_b (tuple(float, float)): Second point in meters
+
+        Returns:
+            float: Length in meters between the snapped points, inf when they are not connected
+        """
+        edge, t, _, _ = self.snap(np.array([point_a, point_b]))
+        if edge[0] < 0:
+            return np.inf
+        if edge[0] == edge[1]:
+            return abs(t[0] - t[1]) * self.lengths[edge[0]]
+
+        # Offsets from the snapped points to both ends of their edges
+        offset_a = np.array([t[0], 1 - t[0]]) * self.lengths[edge[0]]
+        offset_b = np.array([t[1], 1 - t[1]]) * self.lengths[edge[1]]
+        between = np.array([self.distances_from(node)[self.edges[edge[1]]] for node in self.edges[edge[0]]])
+        return float((offset_a[:, None] + between + offset_b[None, :]).min())
+
+    def save(self, graph_file):
+        """Saves the nodes and edges of the graph as an .npz file
+
+        Args:
+            graph_file (str): Path of the .npz file
+        """
+        graph_file = Path(graph_file)
+        graph_file.parent.mkdir(parents=True, exist_ok=True)
+        # The graph is written to a temporary file and renamed, so that a partial graph is never loaded
+        tmp_file = graph_file.with_name(graph_file.name + ".tmp{}".format(os.getpid()))
+        with open(tmp_file, "wb") as f:
+            np.savez(f, waypoints=self.waypoints, edges=self.edges,
+                     source_hashes=np.array(json.dumps(self.source_hashes)))
+        os.replace(tmp_file, graph_file)
+
+    @classmethod
+    def load(cls, graph_file, **kwargs):
+        """Loads a graph saved with save
+
+        Args:
+            graph_file (str): Path of the .npz file
+            **kwargs: Options of WaypointGraph
+
+        Returns:
+            WaypointGraph: Loaded graph
+        """
+        with np.load(graph_file, allow_pickle=False) as saved:
+            graph = cls(saved["waypoints"], saved["edges"], **kwargs)
+            graph.source_hashes = json.loads(str(saved["source_hashes"]))
+        return graph
+
+
+def floor_graph(map_folder, floorplan, graph_dir, cell_size=0.5, max_edge_length=10.0, index=None):
+    """Waypoint graph of a floor, loaded from graph_dir unless its waypoints, grid or options changed
+
+    Args:
+        map_folder (str): DIR of the map
+        floorplan (dict): Dict of the floorplan, as returned by data_parser.floorplan
+        graph_dir (str): Folder where the graphs, and the occupancy grids they are built on, are saved
+        cell_size (float, optional): Size of the grid cells in meters. Defaults to 0.5.
+        max_edge_length (float, optional): Maximum length of an edge in meters. Defaults to 10.0.
+        index (WaypointIndex, optional): Persistent waypoint index, see data_parser.waypoint_list.
+        Defaults to None.
+
+    Returns:
+        WaypointGraph: Graph of the floor
+    """
+    waypoints = np.asarray(data_parser.waypoint_list(map_folder, index=index), dtype="float64")
+    grid = floor_grid_map(floorplan, cell_size, Path(graph_dir) / "grids")
+    # The graphs built on grids without the floor outline, whose edges may leave the building, are built again
+    source_hashes = dict(grid.source_hashes, waypoints=hashlib.sha1(waypoints.tobytes()).hexdigest(),
+                         cell_size=cell_size, max_edge_length=max_edge_length, outline=grid.has_outline)
+
+    # The _graph suffix keeps the graphs apart from the WaypointIndex files, which are named after the floor too
+    folder = Path(os.path.abspath(map_folder))
+    graph_file = Path(graph_dir) / "{}_{}_{}_graph.npz".format(
+        folder.parent.name, folder.name, hashlib.sha1(str(folder).encode("utf-8")).hexdigest()[:12])
+    if graph_file.exists():
+        graph = WaypointGraph.load(graph_file)
+        if graph.source_hashes == source_hashes:
+            return graph
+
+    graph = WaypointGraph.build(waypoints, grid, max_edge_length=max_edge_length)
+    graph.source_hashes = source_hashes
+    graph.save(graph_file)
+    return graph
@@ -0,0 +1,108 @@
+from indoor_positioning.data_parser import WaypointData, tracing_parser
+from pathlib import Path
+
+import glob
+import hashlib
+import os
+import numpy as np
+
+
+class WaypointIndex:
+    """Persistent per-floor index of the waypoints of the tracing files
+
+    The index of each floor folder is an .npz file with the waypoints of all of its traces, along with the
+    size and mtime of each trace. Updating it only parses (with the waypoint-only mode of tracing_parser)
+    the traces which are new or have changed since the last update.
+    """
+
+    def __init__(self, index_dir):
+        """
+        Args:
+            index_dir (str): Folder where the index files are kept, it is created if needed
+        """
+        self.index_dir = Path(index_dir)
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        self.parsed = 0
+        self.reused = 0
+
+    def index_file(self, map_folder):
+        """Index file of a floor folder
+
+        Args:
+            map_folder (str): DIR of the map
+
+        Returns:
+            Path: Path of the .npz index
+        """
+        folder = Path(os.path.abspath(map_folder))
+        digest = hashlib.sha1(str(folder).encode("utf-8")).hexdigest()[:12]
+        return self.index_dir / "{}_{}_{}.npz".format(folder.parent.name, folder.name, digest)
+
+    def update(self, map_folder):
+        """Brings the index of a floor folder up to date with its tracing files
+
+        Args:
+            map_folder (str): DIR of the map
+
+        Returns:
+            dict: WaypointData of each tracing file of the floor
+        """
+        indexed = self._read(self.index_file(map_folder))
+        trace_waypoints = {}
+        stats = {}
+        changed = False
+        for trace_filename in sorted(glob.glob(map_folder + "/*.txt", recursive=True)):
+            stat = os.stat(trace_filename)
+            stats[trace_filename] = (stat.st_size, stat.st_mtime_ns)
+            if trace_filename in indexed and indexed[trace_filename][0] == stats[trace_filename]:
+                trace_waypoints[trace_filename] = indexed[trace_filename][1]
+                self.reused += 1
+            else:
+                trace_waypoints[trace_filename] = tracing_parser(
+                    trace_filename, record_types={"TYPE_WAYPOINT"}).waypoint
+                self.parsed += 1
+                changed = True
+
+        if changed or indexed.keys() != trace_waypoints.keys():
+            self._write(self.index_file(map_folder), trace_waypoints, stats)
+        return trace_waypoints
+
+    def waypoints(self, map_folder):
+        """Unique waypoints of a floor folder, as data_parser.waypoint_list
+
+        Args:
+            map_folder (str): DIR of the map
+
+        Returns:
+            np.array: (N, 2) array of the waypoint pairs in the map
+        """
+        trace_waypoints = self.update(map_folder)
+        return np.unique(np.concatenate(
+            [waypoint.xy for waypoint in trace_waypoints.values()] + [np.empty((0, 2), dtype="float32")]), axis=0)
+
+    @staticmethod
+    def _read(index_file):
+        if not index_file.exists():
+            return {}
+        with np.load(index_file, allow_pickle=False) as index:
+            bounds = np.concatenate([[0], np.cumsum(index["counts"])])
+            return {str(trace_filename): ((int(size), int(mtime)),
+                                          WaypointData(tss=index["tss"][start:end], xy=index["xy"][start:end]))
+                    for trace_filename, size, mtime, start, end in zip(
+                        index["files"], index["sizes"], index["mtimes"], bounds[:-1], bounds[1:])}
+
+    @staticmethod
+    def _write(index_file, trace_waypoints, stats):
+        trace_filenames = list(trace_waypoints)
+        waypoints = [trace_waypoints[trace_filename] for trace_filename in trace_filenames]
+        # The index is written to a temporary file and renamed, so that a partial index is never read
+        tmp_file = index_file.with_name(index_file.name + ".tmp{}".format(os.getpid()))
+        with open(tmp_file, "wb") as f:
+            np.savez(f,
+                     files=np.array(trace_filenames, dtype=str),
+                     sizes=np.array([stats[trace_filename][0] for trace_filename in trace_filenames], dtype=np.int64),
+                     mtimes=np.array([stats[trace_filename][1] for trace_filename in trace_filenames], dtype=np.int64),
+                     counts=np.array([len(waypoint) for waypoint in waypoints], dtype=np.int64),
+                     tss=np.concatenate([waypoint.tss for waypoint in waypoints] + [np.empty(0, dtype=np.int64)]),
+                     xy=np.concatenate([waypoint.xy for waypoint in waypoints] + [np.empty((0, 2), dtype="float32")]))
+        os.replace(tmp_file, index_file)
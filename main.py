@@ -1,4 +1,7 @@
-from indoor_positioning import data_parser, visualizer, data_processing
+from indoor_positioning import data_parser, visualizer, data_processing, instrumentation
+from indoor_positioning.trace_cache import TraceCache
+from indoor_positioning.waypoint_index import WaypointIndex
+from indoor_positioning.waypoint_graph import floor_graph
 from pathlib import Path
 
 import glob
@@ -12,6 +15,12 @@ METADATA_DIR = "./dataset/metadata/"
 OUTPUT_DIR = './output/'
 TSS_HISTOGRAMS_DIR = OUTPUT_DIR + "tss_hist/"
 WAYPOINTS_DIR = OUTPUT_DIR + "waypoints/"
+TRACE_CACHE_DIR = OUTPUT_DIR + "trace_cache/"
+WAYPOINT_INDEX_DIR = OUTPUT_DIR + "waypoint_index/"
+WAYPOINT_GRAPH_DIR = OUTPUT_DIR + "waypoint_graph/"
+INSTRUMENTATION_FILE = OUTPUT_DIR + "instrumentation.jsonl"
+# Trace id captured with cProfile and tracemalloc into OUTPUT_DIR/profiles/, None for no capture
+PROFILE_TRACE = None
 
 
 if __name__ == "__main__":
@@ -20,52 +29,64 @@ if __name__ == "__main__":
     Path(TSS_HISTOGRAMS_DIR + venue_id).mkdir(parents=True, exist_ok=True)
     Path(WAYPOINTS_DIR).mkdir(parents=True, exist_ok=True)
     Path(WAYPOINTS_DIR + venue_id).mkdir(parents=True, exist_ok=True)
+    trace_cache = TraceCache(TRACE_CACHE_DIR)
+    waypoint_index = WaypointIndex(WAYPOINT_INDEX_DIR)
+    aggregator = instrumentation.Aggregator()
+    instrumentation.enable(instrumentation.JsonLinesSink(INSTRUMENTATION_FILE), aggregator,
+                           profile_trace=PROFILE_TRACE, profile_dir=OUTPUT_DIR + "profiles/")
 
     # Specific tracing file selection
 
     tracing_files = glob.glob(VENUE_DIR + "**/*.txt", recursive=True)
     tracing_test_filename = tracing_files[0]
     tracing_test_id = Path(tracing_test_filename).parts[-1].replace(".txt","")
-    parsed_data = data_parser.tracing_parser(tracing_test_filename)
-    
-    # Floor data
+    with instrumentation.trace(tracing_test_id):
+        parsed_data = trace_cache.load(tracing_test_filename)
 
-    floor_folder_dir = str(Path(tracing_test_filename).parent)
-    floorplan = data_parser.floorplan(METADATA_DIR, floor_folder_dir)
+        # Floor data
 
+        floor_folder_dir = str(Path(tracing_test_filename).parent)
+        floorplan = data_parser.floorplan(METADATA_DIR, floor_folder_dir)
 
-    "1.1 -- Visualizing tss difference"
-    sensors_to_viz = {
-        "Calibrated Acce": parsed_data.acc_calib,
-        "Calibrated Magnetometer": parsed_data.mag_calib,
-        "Calibrated Gyro": parsed_data.gyro_calib}
 
-    histogram_figs = []
-    for sensor in sensors_to_viz:
-        tss = [xyz[0] for xyz in sensors_to_viz[sensor]]
-        histogram_figs.append(visualizer.viz_histogram_tss_diff(tss))
+        "1.1 -- Visualizing tss difference"
+        sensors_to_viz = {
+            "Calibrated Acce": parsed_data.acc_calib,
+            "Calibrated Magnetometer": parsed_data.mag_calib,
+            "Calibrated Gyro": parsed_data.gyro_calib}
 
-    histogram_html = TSS_HISTOGRAMS_DIR + venue_id + "/" + tracing_test_id + ".html"
+        histogram_figs = []
+        for sensor in sensors_to_viz:
+            histogram_figs.append(visualizer.viz_histogram_tss_diff(sensors_to_viz[sensor].tss))
 
-    visualizer.figures_to_html(histogram_figs, histogram_html)
+        histogram_html = TSS_HISTOGRAMS_DIR + venue_id + "/" + tracing_test_id + ".html"
 
-    "1.2 Visualazing Filtering"
+        visualizer.figures_to_html(histogram_figs, histogram_html)
 
-    acc_df = data_processing.acc_df(parsed_data, filt_type="filtfilt")
-    acc_filter_fig = visualizer.fig_acc_filter(acc_df)
-    # acc_filter_fig.show()
+        "1.2 Visualazing Filtering"
 
-    mag_df = data_processing.mag_df(parsed_data)
+        acc_df = data_processing.acc_df(parsed_data, filt_type="filtfilt")
+        acc_filter_fig = visualizer.fig_acc_filter(acc_df)
+        # acc_filter_fig.show()
 
-    
+        mag_df = data_processing.mag_df(parsed_data)
 
 
-    "1.3 Waypoints viz"
 
-    waypoint_list = data_parser.waypoint_list(floor_folder_dir)
 
-    waypoints_fig = visualizer.fig_all_waypoints(floorplan, waypoint_list)
-    waypoints_html = WAYPOINTS_DIR + venue_id + "/" + tracing_test_id + ".html"
-    visualizer.figures_to_html([waypoints_fig], waypoints_html)
+        "1.3 Waypoints viz"
 
-    
\ No newline at end of file
+        waypoint_list = data_parser.waypoint_list(floor_folder_dir, index=waypoint_index)
+        print("Waypoint index: {} traces parsed, {} reused".format(waypoint_index.parsed, waypoint_index.reused))
+
+        waypoints_fig = visualizer.fig_all_waypoints(floorplan, waypoint_list)
+        waypoints_html = WAYPOINTS_DIR + venue_id + "/" + tracing_test_id + ".html"
+        visualizer.figures_to_html([waypoints_fig], waypoints_html)
+
+        "1.4 Waypoint graph"
+
+        waypoint_graph = floor_graph(floor_folder_dir, floorplan, WAYPOINT_GRAPH_DIR, index=waypoint_index)
+        print("Waypoint graph: {} nodes, {} edges".format(len(waypoint_graph), waypoint_graph.edges.shape[0]))
+
+    instrumentation.disable()
+    print(aggregator.table())
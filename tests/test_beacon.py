@@ -0,0 +1,88 @@
+"""Multilateration of beacon.multilaterate, whose residuals never grow over its iterations, and the path-loss
+ranges of beacon.BeaconMap, referenced to the tx_power of the readings.
+
+Usage:
+    python -m pytest tests
+"""
+from indoor_positioning import beacon, data_parser
+
+import numpy as np
+import pytest
+
+
+def noisy_epochs(n_epochs, max_anchors, seed):
+    """Epochs of 1 to max_anchors anchors within 15 m of the device, with 4 dB of log-normal range noise"""
+    rng = np.random.default_rng(seed)
+    truth = rng.uniform(0, 100, (n_epochs, 2))
+    anchors = truth[:, None, :] + rng.uniform(-15, 15, (n_epochs, max_anchors, 2))
+    n_anchors = rng.integers(1, max_anchors + 1, n_epochs)
+    anchors[np.arange(max_anchors) >= n_anchors[:, None]] = np.nan
+    distances = np.linalg.norm(anchors - truth[:, None, :], axis=-1)
+    ranges = distances * 10 ** (rng.normal(0, 4, distances.shape) / 20)
+    return truth, anchors, ranges, n_anchors
+
+
+def test_exact_ranges_are_solved():
+    truth, anchors, _, n_anchors = noisy_epochs(500, 6, seed=0)
+    ranges = np.linalg.norm(anchors - truth[:, None, :], axis=-1)
+    positions, rms = beacon.multilaterate(anchors, ranges)
+    solved = n_anchors >= 3
+    np.testing.assert_allclose(positions[solved], truth[solved], atol=1e-2)
+    assert rms[solved].max() < 1e-2
+
+
+def test_underdetermined_epochs_keep_the_centroid():
+    anchors = np.array([[[0, 0], [10, 0], [np.nan, np.nan]],
+                        [[5, 5], [np.nan, np.nan], [np.nan, np.nan]],
+                        [[np.nan, np.nan]] * 3])
+    ranges = np.array([[2, 2, np.nan], [3, np.nan, np.nan], [np.nan] * 3])
+    positions, rms = beacon.multilaterate(anchors, ranges)
+    np.testing.assert_allclose(positions[:2], [[5, 0], [5, 5]])
+    assert np.isnan(positions[2]).all() and np.isnan(rms[2])
+
+
+def test_residuals_do_not_grow():
+    truth, anchors, ranges, n_anchors = noisy_epochs(5000, 8, seed=1)
+    centroids, centroid_rms = beacon.multilaterate(anchors, ranges, n_iterations=0)
+    positions, rms = beacon.multilaterate(anchors, ranges)
+    assert (rms <= centroid_rms + 1e-9).all()
+    errors = np.linalg.norm(positions - truth, axis=1)
+    centroid_errors = np.linalg.norm(centroids - truth, axis=1)
+    # Noisy ranges move the solutions of some epochs away, but never past the spread of their anchors
+    assert errors.max() < 50
+    assert np.percentile(errors, 95) < np.percentile(centroid_errors, 95) * 1.2
+    assert np.median(errors[n_anchors >= 5]) < np.median(centroid_errors[n_anchors >= 5])
+
+
+def test_ranges_use_the_tx_power(tmp_path):
+    beacons = np.array([[0, 0], [20, 0], [0, 20], [20, 20]])
+    device = np.array([6, 9])
+    distances = np.linalg.norm(beacons - device, axis=1)
+    # The first two beacons advertise their tx_power, the other two do not
+    tx_power = [-65, -75, 0, 0]
+    lines = ["#\tstartTime:0", "#\tSiteID:site\tSiteName:name\tFloorId:floor\tFloorName:F1"]
+    for ix, (power, distance) in enumerate(zip(tx_power, distances)):
+        reference = power or beacon.REFERENCE_RSSI
+        lines.append("{}\tTYPE_BEACON\tuuid\t1\t{}\t{}\t{}\t0\tmac".format(
+            ix + 1, ix, power, int(round(reference - 10 * beacon.PATH_LOSS_EXPONENT * np.log10(distance)))))
+    trace_file = tmp_path / "trace.txt"
+    trace_file.write_text("\n".join(lines) + "\n")
+
+    for engine in ["python", "bulk"]:
+        readings = data_parser.tracing_parser(str(trace_file), engine=engine).beacon
+        assert readings.tx_power.tolist() == tx_power
+        beacon_map = beacon.BeaconMap()
+        beacon_map.beacon_ids = {"uuid_1_{}".format(ix): ix for ix in range(4)}
+        beacon_map.positions = beacons.astype("float64")
+        beacon_map.floors = ["F1"] * 4
+        _, positions, n_beacons = beacon_map.locate(readings, window=10)
+        assert n_beacons.tolist() == [4]
+        # The RSSI are rounded to integers
+        assert np.linalg.norm(positions[0] - device) < 1
+        readings.tx_power[:] = 0
+        assert np.linalg.norm(beacon_map.locate(readings, window=10)[1][0] - device) > 3
+
+
+def test_rssi_to_distance_per_reading():
+    np.testing.assert_allclose(beacon.rssi_to_distance([-65, -79, -59], [-65, -59, -59]), [1, 10, 1])
+    assert beacon.rssi_to_distance(-79) == pytest.approx(10)
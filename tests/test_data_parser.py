@@ -0,0 +1,199 @@
+"""Equivalence of the bulk and python engines of data_parser.tracing_parser, on the bundled traces and on
+adversarial inputs: signs, exponents, over-long numbers and strings, line endings and truncated lines.
+
+Usage:
+    python -m pytest tests
+"""
+from indoor_positioning import data_parser
+from dataclasses import fields
+
+import glob
+import numpy as np
+import pytest
+
+BUNDLED_TRACES = sorted(glob.glob("./dataset/*/*/*.txt"))
+
+HEADER = "#\tstartTime:1560566366968\n" \
+    "#\tSiteID:site\tSiteName:name\tFloorId:floor\tFloorName:F1\n"
+
+# Decimal fields of every shape: signs, exponents, more digits than a float64 holds, missing integer or
+# fractional parts...
+ADVERSARIAL_FLOATS = [
+    "0", "-0", "0.0", "-0.0", "1", "-1", "7.", "-7.", ".5", "-.5", "0.4785614", "-0.4785614", "123456.789",
+    "999999999999999", "-999999999999999", "9999999999999999", "0.000000000000001", "-0.000000000000001",
+    "12345678.1234567", "-12345678.1234567", "123456789.1234567", "0.12345678901234567890",
+    "-1234567890123456789.5", "5.950928E-4", "-5.950928e-4", "1e10", "-3E+02", "1.5e-300", "+1.5", "+0",
+    "00000000000000001.25", "-00000000000000001.25", "nan", "inf", "-inf",
+]
+ADVERSARIAL_INTEGERS = [
+    "0", "-0", "7", "-68", "+5", "1560566366968", "-1560566366968", "9999999999999999", "-9999999999999999",
+    "99999999999999999", "-99999999999999999", "9223372036854775807", "-9223372036854775808",
+    "0000000000000000000042",
+]
+
+
+def assert_same_records(bulk, python):
+    """Checks that two columnar records are equal, with their categorical codes compared by value"""
+    assert type(bulk) is type(python)
+    for field in fields(bulk):
+        bulk_values, python_values = getattr(bulk, field.name), getattr(python, field.name)
+        names_field = field.name + "_names"
+        if hasattr(bulk, names_field):
+            bulk_values = getattr(bulk, names_field)[bulk_values]
+            python_values = getattr(python, names_field)[python_values]
+        elif field.name.endswith("_names"):
+            continue
+        assert bulk_values.dtype == python_values.dtype, field.name
+        np.testing.assert_array_equal(bulk_values, python_values, err_msg=field.name)
+
+
+def assert_same_trace(trace_filename, record_types=None):
+    bulk = data_parser.tracing_parser(trace_filename, engine="bulk", record_types=record_types)
+    python = data_parser.tracing_parser(trace_filename, engine="python", record_types=record_types)
+    for field in fields(data_parser.TraceData):
+        bulk_value, python_value = getattr(bulk, field.name), getattr(python, field.name)
+        if isinstance(bulk_value, str):
+            assert bulk_value == python_value, field.name
+        else:
+            assert_same_records(bulk_value, python_value)
+    return bulk
+
+
+def write_trace(tmp_path, lines, newline="\n", final_newline=True):
+    trace_file = tmp_path / "trace.txt"
+    text = newline.join(lines) + (newline if final_newline else "")
+    trace_file.write_bytes(text.encode("utf-8"))
+    return str(trace_file)
+
+
+@pytest.mark.skipif(not BUNDLED_TRACES, reason="no bundled traces")
+@pytest.mark.parametrize("trace_filename", BUNDLED_TRACES)
+def test_bundled_traces(trace_filename):
+    assert_same_trace(trace_filename)
+    assert_same_trace(trace_filename, record_types={"TYPE_WAYPOINT", "TYPE_WIFI"})
+
+
+def test_adversarial_floats(tmp_path):
+    lines = HEADER.splitlines()
+    for ts, value in enumerate(ADVERSARIAL_FLOATS):
+        lines.append("{}\tTYPE_ACCELEROMETER\t{}\t-{}\t{}".format(ts, value, value.lstrip("+-"), value))
+        lines.append("{}\tTYPE_WAYPOINT\t{}\t{}".format(ts, value, value))
+    trace = assert_same_trace(write_trace(tmp_path, lines))
+    assert len(trace.acc_calib) == len(ADVERSARIAL_FLOATS)
+
+
+def test_adversarial_integers(tmp_path):
+    lines = HEADER.splitlines()
+    for value in ADVERSARIAL_INTEGERS:
+        lines.append("{}\tTYPE_GYROSCOPE\t1\t2\t3".format(value))
+        lines.append("{}\tTYPE_WIFI\tssid\tbssid\t-{}\t5805\t1".format(value, len(value)))
+    trace = assert_same_trace(write_trace(tmp_path, lines))
+    assert len(trace.wifi) == len(ADVERSARIAL_INTEGERS)
+
+
+@pytest.mark.parametrize("newline", ["\n", "\r\n"])
+@pytest.mark.parametrize("final_newline", [True, False])
+def test_line_endings(tmp_path, newline, final_newline):
+    lines = HEADER.splitlines() + [
+        "1\tTYPE_WIFI\tssid a\tbssid\t-68\t5805\t1",
+        "2\tTYPE_BEACON\tuuid\tmajor\tminor\t-65\t-78\t3.78\tmac",
+        "3\tTYPE_MAGNETIC_FIELD\t-12.5\t0.25\t44.0",
+        "#\tendTime:4",
+        "4\tTYPE_WAYPOINT\t107.48422\t120.17882",
+    ]
+    trace = assert_same_trace(write_trace(tmp_path, lines, newline, final_newline))
+    assert trace.waypoint.xy.tolist() == [[np.float32(107.48422), np.float32(120.17882)]]
+
+
+def test_over_long_and_empty_strings(tmp_path):
+    lines = HEADER.splitlines() + [
+        "1\tTYPE_WIFI\t{}\t{}\t-1\t5805\t1".format("s" * 300, "b" * 17),
+        "2\tTYPE_WIFI\t\t\t-2\t5805\t1",
+        "3\tTYPE_WIFI\tTYPE_WIFI\tb\t-3\t5805\t1",
+        "4\tTYPE_BEACON\t\t\t\t-65\t-78\t3.78\tmac",
+        "5\tTYPE_BEACON\t{}\tmajor\tminor\t-65\t-78\t3.78\tmac".format("u" * 70),
+    ]
+    assert_same_trace(write_trace(tmp_path, lines))
+
+
+def test_empty_and_header_only(tmp_path):
+    assert_same_trace(write_trace(tmp_path, HEADER.splitlines()))
+    assert data_parser.parse_buffers([b"", b"\n"]) == [([], {}), ([], {})]
+
+
+def test_truncated_lines_are_skipped(tmp_path):
+    lines = HEADER.splitlines() + [
+        "1\tTYPE_ACCELEROMETER\t1.0\t2.0\t3.0",
+        "2\tTYPE_ACCELEROMETER\t1.0\t2.0",
+        "3\tTYPE_WIFI\tssid\tbssid",
+        "4\tTYPE_BEACON\tuuid\tmajor\tminor\t-65",
+        "5\tTYPE_WAYPOINT\t1.5",
+        "6\tTYPE_WAYPOINT",
+        "7",
+    ]
+    trace = assert_same_trace(write_trace(tmp_path, lines, final_newline=False))
+    assert trace.acc_calib.tss.tolist() == [1]
+    assert len(trace.wifi) == len(trace.beacon) == len(trace.waypoint) == 0
+
+
+def test_random_decimals(tmp_path):
+    rng = np.random.default_rng(0)
+    values = []
+    for n_digits in rng.integers(1, 20, 3000):
+        digits = "".join(map(str, rng.integers(0, 10, n_digits)))
+        # The dot is put anywhere, including before the first and after the last digit
+        dot = rng.integers(0, n_digits + 2)
+        if dot <= n_digits:
+            digits = digits[:dot] + "." + digits[dot:]
+        values.append(("-" if rng.random() < 0.5 else "") + digits)
+    lines = HEADER.splitlines() + ["{}\tTYPE_WAYPOINT\t{}\t{}".format(ts, value, value[::-1].strip("-"))
+                                   for ts, value in enumerate(values)]
+    trace = assert_same_trace(write_trace(tmp_path, lines))
+    np.testing.assert_array_equal(trace.waypoint.xy[:, 0],
+                                  np.array([float(value) for value in values], dtype=np.float32))
+
+
+def test_parse_buffers_splits_the_records_back(tmp_path):
+    buffers = [
+        b"1\tTYPE_WIFI\ta\tb\t-1\t1\t1\n2\tTYPE_ACCELEROMETER\t1\t2\n3\tTYPE_WIFI\tc\td\t-3\t1\t1\n",
+        b"",
+        b"#\tstartTime:4\r\n4\tTYPE_WIFI\ta\n5\tTYPE_ACCELEROMETER\t1\t2\t3\r\n",
+        b"6\tTYPE_WIFI\te\tb\t-6\t1\t1\n7\tTYPE_WAYPOINT\t1.5\t2.5",
+    ]
+    parsed = data_parser.parse_buffers(buffers)
+    assert [headers for headers, _ in parsed] == [[], [], ["#\tstartTime:4"], []]
+    assert [sorted(records) for _, records in parsed] == [["wifi"], [], ["acc_calib"], ["waypoint", "wifi"]]
+    assert parsed[0][1]["wifi"].tss.tolist() == [1, 3]
+    assert parsed[0][1]["wifi"].rssi.tolist() == [-1, -3]
+    assert parsed[2][1]["acc_calib"].tss.tolist() == [5]
+    wifi = parsed[3][1]["wifi"]
+    assert wifi.ssid_names[wifi.ssid].tolist() == ["e"] and wifi.bssid_names[wifi.bssid].tolist() == ["b"]
+    assert parsed[3][1]["waypoint"].xy.tolist() == [[1.5, 2.5]]
+
+
+@pytest.mark.parametrize("record_types", [{"TYPE_WAYPOINT"}, {"TYPE_WIFI", "TYPE_BEACON"}])
+def test_selected_record_types(tmp_path, record_types):
+    lines = HEADER.splitlines() + [
+        "1\tTYPE_WIFI\tTYPE_WAYPOINT\tbssid\t-68\t5805\t1",
+        "2\tTYPE_WAYPOINT\t1.5\t2.5",
+        "3\tTYPE_BEACON\tTYPE_WAYPOINT\tmajor\tminor\t-65\t-78\t3.78\tmac",
+        "4\tTYPE_ACCELEROMETER\t1.0\t2.0\t3.0",
+        "#\tendTime:5",
+        "5\tTYPE_WAYPOINT\t3.5\t4.5",
+    ]
+    trace_filename = write_trace(tmp_path, lines, final_newline=False)
+    selected = assert_same_trace(trace_filename, record_types=record_types)
+    full = data_parser.tracing_parser(trace_filename)
+    for record_type, sensor_type in data_parser.SENSOR_TYPES.items():
+        sensor_data = getattr(selected, sensor_type["name"])
+        if record_type in record_types:
+            assert_same_records(sensor_data, getattr(full, sensor_type["name"]))
+            assert len(sensor_data)
+        else:
+            assert not len(sensor_data)
+    assert selected.site_id == "site" and selected.floor_name == "F1"
+
+
+def test_not_valid_record_type(tmp_path):
+    with pytest.raises(ValueError):
+        data_parser.tracing_parser(write_trace(tmp_path, HEADER.splitlines()), record_types={"TYPE_GPS"})
@@ -0,0 +1,76 @@
+"""Causal filters of data_processing: StreamingFilter and filter_chunks filter a signal split into chunks of any
+size as a one-shot sosfilt of the whole signal does.
+
+Usage:
+    python -m pytest tests
+"""
+from indoor_positioning import data_processing
+
+import numpy as np
+import pytest
+
+signal = pytest.importorskip("scipy.signal")
+
+
+def one_shot(samples):
+    """Causal filter of whole signals, started at the steady state of their first sample"""
+    sos = data_processing.butter_filter(output="sos")
+    samples = np.atleast_2d(samples)
+    zi = signal.sosfilt_zi(sos)[:, None, :] * samples[None, :, :1]
+    return signal.sosfilt(sos, samples, axis=-1, zi=zi)[0]
+
+
+def random_splits(rng, n_samples, max_chunk):
+    """Chunk boundaries of a signal, with empty and single sample chunks"""
+    sizes = rng.integers(0, max_chunk, n_samples)
+    return np.concatenate([[0], np.minimum(np.cumsum(sizes), n_samples)])
+
+
+def test_streaming_filter_of_chunks():
+    rng = np.random.default_rng(0)
+    samples = 9.8 + np.cumsum(rng.normal(0, 0.5, (3, 1000)), axis=1)
+    expected = one_shot(samples)
+    for max_chunk in [2, 7, 60]:
+        bounds = random_splits(rng, samples.shape[1], max_chunk)
+        streaming = data_processing.StreamingFilter()
+        filtered = np.concatenate([streaming.process(samples[:, start:end])
+                                   for start, end in zip(bounds[:-1], bounds[1:])] +
+                                  [streaming.process(samples[:, bounds[-1]:])], axis=1)
+        np.testing.assert_allclose(filtered, expected, rtol=0, atol=1e-9)
+
+        # A single signal, after a reset
+        streaming.reset()
+        filtered = np.concatenate([streaming.process(samples[0, start:end])
+                                   for start, end in zip(bounds[:-1], bounds[1:])] +
+                                  [streaming.process(samples[0, bounds[-1]:])])
+        np.testing.assert_allclose(filtered, expected[0], rtol=0, atol=1e-9)
+    np.testing.assert_allclose(data_processing.filter_batch(samples), expected, rtol=0, atol=1e-9)
+
+
+def test_filter_chunks_of_signals_of_different_lengths():
+    rng = np.random.default_rng(1)
+    signals = [9.8 + np.cumsum(rng.normal(0, 0.5, n_samples)) for n_samples in [0, 1, 300, 450, 1000]]
+    splits = [random_splits(rng, len(samples), 40) for samples in signals]
+    states = [None] * len(signals)
+    filtered = [[] for _ in signals]
+    for call in range(max(len(bounds) for bounds in splits)):
+        # The signals are split differently, and the shortest ones end before the others
+        chunks = [samples[bounds[call]:bounds[call + 1]] if call + 1 < len(bounds) else samples[bounds[-1]:]
+                  for samples, bounds in zip(signals, splits)]
+        filtered_chunks, states = data_processing.filter_chunks(chunks, states)
+        for row, chunk in enumerate(filtered_chunks):
+            assert chunk.shape == chunks[row].shape
+            filtered[row].append(chunk)
+
+    assert states[0] is None
+    for samples, chunks in zip(signals[1:], filtered[1:]):
+        np.testing.assert_allclose(np.concatenate(chunks), one_shot(samples)[0], rtol=0, atol=1e-9)
+
+
+def test_not_valid_chunk_shapes():
+    streaming = data_processing.StreamingFilter()
+    with pytest.raises(ValueError):
+        streaming.process(np.zeros((2, 2, 10)))
+    streaming.process(np.zeros((2, 10)))
+    with pytest.raises(ValueError):
+        streaming.process(np.zeros((3, 10)))
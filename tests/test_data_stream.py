@@ -0,0 +1,116 @@
+"""Batches of data_stream.TraceStream against data_parser.tracing_parser, on the bundled traces, file-like
+objects and a file which is still being written.
+
+Usage:
+    python -m pytest tests
+"""
+from indoor_positioning import data_parser, data_stream
+from dataclasses import fields
+
+import glob
+import io
+import threading
+import time
+import numpy as np
+import pytest
+
+BUNDLED_TRACES = sorted(glob.glob("./dataset/*/*/*.txt"))
+
+HEADER = ["#\tstartTime:1560566366968", "#\tSiteID:site\tSiteName:name\tFloorId:floor\tFloorName:F1"]
+
+
+def decoded(columns):
+    """Values of each field of columnar records, the codes replaced by their names"""
+    values = {}
+    for field in fields(columns):
+        if field.name.endswith("_names"):
+            continue
+        field_values = np.asarray(getattr(columns, field.name))
+        names = getattr(columns, field.name + "_names", None)
+        values[field.name] = field_values if names is None else np.asarray(names)[field_values]
+    return values
+
+
+def collect(stream):
+    """Batches of a stream concatenated by sensor"""
+    batches = {}
+    for sensor_name, columns in stream:
+        batches.setdefault(sensor_name, []).append(decoded(columns))
+    return {sensor_name: {name: np.concatenate([batch[name] for batch in sensor_batches])
+                          for name in sensor_batches[0]}
+            for sensor_name, sensor_batches in batches.items()}
+
+
+def assert_same_as_parser(streamed, trace_data):
+    for sensor_name in data_stream._SENSOR_COLUMNS:
+        expected = decoded(getattr(trace_data, sensor_name))
+        if not len(getattr(trace_data, sensor_name)):
+            assert sensor_name not in streamed
+            continue
+        for name, values in expected.items():
+            np.testing.assert_array_equal(streamed[sensor_name][name], values, err_msg=sensor_name + "." + name)
+
+
+@pytest.mark.skipif(not BUNDLED_TRACES, reason="no bundled traces")
+def test_bundled_trace_batches():
+    trace_filename = BUNDLED_TRACES[0]
+    stream = data_stream.stream_parser(trace_filename, batch_size=100)
+    sizes = []
+
+    def sized(stream):
+        for sensor_name, columns in stream:
+            sizes.append(len(columns))
+            yield sensor_name, columns
+
+    streamed = collect(sized(stream))
+    assert max(sizes) <= 100
+    trace_data = data_parser.tracing_parser(trace_filename, engine="python")
+    assert_same_as_parser(streamed, trace_data)
+    assert stream.metadata["site_id"] == trace_data.site_id and stream.metadata["floor_name"] == trace_data.floor_name
+
+
+@pytest.mark.parametrize("binary", [False, True])
+def test_file_like_sources(tmp_path, binary):
+    lines = HEADER + [
+        "1\tTYPE_WIFI\tcafé\tbssid\t-68\t5805\t1",
+        "2\tTYPE_BEACON\tuuid\tmajor\tminor\t-65\t-78\t3.78\tmac",
+        "3\tTYPE_ACCELEROMETER\t1.0\t2.0",
+        "4\tTYPE_UNKNOWN\t1",
+        "5\tTYPE_WAYPOINT\t1.5\t2.5",
+    ]
+    text = "\r\n".join(lines)
+    trace_file = tmp_path / "trace.txt"
+    trace_file.write_text(text, encoding="utf-8")
+    source = io.BytesIO(text.encode("utf-8")) if binary else io.StringIO(text)
+    streamed = collect(data_stream.stream_parser(source))
+    assert_same_as_parser(streamed, data_parser.tracing_parser(str(trace_file), engine="python"))
+    assert streamed["wifi"]["ssid"].tolist() == ["café"]
+
+
+def test_followed_file(tmp_path):
+    trace_file = tmp_path / "trace.txt"
+    trace_file.write_bytes(b"")
+    body = [("{}\tTYPE_WIFI\tcafé\tbssid\t-{}\t5805\t1".format(ts, ts % 90)) for ts in range(200)]
+    data = ("\n".join(HEADER + body + ["#\tendTime:200"]) + "\n").encode("utf-8")
+
+    def write():
+        # The writes end in the middle of lines, and of the multi-byte char
+        with open(trace_file, "ab") as f:
+            for start in range(0, len(data), 997):
+                f.write(data[start:start + 997])
+                f.flush()
+                time.sleep(0.005)
+
+    writer = threading.Thread(target=write)
+    stream = data_stream.stream_parser(str(trace_file), batch_size=64, follow=True, poll_interval=0.001, timeout=10)
+    writer.start()
+    streamed = collect(stream)
+    writer.join()
+    assert stream.finished
+    assert streamed["wifi"]["tss"].tolist() == list(range(200))
+    assert set(streamed["wifi"]["ssid"]) == {"café"}
+
+
+def test_not_valid_batch_size():
+    with pytest.raises(ValueError):
+        data_stream.TraceStream(io.StringIO(""), batch_size=0)
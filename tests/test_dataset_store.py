@@ -0,0 +1,155 @@
+"""Conversion of a synthetic corpus into dataset_store and its queries: projected columns and pushed-down
+predicates, up to date floors skipped, moved corpora replacing their partitions, failed floors keeping their
+last partitions and floors without any parsed trace kept in the manifest.
+
+Usage:
+    python -m pytest tests
+"""
+from indoor_positioning import data_parser
+
+import json
+import os
+import shutil
+import numpy as np
+import pytest
+
+dataset_store = pytest.importorskip("indoor_positioning.dataset_store")
+pytest.importorskip("pyarrow")
+
+START_TIME = 1560566366968
+
+
+def write_trace(floor_dir, name, start, n_scans, floor_id="floor1"):
+    """Trace of a floor with accelerometer samples, WiFi scans, beacon readings and two waypoints"""
+    lines = ["#\tstartTime:{}".format(start),
+             "#\tSiteID:site\tSiteName:name\tFloorId:{}\tFloorName:F1".format(floor_id),
+             "{}\tTYPE_WAYPOINT\t1.5\t2.5".format(start)]
+    for ix in range(n_scans):
+        ts = start + 100 * ix
+        lines.append("{}\tTYPE_ACCELEROMETER\t{}\t0.5\t9.8".format(ts, ix / 10))
+        lines.append("{}\tTYPE_WIFI\tssid\t{:02x}:00\t{}\t2412\t0".format(ts, ix % 7, -40 - ix % 30))
+        lines.append("{}\tTYPE_BEACON\tuuid\t1\t{}\t-65\t{}\t1.0\tmac".format(ts, ix % 3, -60 - ix % 20))
+    lines.append("{}\tTYPE_WAYPOINT\t3.5\t4.5".format(start + 100 * n_scans))
+    floor_dir.mkdir(parents=True, exist_ok=True)
+    (floor_dir / (name + ".txt")).write_text("\n".join(lines) + "\n")
+    return str(floor_dir / (name + ".txt"))
+
+
+@pytest.fixture
+def corpus(tmp_path):
+    root = tmp_path / "dataset"
+    traces = [write_trace(root / "site" / "F1", "trace_a", START_TIME, 300),
+              write_trace(root / "site" / "F1", "trace_b", START_TIME + 10 ** 6, 200)]
+    return root, traces
+
+
+def convert(root, store_dir, **kwargs):
+    return dataset_store.convert(str(root), str(store_dir), workers=1, progress=False, **kwargs)
+
+
+def part_files(store_dir):
+    return sorted(str(path.relative_to(store_dir)) for path in store_dir.rglob("*.parquet"))
+
+
+def test_query_projection_and_predicate(corpus, tmp_path):
+    root, traces = corpus
+    convert(root, tmp_path / "store", row_group_rows=64)
+    store = dataset_store.DatasetStore(str(tmp_path / "store"))
+    wifi = data_parser.tracing_parser(traces[0]).wifi
+    start, end = START_TIME + 5000, START_TIME + 12000
+
+    table = store.query("TYPE_WIFI", columns=["tss", "rssi"], floor_name="F1", start=start, end=end)
+    assert table.column_names == ["tss", "rssi"]
+    selected = (wifi.tss >= start) & (wifi.tss < end)
+    np.testing.assert_array_equal(table.column("tss").to_numpy(), wifi.tss[selected])
+    np.testing.assert_array_equal(table.column("rssi").to_numpy(), wifi.rssi[selected])
+    assert store.query("TYPE_WIFI", columns=["tss"], trace="trace_b").num_rows == 200
+    assert store.query("TYPE_WIFI", columns=["tss"], floor_name="F2").num_rows == 0
+
+    stored = store.trace_data("trace_a", site_id="site", floor_id="floor1")
+    parsed = data_parser.tracing_parser(traces[0])
+    np.testing.assert_array_equal(stored.beacon.tx_power, parsed.beacon.tx_power)
+    np.testing.assert_array_equal(stored.acc_calib.xyz, parsed.acc_calib.xyz)
+    np.testing.assert_array_equal(stored.waypoint.xy, parsed.waypoint.xy)
+
+
+def test_up_to_date_floors_are_skipped(corpus, tmp_path):
+    root, traces = corpus
+    store_dir = tmp_path / "store"
+    first = convert(root, store_dir)
+    assert [summary.get("skipped", False) for summary in first] == [False]
+    second = convert(root, store_dir)
+    assert second[0]["skipped"] and second[0]["traces"] == 2 and sorted(second[0]["files"]) == part_files(store_dir)
+
+    # A touched trace converts its floor again
+    os.utime(traces[1], ns=(0, 0))
+    third = convert(root, store_dir)
+    assert not third[0].get("skipped", False) and third[0]["traces"] == 2
+
+
+def test_moved_corpus_replaces_its_partitions(corpus, tmp_path):
+    root, _ = corpus
+    store_dir = tmp_path / "store"
+    convert(root, store_dir)
+    files = part_files(store_dir)
+    # The copy has new mtimes, so its floor is converted again, into the same partitions
+    moved = tmp_path / "moved"
+    shutil.copytree(root, moved, copy_function=shutil.copy)
+    summaries = convert(moved, store_dir)
+    assert not summaries[0].get("skipped", False)
+    assert part_files(store_dir) == files
+    store = dataset_store.DatasetStore(str(store_dir))
+    assert store.query("TYPE_WIFI", columns=["tss"]).num_rows == 500
+    assert list(json.loads((store_dir / dataset_store.MANIFEST_FILE).read_text())) == ["site/floor1"]
+
+
+def test_failed_floor_keeps_its_last_partitions(corpus, tmp_path, monkeypatch):
+    root, traces = corpus
+    store_dir = tmp_path / "store"
+    convert(root, store_dir)
+    manifest = (store_dir / dataset_store.MANIFEST_FILE).read_text()
+    before = {name: (store_dir / name).read_bytes() for name in part_files(store_dir)}
+
+    write_trace(root / "site" / "F1", "trace_c", START_TIME + 2 * 10 ** 6, 100)
+    calls = []
+
+    def failing_record_table(*args):
+        calls.append(args)
+        if len(calls) > len(data_parser.SENSOR_TYPES):
+            raise OSError("disk full")
+        return record_table(*args)
+
+    record_table = dataset_store._record_table
+    monkeypatch.setattr(dataset_store, "_record_table", failing_record_table)
+    with pytest.raises(OSError):
+        dataset_store.convert_floor(str(root / "site" / "F1"), str(store_dir))
+    # The forked worker of convert fails the same way, the floor is reported but its manifest entry is kept
+    summaries = convert(root, store_dir)
+    assert summaries[0]["errors"] == ["OSError: disk full"]
+
+    assert {name: (store_dir / name).read_bytes() for name in part_files(store_dir)} == before
+    assert not [path for path in store_dir.rglob("*") if ".tmp" in path.name]
+    assert (store_dir / dataset_store.MANIFEST_FILE).read_text() == manifest
+
+
+def test_unparsed_floor_is_kept_in_the_manifest(corpus, tmp_path):
+    root, _ = corpus
+    store_dir = tmp_path / "store"
+    broken = root / "site" / "F2" / "broken.txt"
+    broken.parent.mkdir()
+    broken.write_text("#\tstartTime:0\n#\tSiteID:site\tFloorId:floor2\n1\tTYPE_ACCELEROMETER\tx\t2\t3\n")
+
+    summaries = {os.path.basename(summary["floor"]): summary for summary in convert(root, store_dir)}
+    assert summaries["F2"]["traces"] == 0 and len(summaries["F2"]["errors"]) == 1
+    manifest = json.loads((store_dir / dataset_store.MANIFEST_FILE).read_text())
+    assert sorted(manifest) == ["floor_dir=site/F2", "site/floor1"]
+
+    summaries = {os.path.basename(summary["floor"]): summary for summary in convert(root, store_dir)}
+    assert summaries["F2"]["skipped"] and summaries["F2"]["errors"] == manifest["floor_dir=site/F2"]["errors"]
+    assert dataset_store.main([str(root), "--store-dir", str(store_dir), "--workers", "1", "--quiet"]) == 1
+
+    # Once fixed, the floor is converted and its entry replaced by those of its partitions
+    write_trace(broken.parent, "broken", START_TIME, 50, floor_id="floor2")
+    summaries = {os.path.basename(summary["floor"]): summary for summary in convert(root, store_dir)}
+    assert summaries["F2"]["traces"] == 1 and not summaries["F2"]["errors"]
+    assert sorted(json.loads((store_dir / dataset_store.MANIFEST_FILE).read_text())) == ["site/floor1", "site/floor2"]
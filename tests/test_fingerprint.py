@@ -0,0 +1,80 @@
+"""Incremental index of fingerprint.FingerprintDB: traces added after the KD-tree was built are found by the
+queries without rebuilding it, until they exceed REBUILD_FRACTION of the tree.
+
+Usage:
+    python -m pytest tests
+"""
+from indoor_positioning import data_parser, fingerprint
+
+import numpy as np
+import pytest
+
+N_ACCESS_POINTS = 120
+
+ACCESS_POINTS = np.random.default_rng(0).uniform(0, 100, (N_ACCESS_POINTS, 2))
+
+
+def write_trace(tmp_path, name, n_scans, seed):
+    """Trace walking a random line of a 100 m floor, whose scans hear the 8 closest access points with some noise"""
+    rng = np.random.default_rng(seed)
+    start, end = rng.uniform(0, 100, (2, 2))
+    lines = ["#\tstartTime:0", "#\tSiteID:site\tSiteName:name\tFloorId:floor\tFloorName:F1",
+             "0\tTYPE_WAYPOINT\t{}\t{}".format(*start)]
+    for scan_ix in range(n_scans):
+        xy = start + (end - start) * (scan_ix + 1) / (n_scans + 1)
+        distances = np.linalg.norm(ACCESS_POINTS - xy, axis=1)
+        for ap_ix in np.argsort(distances)[:8]:
+            lines.append("{}\tTYPE_WIFI\tssid\t{:02x}:00\t{}\t2412\t0".format(
+                scan_ix + 1, ap_ix, int(-40 - distances[ap_ix] / 2 + rng.normal(0, 3))))
+    lines.append("{}\tTYPE_WAYPOINT\t{}\t{}".format(n_scans + 1, *end))
+    trace_file = tmp_path / (name + ".txt")
+    trace_file.write_text("\n".join(lines) + "\n")
+    return data_parser.tracing_parser(str(trace_file))
+
+
+def scan_of(db, row):
+    """BSSIDs and RSSI of a fingerprint of the database"""
+    bssids = sorted(db.bssid_ids, key=db.bssid_ids.get)
+    vector = db._stack_chunks(db._chunks)[0][row]
+    return [bssids[column] for column in vector.indices], vector.data + fingerprint.MISSING_RSSI
+
+
+@pytest.fixture
+def large_db(tmp_path):
+    db = fingerprint.FingerprintDB()
+    db.add_trace(write_trace(tmp_path, "large", fingerprint.EXACT_SEARCH_LIMIT + 500, seed=1))
+    db.knn(*scan_of(db, 0))
+    assert db._index["tree"] is not None
+    return db
+
+
+def test_added_traces_are_searched_without_rebuilding(tmp_path, large_db):
+    tree = large_db._index["tree"]
+    n_indexed = len(large_db)
+    large_db.add_trace(write_trace(tmp_path, "small", 200, seed=2))
+
+    for row in [n_indexed, n_indexed + 57, len(large_db) - 1, 10]:
+        position, neighbours, distances = large_db.knn(*scan_of(large_db, row), k=3)
+        assert large_db._index["tree"] is tree
+        assert distances[0] == pytest.approx(0, abs=1e-6)
+        _, _, exact_distances = large_db.knn(*scan_of(large_db, row), k=3, exact=True)
+        np.testing.assert_allclose(distances, exact_distances)
+
+
+def test_index_is_rebuilt_past_the_fraction(tmp_path, large_db):
+    tree = large_db._index["tree"]
+    n_added = int(fingerprint.REBUILD_FRACTION * tree.n) + 1
+    large_db.add_trace(write_trace(tmp_path, "other", n_added, seed=3))
+    large_db.knn(*scan_of(large_db, 0))
+    assert large_db._index["tree"] is not tree
+    assert large_db._index["tree"].n == len(large_db)
+
+
+def test_saved_database_matches(tmp_path, large_db):
+    large_db.add_trace(write_trace(tmp_path, "small", 200, seed=2))
+    large_db.save(str(tmp_path / "db"))
+    loaded = fingerprint.FingerprintDB.load(str(tmp_path / "db"))
+    assert len(loaded) == len(large_db) and loaded.traces == large_db.traces
+    for row in [0, len(large_db) - 1]:
+        scan = scan_of(large_db, row)
+        np.testing.assert_allclose(loaded.knn(*scan)[2], large_db.knn(*scan)[2])
@@ -0,0 +1,51 @@
+"""Equivalence of the union and iterative methods of gridding.format.extract_geometries, on the bundled floors
+and on a synthetic floor.
+
+Usage:
+    python -m pytest tests
+"""
+from indoor_positioning.gridding.format import extract_geometries
+
+import glob
+import json
+import pytest
+
+BUNDLED_GEOJSONS = sorted(glob.glob("./dataset/metadata/*/*/geojson_map.json"))
+
+
+def polygon_feature(coordinates):
+    return {"type": "Feature", "properties": {}, "geometry": {"type": "Polygon", "coordinates": [coordinates]}}
+
+
+def assert_same_geometries(geojson_file):
+    union = extract_geometries(geojson_file, method="union")
+    iterative = extract_geometries(geojson_file, method="iterative")
+    assert union.area == pytest.approx(iterative.area, rel=1e-9)
+    assert union.symmetric_difference(iterative).area < 1e-4
+    return union
+
+
+@pytest.mark.skipif(not BUNDLED_GEOJSONS, reason="no bundled floors")
+@pytest.mark.parametrize("geojson_file", BUNDLED_GEOJSONS)
+def test_bundled_floors(geojson_file):
+    assert_same_geometries(geojson_file)
+
+
+def test_synthetic_floor(tmp_path):
+    # Overlapping shops, a shop crossing the floor outline and a shop outside of it
+    shops = [[[1, 1], [4, 1], [4, 4], [1, 4], [1, 1]],
+             [[3, 3], [6, 3], [6, 6], [3, 6], [3, 3]],
+             [[8, 8], [12, 8], [12, 9], [8, 9], [8, 8]],
+             [[20, 20], [21, 20], [21, 21], [20, 21], [20, 20]]]
+    geojson_file = tmp_path / "geojson_map.json"
+    geojson_file.write_text(json.dumps({"type": "FeatureCollection", "features": [
+        polygon_feature([[0, 0], [10, 0], [10, 10], [0, 10], [0, 0]])] + [polygon_feature(shop) for shop in shops]}))
+
+    geometry = assert_same_geometries(str(geojson_file))
+    # Only the parts of the shops inside the floor are kept
+    assert geometry.bounds == pytest.approx((0.9, 0.9, 10, 9.1))
+
+
+def test_not_valid_method(tmp_path):
+    with pytest.raises(ValueError):
+        extract_geometries(str(tmp_path / "geojson_map.json"), method="loop")
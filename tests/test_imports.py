@@ -0,0 +1,44 @@
+"""Lazy imports of the package: its modules load scipy, pandas, plotly, PIL and matplotlib only when a function
+using them is called, so the parse-only processes never load them. Each check runs in a new interpreter.
+
+Usage:
+    python -m pytest tests
+"""
+import glob
+import json
+import subprocess
+import sys
+import pytest
+
+BUNDLED_TRACES = sorted(glob.glob("./dataset/*/*/*.txt"))
+
+HEAVY_MODULES = ["scipy", "pandas", "plotly", "PIL", "matplotlib", "cProfile"]
+
+
+def loaded_modules(code):
+    """Heavy modules loaded by running code in a new interpreter"""
+    code += "\nimport json, sys\nprint(json.dumps(sorted({name.split('.')[0] for name in sys.modules})))"
+    output = subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True).stdout
+    return set(json.loads(output.splitlines()[-1])) & set(HEAVY_MODULES)
+
+
+@pytest.mark.parametrize("module", ["data_parser", "data_stream", "trace_cache", "waypoint_index", "data_processing",
+                                    "pdr", "batch", "instrumentation", "visualizer", "fingerprint", "beacon",
+                                    "magnetic_map", "service"])
+def test_modules_do_not_load_heavy_dependencies(module):
+    assert loaded_modules("import indoor_positioning.{}".format(module)) == set()
+
+
+@pytest.mark.skipif(not BUNDLED_TRACES, reason="no bundled traces")
+def test_parse_only_process(tmp_path):
+    code = "\n".join(["from indoor_positioning import trace_cache",
+                      "cache = trace_cache.TraceCache({!r})".format(str(tmp_path)),
+                      "for _ in range(2):",
+                      "    cache.load({!r})".format(BUNDLED_TRACES[0])])
+    assert loaded_modules(code) == set()
+
+
+def test_functions_import_their_dependencies():
+    pytest.importorskip("scipy")
+    code = "from indoor_positioning import data_processing\ndata_processing.butter_filter(output='sos')"
+    assert loaded_modules(code) == {"scipy"}
@@ -0,0 +1,64 @@
+"""Recorder of instrumentation, enabled once for the process: the stages of every thread are recorded, each
+thread with its own trace id and parent stages.
+
+Usage:
+    python -m pytest tests
+"""
+from concurrent.futures import ThreadPoolExecutor
+from indoor_positioning import instrumentation
+
+import threading
+import pytest
+
+
+@instrumentation.instrumented("leaf")
+def leaf(barrier):
+    # The threads are all inside their trace and parent stages at once
+    barrier.wait(timeout=10)
+
+
+class ListSink:
+    def __init__(self):
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def sink():
+    sink = ListSink()
+    instrumentation.enable(sink)
+    yield sink
+    instrumentation.disable()
+
+
+def test_stages_of_every_thread_are_recorded(sink):
+    n_threads = 4
+    barrier = threading.Barrier(n_threads)
+
+    def work(thread_ix):
+        with instrumentation.trace("trace{}".format(thread_ix)):
+            with instrumentation.stage("parent{}".format(thread_ix)):
+                leaf(barrier)
+
+    with ThreadPoolExecutor(n_threads) as pool:
+        list(pool.map(work, range(n_threads)))
+
+    leaves = [record for record in sink.records if record["stage"] == "leaf"]
+    assert len(leaves) == n_threads
+    assert sorted((record["trace"], record["parent"]) for record in leaves) == [
+        ("trace{}".format(ix), "parent{}".format(ix)) for ix in range(n_threads)]
+    traces = [record for record in sink.records if record["stage"] == "trace"]
+    assert sorted(record["trace"] for record in traces) == ["trace{}".format(ix) for ix in range(n_threads)]
+    assert all(record["parent"] is None for record in traces)
+
+
+def test_disabled_in_every_thread(sink):
+    instrumentation.disable()
+    with ThreadPoolExecutor(1) as pool:
+        pool.submit(leaf, threading.Barrier(1)).result()
+    assert sink.records == []
@@ -0,0 +1,100 @@
+"""Cells of magnetic_map.MagneticMap: the batches merged into the map give the mean and variance of all their
+samples, the sequences of a synthetic field are matched at their start and rotation, and the floor maps only
+add the new traces.
+
+Usage:
+    python -m pytest tests
+"""
+from indoor_positioning import magnetic_map as magnetic_map_module
+from indoor_positioning.gridding.occupancy import OccupancyGridMap
+from indoor_positioning.magnetic_map import MagneticMap, build_floor_map
+from shapely.geometry import MultiPolygon, box
+
+import numpy as np
+import pytest
+
+# 20 x 20 grid of 1 m cells
+GRID = OccupancyGridMap(MultiPolygon([box(0, 0, 1, 1), box(19, 19, 20, 20)]), 1.0)
+
+
+def field(xy):
+    """Smooth synthetic magnitude in uT"""
+    return 45 + 10 * np.sin(xy[..., 0] / 3) + 8 * np.cos(xy[..., 1] / 4) + 0.1 * xy[..., 0] * xy[..., 1]
+
+
+def test_merged_batches_equal_direct_statistics():
+    rng = np.random.default_rng(0)
+    # Samples out of the grid are dropped, and the magnitudes have a large mean for their variance
+    xy = rng.uniform(-2, 22, (20000, 2))
+    values = 50 + rng.normal(0, 0.01, xy.shape[0]) + 1e-3 * xy[:, 0]
+    magnetic_map = MagneticMap(GRID)
+    bounds = np.concatenate([[0], np.sort(rng.integers(0, xy.shape[0], 30)), [xy.shape[0]]])
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        magnetic_map.add_samples(xy[start:end], values[start:end])
+
+    idx = np.floor(xy).astype(np.int64)
+    inside = ((idx >= 0) & (idx < 20)).all(axis=1)
+    assert magnetic_map.count.sum() == inside.sum()
+    for row, col in [(0, 0), (7, 3), (19, 19)]:
+        cell_values = values[inside & (idx[:, 0] == row) & (idx[:, 1] == col)]
+        assert magnetic_map.count[row, col] == cell_values.shape[0]
+        assert magnetic_map.mean[row, col] == pytest.approx(cell_values.mean(), rel=1e-12)
+        assert magnetic_map.variance[row, col] == pytest.approx(cell_values.var(ddof=1), rel=1e-6)
+
+    single = MagneticMap(GRID)
+    single.add_samples(np.array([[3.5, 3.5]]), np.array([40.0]))
+    assert single.count[3, 3] == 1 and np.isnan(single.variance[3, 3]) and np.isnan(single.variance[0, 0])
+
+
+def test_sequence_is_matched_at_its_start_and_rotation(monkeypatch):
+    centres = GRID._idx_to_coords(np.argwhere(np.ones(GRID.grid_map.shape, dtype=bool)))
+    magnetic_map = MagneticMap(GRID)
+    rng = np.random.default_rng(1)
+    for _ in range(5):
+        magnetic_map.add_samples(centres, field(centres) + rng.normal(0, 0.2, centres.shape[0]))
+
+    # An L-shaped walk from (5.5, 6.5), rotated by 90 degrees
+    offsets = np.array([[0, 0], [1, 0], [2, 0], [3, 0], [4, 0], [4, 1], [4, 2], [4, 3], [4, 4]], dtype=float)
+    start = np.array([5.5, 6.5])
+    values = field(start + np.stack([-offsets[:, 1], offsets[:, 0]], axis=1))
+    rotations = np.arange(4) * np.pi / 2
+    positions, best_rotations, costs = magnetic_map.match(values, offsets, rotations=rotations, top_k=5)
+    np.testing.assert_allclose(positions[0], start)
+    assert best_rotations[0] == pytest.approx(np.pi / 2) and costs[0] < 1 and np.all(np.diff(costs) >= 0)
+
+    # Lookups bounded to a few candidates at once give the same hypotheses
+    monkeypatch.setattr(magnetic_map_module, "MATCH_CHUNK_SIZE", 7 * offsets.shape[0] * rotations.shape[0])
+    chunked = magnetic_map.match(values, offsets, rotations=rotations, top_k=5)
+    for chunked_values, expected in zip(chunked, [positions, best_rotations, costs]):
+        np.testing.assert_array_equal(chunked_values, expected)
+
+
+def write_trace(floor_dir, name, n_samples, y):
+    lines = ["#\tstartTime:0", "#\tSiteID:site\tSiteName:name\tFloorId:floor\tFloorName:F1",
+             "0\tTYPE_WAYPOINT\t2.5\t{}".format(y), "{}\tTYPE_WAYPOINT\t17.5\t{}".format(20 * n_samples, y)]
+    for ix in range(n_samples):
+        xy = np.array([2.5 + 15 * ix / n_samples, y])
+        lines.append("{}\tTYPE_MAGNETIC_FIELD\t{}\t0.0\t0.0\t3".format(20 * ix, field(xy)))
+    floor_dir.mkdir(parents=True, exist_ok=True)
+    (floor_dir / (name + ".txt")).write_text("\n".join(lines) + "\n")
+
+
+def test_floor_map_adds_the_new_traces(tmp_path):
+    pytest.importorskip("pandas")
+    floor_dir = tmp_path / "site" / "F1"
+    map_file = str(tmp_path / "maps" / "F1.npz")
+    write_trace(floor_dir, "trace_a", 300, 4.5)
+    first = build_floor_map(str(floor_dir), GRID, map_file)
+    assert first.traces == ["trace_a"] and first.count.sum() == 300
+
+    write_trace(floor_dir, "trace_b", 200, 12.5)
+    second = build_floor_map(str(floor_dir), GRID, map_file)
+    assert second.traces == ["trace_a", "trace_b"] and second.count.sum() == 500
+    np.testing.assert_array_equal(second.count[:, 4], first.count[:, 4])
+    known = second.count > 0
+    np.testing.assert_allclose(second.mean[known], field(GRID._idx_to_coords(np.argwhere(known))), atol=1.5)
+
+    loaded = MagneticMap.load(map_file, GRID)
+    np.testing.assert_array_equal(loaded.m2, second.m2)
+    with pytest.raises(ValueError):
+        MagneticMap.load(map_file, OccupancyGridMap(MultiPolygon([box(0, 0, 1, 1), box(9, 9, 10, 10)]), 1.0))
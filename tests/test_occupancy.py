@@ -0,0 +1,165 @@
+"""Walkable cells of gridding.occupancy.OccupancyGridMap: the cells out of the floor outline are not walkable,
+on a synthetic L-shaped floor, the scanline and pointwise methods build the same grid, and the saved grids are
+loaded as memory maps until their floor changes.
+
+Usage:
+    python -m pytest tests
+"""
+from indoor_positioning import data_parser
+from indoor_positioning.gridding import occupancy
+from indoor_positioning.gridding.format import extract_geometries, extract_outline, transform
+from indoor_positioning.gridding.occupancy import OccupancyGridMap
+from shapely import affinity
+from shapely.geometry import MultiPolygon, Polygon, box
+
+import glob
+import json
+import os
+import numpy as np
+import pytest
+
+BUNDLED_GEOJSONS = sorted(glob.glob("./dataset/metadata/*/*/geojson_map.json"))
+
+# 20 x 20 m frame, whose top right quarter is out of the L-shaped floor
+OUTLINE = Polygon([(0, 0), (20, 0), (20, 10), (10, 10), (10, 20), (0, 20)])
+LAYOUT = MultiPolygon([box(0, 0, 1, 1), box(4, 4, 6, 6), box(19, 19, 20, 20)])
+
+
+@pytest.fixture(params=["scanline", "pointwise"])
+def grid(request):
+    return OccupancyGridMap(LAYOUT, 0.5, method=request.param, outline=OUTLINE)
+
+
+def test_cells_out_of_the_outline_are_not_walkable(grid):
+    np.testing.assert_array_equal(grid.is_free(np.array([[15, 5], [5, 15], [15, 15], [5, 5], [0.5, 0.5]])),
+                                  [True, True, False, False, False])
+    assert grid.labels[grid.walkable].min() == 1 and grid.labels.max() == 1
+    # The nearest cells which are not walkable are those above the outline, 3 cells away
+    np.testing.assert_allclose(grid.obstacle_distance(np.array([[15.25, 15.25], [15.25, 8.75]])), [0, 1.5])
+
+
+def test_segment_leaving_the_outline_is_blocked(grid):
+    starts = np.array([[15, 5], [15, 5], [9, 15], [2, 8]])
+    ends = np.array([[5, 17], [15, 15], [9, 2], [8, 8]])
+    # Across the missing quarter, into it, along the inner edge, and above the shop
+    np.testing.assert_array_equal(grid.crosses_obstacle(starts, ends), [True, True, False, False])
+    np.testing.assert_array_equal(grid.reachable(starts, ends), [True, False, True, True])
+
+
+def test_without_outline_every_free_cell_is_walkable():
+    grid = OccupancyGridMap(LAYOUT, 0.5)
+    np.testing.assert_array_equal(grid.walkable, ~grid.grid_map)
+    assert not grid.crosses_obstacle(np.array([[15, 5]]), np.array([[5, 15]]))[0]
+
+
+def test_saved_grid_keeps_the_walkable_cells(tmp_path, grid):
+    grid.save(str(tmp_path / "grid"))
+    loaded = OccupancyGridMap.load(str(tmp_path / "grid"))
+    assert loaded.has_outline
+    np.testing.assert_array_equal(loaded.walkable, grid.walkable)
+    np.testing.assert_array_equal(loaded.labels, grid.labels)
+
+
+def test_loaded_grid_is_a_read_only_memory_map(tmp_path, grid):
+    grid.save(str(tmp_path / "grid"), source_hashes={"geojson_map.json": "abc"})
+    assert not [path for path in tmp_path.iterdir() if ".tmp" in path.name]
+    loaded = OccupancyGridMap.load(str(tmp_path / "grid"))
+    assert loaded.source_hashes == {"geojson_map.json": "abc"} and loaded.cell_size == grid.cell_size
+    for name in ["grid_map", "walkable", "distance_map", "labels"]:
+        layer = getattr(loaded, name)
+        assert isinstance(layer, np.memmap) and not layer.flags.writeable, name
+        np.testing.assert_array_equal(layer, getattr(grid, name))
+    assert loaded.grid_map.dtype == bool
+    np.testing.assert_array_equal(loaded.obstacle_distance(np.array([[15.25, 15.25], [15.25, 8.75]])), [0, 1.5])
+    with pytest.raises(ValueError):
+        loaded.walkable[0, 0] = True
+
+
+def write_floor(floor_dir, shop):
+    """Geojson of the L-shaped floor with a shop, and shops in two corners which keep the bounds of its layout"""
+    features = [[[0, 0], [20, 0], [20, 10], [10, 10], [10, 20], [0, 20], [0, 0]], shop,
+                [[0, 0], [1, 0], [1, 1], [0, 1], [0, 0]], [[19, 9], [20, 9], [20, 10], [19, 10], [19, 9]],
+                [[9, 19], [10, 19], [10, 20], [9, 20], [9, 19]]]
+    floor_dir.mkdir(parents=True, exist_ok=True)
+    (floor_dir / "geojson_map.json").write_text(json.dumps({"type": "FeatureCollection", "features": [
+        {"type": "Feature", "properties": {}, "geometry": {"type": "Polygon", "coordinates": [coordinates]}}
+        for coordinates in features]}))
+    (floor_dir / "floor_info.json").write_text(json.dumps({"map_info": {"height": 20, "width": 20}}))
+    return {"width": 20, "height": 20, "floor_geojson": str(floor_dir / "geojson_map.json")}
+
+
+def test_floor_grid_is_built_again_when_its_floor_changes(tmp_path, monkeypatch):
+    builds = []
+
+    def counted_extract_geometries(geojson_file):
+        builds.append(geojson_file)
+        return extract_geometries(geojson_file)
+
+    monkeypatch.setattr(occupancy, "extract_geometries", counted_extract_geometries)
+    floorplan = write_floor(tmp_path / "metadata" / "site" / "F1", [[4, 4], [6, 4], [6, 6], [4, 6], [4, 4]])
+    grid_dir = str(tmp_path / "grids")
+    built = occupancy.floor_grid_map(floorplan, 0.5, grid_dir)
+    assert not isinstance(built.walkable, np.memmap) and not built.is_free(np.array([[15, 15]]))[0]
+    loaded = occupancy.floor_grid_map(floorplan, 0.5, grid_dir)
+    assert len(builds) == 1 and isinstance(loaded.walkable, np.memmap)
+    np.testing.assert_array_equal(loaded.walkable, built.walkable)
+
+    # Another cell size has its own grid
+    assert occupancy.floor_grid_map(floorplan, 1.0, grid_dir).walkable.shape == (20, 20)
+    assert len(builds) == 2 and occupancy.floor_grid_map(floorplan, 0.5, grid_dir).cell_size == 0.5
+    assert len(builds) == 2
+
+    # An edited floor overwrites its grid
+    write_floor(tmp_path / "metadata" / "site" / "F1", [[14, 4], [16, 4], [16, 6], [14, 6], [14, 4]])
+    edited = occupancy.floor_grid_map(floorplan, 0.5, grid_dir)
+    assert len(builds) == 3
+    assert edited.is_free(np.array([[5, 5]]))[0] and not edited.is_free(np.array([[15, 5]]))[0]
+    assert isinstance(occupancy.floor_grid_map(floorplan, 0.5, grid_dir).walkable, np.memmap)
+    assert len(builds) == 3 and len(list((tmp_path / "grids").glob("*.json"))) == 2
+
+
+def assert_same_rasters(layout, cell_size, outline=None):
+    scanline = OccupancyGridMap(layout, cell_size, outline=outline)
+    pointwise = OccupancyGridMap(layout, cell_size, method="pointwise", outline=outline)
+    np.testing.assert_array_equal(scanline.grid_map, pointwise.grid_map)
+    np.testing.assert_array_equal(scanline.walkable, pointwise.walkable)
+    return scanline
+
+
+@pytest.mark.parametrize("cell_size", [0.5, 0.3, 1 / 3, 0.7])
+def test_scanline_of_synthetic_floors(cell_size):
+    assert_same_rasters(LAYOUT, cell_size, outline=OUTLINE)
+    # A hole, and vertices and edges on the cell centres of the 0.5 m grid
+    courtyard = Polygon([(0.25, 0.25), (9.75, 0.25), (9.75, 9.75), (0.25, 9.75)],
+                        [[(2.25, 2.25), (7.75, 2.25), (5.25, 5.25), (7.75, 7.75), (2.25, 7.75)]])
+    triangles = MultiPolygon([Polygon([(10.25, 0.25), (15.25, 5.25), (10.25, 10.25)]),
+                              Polygon([(15.75, 0.75), (19.75, 0.75), (17.75, 9.75)])])
+    grid = assert_same_rasters(MultiPolygon([courtyard, *triangles.geoms]), cell_size)
+    assert grid.grid_map.any() and not grid.grid_map.all()
+
+
+def test_scanline_of_random_polygons():
+    rng = np.random.default_rng(0)
+    for _ in range(20):
+        # Star-shaped polygons, rotated and with vertices snapped onto the cell centres or not
+        n_vertices = rng.integers(3, 30)
+        angles = np.sort(rng.uniform(0, 2 * np.pi, n_vertices))
+        radius = rng.uniform(1, 8, n_vertices)
+        vertices = np.stack([10 + radius * np.cos(angles), 10 + radius * np.sin(angles)], axis=1)
+        if rng.random() < 0.5:
+            vertices = np.floor(vertices / 0.5) * 0.5 + 0.25
+        polygon = affinity.rotate(Polygon(vertices).buffer(0), rng.uniform(0, 90), origin=(10, 10))
+        frame = box(19.9, 19.9, 20, 20)
+        assert_same_rasters(MultiPolygon([*getattr(polygon, "geoms", [polygon]), frame]), 0.5)
+
+
+@pytest.mark.skipif(not BUNDLED_GEOJSONS, reason="no bundled floors")
+def test_scanline_of_a_bundled_floor():
+    geojson_file = BUNDLED_GEOJSONS[0]
+    floor_dir = os.path.dirname(geojson_file)
+    floorplan = data_parser.floorplan("./dataset/metadata/", floor_dir.replace("metadata/", "", 1))
+    geometry = extract_geometries(geojson_file)
+    layout = transform(geometry, floorplan)
+    outline = transform(extract_outline(geojson_file), floorplan, bounds=geometry.bounds)
+    grid = assert_same_rasters(layout, 1.0, outline=outline)
+    assert grid.walkable.any() and grid.grid_map.any()
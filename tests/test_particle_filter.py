@@ -0,0 +1,59 @@
+"""Particles of particle_filter.ParticleFilter on the walkable cells of a synthetic L-shaped floor, and their
+re-seeding once every one of them is dropped.
+
+Usage:
+    python -m pytest tests
+"""
+from indoor_positioning.gridding.occupancy import OccupancyGridMap
+from indoor_positioning.particle_filter import ParticleFilter, predict_batch
+from shapely.geometry import MultiPolygon, Polygon, box
+
+import numpy as np
+import pytest
+
+# 20 x 20 m frame, whose top right quarter is out of the L-shaped floor
+OUTLINE = Polygon([(0, 0), (20, 0), (20, 10), (10, 10), (10, 20), (0, 20)])
+LAYOUT = MultiPolygon([box(0, 0, 1, 1), box(4, 4, 6, 6), box(19, 19, 20, 20)])
+
+
+@pytest.fixture(scope="module")
+def grid():
+    return OccupancyGridMap(LAYOUT, 0.5, outline=OUTLINE)
+
+
+def particles(particle_filter):
+    return np.stack([particle_filter.x, particle_filter.y], axis=1)
+
+
+def test_initialized_over_the_walkable_cells(grid):
+    particle_filter = ParticleFilter(grid, n_particles=5000, seed=0)
+    particle_filter.initialize()
+    assert grid.is_free(particles(particle_filter)).all()
+    assert particle_filter.weights.sum() == pytest.approx(1)
+
+
+def test_blocked_particles_are_reseeded_around_the_last_estimate(grid):
+    particle_filter = ParticleFilter(grid, n_particles=2000, seed=0, reseed_spread=1.0)
+    particle_filter.initialize(center=(15, 8), spread=0.2)
+    # Every particle walks into the top right quarter, out of the floor
+    particle_filter.predict(4, 0, length_noise=0.05, heading_noise=0.01)
+    free = grid.is_free(particles(particle_filter))
+    assert free.any() and (particle_filter.weights[~free] == 0).all()
+    assert particle_filter.weights.sum() == pytest.approx(1)
+    np.testing.assert_allclose(particle_filter.estimate(), (15, 9.3), atol=0.5)
+
+
+def test_reseeded_over_the_walkable_cells_far_from_them(grid):
+    particle_filter = ParticleFilter(grid, n_particles=2000, seed=0, reseed_spread=1.0)
+    particle_filter.initialize(center=(16, 16), spread=0.5)
+    assert grid.is_free(particles(particle_filter)).all()
+    assert particle_filter.weights.sum() == pytest.approx(1)
+
+
+def test_predict_batch_reseeds_each_filter(grid):
+    filters = [ParticleFilter(grid, n_particles=500, seed=seed) for seed in range(2)]
+    for particle_filter, center in zip(filters, [(15, 8), (5, 15)]):
+        particle_filter.initialize(center=center, spread=0.2)
+    predict_batch(filters, [4, 1], [0, 0], length_noise=0.05, heading_noise=0.01)
+    assert grid.is_free(particles(filters[0]))[filters[0].weights > 0].all()
+    np.testing.assert_allclose(filters[1].estimate(), (5, 16), atol=0.2)
@@ -0,0 +1,52 @@
+"""Paginated report of report.build_report: pages of page_size traces referencing one shared plotly.js, broken
+traces reported in their section, and pages whose size does not grow with the samples of the traces.
+
+Usage:
+    python -m pytest tests
+"""
+from indoor_positioning import visualizer
+
+import glob
+import html
+import shutil
+import pytest
+
+report = pytest.importorskip("indoor_positioning.report")
+pytest.importorskip("pandas")
+
+BUNDLED_FLOORS = sorted(glob.glob("./dataset/*/F1"))
+
+
+@pytest.mark.skipif(not BUNDLED_FLOORS, reason="no bundled traces")
+def test_pages_share_plotlyjs(tmp_path):
+    root = tmp_path / "venue"
+    shutil.copytree(BUNDLED_FLOORS[0], root / "F1")
+    (root / "F1" / "broken.txt").write_text("#\tstartTime:0\n1\tTYPE_ACCELEROMETER\tx\t2\t3\n")
+    n_traces = len(list((root / "F1").glob("*.txt")))
+
+    output_dir = tmp_path / "report"
+    summaries = report.build_report(str(root), str(output_dir), workers=1, page_size=2, max_points=500,
+                                    progress=False)
+    assert len(summaries) == n_traces
+    assert [summary["page"] for summary in summaries] == \
+        ["page_{:04d}.html".format(ix // 2 + 1) for ix in range(n_traces)]
+    errors = [summary for summary in summaries if "error" in summary]
+    assert [summary["trace"].endswith("broken.txt") for summary in errors] == [True]
+
+    header = (output_dir / visualizer.PLOTLYJS_FILE).read_text(encoding="utf-8")[:60]
+    pages = sorted(output_dir.glob("page_*.html"))
+    assert len(pages) == (n_traces + 1) // 2
+    for page in pages:
+        text = page.read_text(encoding="utf-8")
+        assert header not in text and text.count('src="{}"'.format(visualizer.PLOTLYJS_FILE)) == 1
+        # Downsampled figures, far below the millions of bytes of plotly.js or of the raw samples
+        assert page.stat().st_size < 500000
+    index = (output_dir / "index.html").read_text(encoding="utf-8")
+    assert all(summary["page"] in index for summary in summaries) and html.escape(errors[0]["error"]) in index
+
+    assert report.main([str(root), "--output", str(output_dir), "--workers", "1", "--quiet"]) == 1
+
+
+def test_not_valid_page_size(tmp_path):
+    with pytest.raises(ValueError):
+        report.build_report(str(tmp_path), str(tmp_path / "report"), workers=1, page_size=0)
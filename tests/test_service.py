@@ -0,0 +1,149 @@
+"""Micro-batches of service.LocalizationService: streamed steps against those of pdr.pdr, failing sessions
+isolated within their batch, requests held back while their floor loads, and the HTTP errors.
+
+Usage:
+    python -m pytest tests
+"""
+from indoor_positioning import data_parser, pdr, service
+
+import asyncio
+import glob
+import threading
+import numpy as np
+import pytest
+
+BUNDLED_TRACES = sorted(glob.glob("./dataset/*/*/*.txt"))
+
+
+class NoAssets:
+    """Asset store without any floor, whose loading waits for loaded to be set"""
+
+    def __init__(self):
+        self.loaded = threading.Event()
+        self.floors = {}
+
+    def get(self, site_id, floor_name):
+        if (site_id, floor_name) not in self.floors:
+            self.loaded.wait(timeout=10)
+            self.floors[site_id, floor_name] = None
+        return self.floors[site_id, floor_name]
+
+    def is_loaded(self, site_id, floor_name):
+        return (site_id, floor_name) in self.floors
+
+
+def stream(trace_filename, interval=1.0):
+    """Steps of a trace streamed request by request to a service"""
+    localization_service = service.LocalizationService(NoAssets())
+    localization_service.assets.loaded.set()
+    steps = []
+    for _, chunk in service.trace_chunks(trace_filename, interval):
+        steps += localization_service.process_batch([("phone", chunk.encode("utf-8"))])[0]["steps"]
+    return np.array(steps).reshape(-1, 3)
+
+
+@pytest.mark.skipif(not BUNDLED_TRACES, reason="no bundled traces")
+@pytest.mark.parametrize("interval", [0.3, 1.0])
+def test_streamed_steps_match_pdr(interval):
+    for trace_filename in BUNDLED_TRACES[:2]:
+        track = pdr.pdr(data_parser.tracing_parser(trace_filename))
+        steps = stream(trace_filename, interval)
+        assert abs(steps.shape[0] - len(track)) <= 1
+        # Time from each streamed step to the nearest step of the zero-phase filter
+        offsets = np.abs(steps[:, 0][:, None] - track.tss[None, :]).min(axis=1)
+        assert np.median(offsets) <= 20 and np.percentile(offsets, 90) <= 60
+
+
+@pytest.mark.skipif(not BUNDLED_TRACES, reason="no bundled traces")
+def test_failing_session_is_isolated():
+    chunks = [chunk.encode("utf-8") for _, chunk in service.trace_chunks(BUNDLED_TRACES[0])][:10]
+    alone = service.LocalizationService(NoAssets())
+    alone.assets.loaded.set()
+    expected = [alone.process_batch([("good", chunk)])[0] for chunk in chunks]
+
+    localization_service = service.LocalizationService(NoAssets())
+    localization_service.assets.loaded.set()
+    for ix, chunk in enumerate(chunks):
+        bad = "{}\tTYPE_ACCELEROMETER\tx\t2\t3\n".format(ix).encode("utf-8")
+        results = localization_service.process_batch([("bad", chunks[ix]), ("good", chunk), ("bad", bad)])
+        assert isinstance(results[0], ValueError) and results[0] is results[2]
+        assert results[1] == expected[ix]
+    assert localization_service.sessions["bad"].n_steps == 0
+
+
+@pytest.mark.skipif(not BUNDLED_TRACES, reason="no bundled traces")
+def test_held_requests_are_replayed_in_order():
+    chunks = [chunk.encode("utf-8") for _, chunk in service.trace_chunks(BUNDLED_TRACES[0])][:12]
+    expected = stream(BUNDLED_TRACES[0])
+    assets = NoAssets()
+    localization_service = service.LocalizationService(assets, batch_window=0.001)
+
+    async def replay():
+        batches = asyncio.ensure_future(localization_service.run_batches())
+        held = [asyncio.ensure_future(localization_service.submit("phone", chunk)) for chunk in chunks[:6]]
+        # A session without floor goes on while the floor of the other one loads
+        other = await asyncio.wait_for(localization_service.submit("other", b"1\tTYPE_WAYPOINT\t1\t2\n"), 5)
+        await asyncio.sleep(0.05)
+        held += [asyncio.ensure_future(localization_service.submit("phone", chunk)) for chunk in chunks[6:]]
+        await asyncio.sleep(0.05)
+        assert not any(future.done() for future in held)
+        assets.loaded.set()
+        results = await asyncio.wait_for(asyncio.gather(*held), 10)
+        batches.cancel()
+        return other, results
+
+    other, results = asyncio.run(replay())
+    assert other["steps"] == [] and len(assets.floors) == 1
+    # The held requests are counted once, when they are computed
+    assert localization_service.stats()["requests"] == len(chunks) + 1
+    # The requests of a session computed by a same batch share its result
+    batch_results = [result for ix, result in enumerate(results) if ix == 0 or result is not results[ix - 1]]
+    assert [result["n_steps"] for result in batch_results] == \
+        list(np.cumsum([len(result["steps"]) for result in batch_results]))
+    steps = np.array([step for result in batch_results for step in result["steps"]]).reshape(-1, 3)
+    assert steps.shape[0] > 10
+    np.testing.assert_array_equal(steps[:, 0], expected[:steps.shape[0], 0])
+
+
+def test_step_headings_of_each_session():
+    localization_service = service.LocalizationService(NoAssets())
+    sessions = [service.Session(session_id) for session_id in ["a", "b", "c"]]
+    sessions[2].heading = 0.5
+    # Timestamps 2 ** 42 ms apart between the sessions, which (session << 42) + tss keys would mix up
+    tss = np.array([2 ** 43 + np.array([0, 100, 200]), 2 ** 42 + np.array([50, 150, 250])])
+    headings = np.array([[0.1, 0.2, 0.3], [-0.1, -0.2, -0.3]])
+    half_angles = np.stack([np.zeros_like(headings), np.zeros_like(headings), -np.sin(headings / 2)], axis=-1)
+    records = [{"rotation_vector": data_parser.SensorsXYZ(tss=tss[ix], xyz=half_angles[ix].astype(np.float32))}
+               for ix in range(2)] + [{}]
+    step_tss = [2 ** 43 + np.array([-10, 0, 150, 400]), 2 ** 42 + np.array([60, 200]), 2 ** 43 + np.array([0])]
+    step_headings = localization_service._step_headings(sessions, records, step_tss)
+    np.testing.assert_allclose(step_headings[0], [np.nan, 0.1, 0.2, 0.3], atol=1e-6)
+    np.testing.assert_allclose(step_headings[1], [-0.1, -0.2], atol=1e-6)
+    np.testing.assert_allclose(step_headings[2], [0.5])
+    np.testing.assert_allclose([session.heading for session in sessions], [0.3, -0.3, 0.5], atol=1e-6)
+
+
+def test_http_errors():
+    localization_service = service.LocalizationService(NoAssets())
+
+    async def exchange(messages):
+        server = await asyncio.start_server(localization_service.handle_connection, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        statuses = []
+        async with server:
+            for message in messages:
+                reader, writer = await asyncio.open_connection("127.0.0.1", port)
+                writer.write(message)
+                await writer.drain()
+                start_line = await reader.readline()
+                statuses.append(int(start_line.split(b" ")[1]))
+                writer.close()
+        return statuses
+
+    assert asyncio.run(exchange([
+        b"POST /sessions/phone HTTP/1.1\r\nContent-Length: abc\r\n\r\n",
+        "POST /sessions/phone HTTP/1.1\r\nContent-Length: {}\r\n\r\n".format(service.MAX_BODY_BYTES + 1).encode(),
+        b"GARBAGE\r\nContent-Length: 0\r\n\r\n",
+        b"GET /nowhere HTTP/1.1\r\nContent-Length: 0\r\n\r\n",
+        b"POST /stats HTTP/1.1\r\nContent-Length: 0\r\n\r\n",
+    ])) == [400, 413, 400, 404, 405]
@@ -0,0 +1,101 @@
+"""Entries of trace_cache.TraceCache: memory-mapped hits equal to the parsed traces, invalidation by mtime,
+eviction of the least recently used entries and the size file kept by concurrent writers.
+
+Usage:
+    python -m pytest tests
+"""
+from indoor_positioning import data_parser, trace_cache
+from dataclasses import fields
+
+import os
+import time
+import numpy as np
+import pytest
+
+
+def write_trace(trace_dir, name, n_scans):
+    lines = ["#\tstartTime:0", "#\tSiteID:site\tSiteName:name\tFloorId:floor\tFloorName:F1",
+             "0\tTYPE_WAYPOINT\t1.5\t2.5"]
+    for ix in range(n_scans):
+        lines.append("{}\tTYPE_ACCELEROMETER\t{}\t0.5\t9.8".format(ix, ix / 10))
+        lines.append("{}\tTYPE_WIFI\tssid\t{:02x}:00\t-{}\t2412\t0".format(ix, ix % 50, 40 + ix % 30))
+        lines.append("{}\tTYPE_BEACON\tuuid\t1\t{}\t-65\t-70\t1.0\tmac".format(ix, ix % 3))
+    trace_dir.mkdir(parents=True, exist_ok=True)
+    (trace_dir / (name + ".txt")).write_text("\n".join(lines) + "\n")
+    return str(trace_dir / (name + ".txt"))
+
+
+def entries_bytes(cache_dir):
+    return sum(file.stat().st_size for entry_dir in cache_dir.iterdir() if entry_dir.is_dir()
+               for file in entry_dir.iterdir())
+
+
+def test_hits_are_memory_maps_of_the_parsed_trace(tmp_path):
+    trace_filename = write_trace(tmp_path / "traces", "trace", 500)
+    cache = trace_cache.TraceCache(str(tmp_path / "cache"))
+    parsed = cache.load(trace_filename)
+    cached = cache.load(trace_filename)
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    for field in fields(data_parser.TraceData):
+        value, cached_value = getattr(parsed, field.name), getattr(cached, field.name)
+        if isinstance(value, str):
+            assert cached_value == value, field.name
+            continue
+        for columns_field in fields(value):
+            array = getattr(cached_value, columns_field.name)
+            np.testing.assert_array_equal(array, getattr(value, columns_field.name))
+            assert isinstance(array, np.memmap) and not array.flags.writeable
+    assert cache.size() == entries_bytes(tmp_path / "cache")
+
+    # An edited trace is parsed again
+    os.utime(trace_filename, ns=(0, 0))
+    cache.load(trace_filename)
+    assert cache.misses == 2
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    traces = [write_trace(tmp_path / "traces", "trace{}".format(ix), 300) for ix in range(6)]
+    cache = trace_cache.TraceCache(str(tmp_path / "cache"), max_bytes=None)
+    cache.load(traces[0])
+    entry_bytes = cache.size()
+    cache.clear()
+
+    # Room for 3 entries, evicted down to 80% of it, 2 entries
+    cache = trace_cache.TraceCache(str(tmp_path / "cache"), max_bytes=int(3.5 * entry_bytes))
+    for trace_filename in traces[:3]:
+        cache.load(trace_filename)
+        time.sleep(0.01)
+    # The first trace is used again, the second one is then the least recently used
+    cache.load(traces[0])
+    time.sleep(0.01)
+    cache.load(traces[3])
+    assert cache.size() == entries_bytes(tmp_path / "cache") <= trace_cache.LOW_WATER * cache.max_bytes
+    hits = cache.hits
+    cache.load(traces[0])
+    cache.load(traces[3])
+    assert cache.hits == hits + 2
+    cache.load(traces[1])
+    assert cache.hits == hits + 2
+
+    cache.clear()
+    assert cache.size() == 0 and not [path for path in (tmp_path / "cache").iterdir() if path.is_dir()]
+
+
+def test_size_file_of_concurrent_workers(tmp_path):
+    for ix in range(12):
+        write_trace(tmp_path / "traces" / "site" / "F1", "trace{}".format(ix), 100 + 10 * ix)
+    summaries = trace_cache.fill_cache(str(tmp_path / "traces"), str(tmp_path / "cache"), workers=3, chunksize=1,
+                                       progress=False)
+    assert len(summaries) == 12 and not any("error" in summary or summary["hit"] for summary in summaries)
+    cache = trace_cache.TraceCache(str(tmp_path / "cache"))
+    assert cache.size() == entries_bytes(tmp_path / "cache")
+
+    summaries = trace_cache.fill_cache(str(tmp_path / "traces"), str(tmp_path / "cache"), workers=3, chunksize=1,
+                                       progress=False)
+    assert all(summary["hit"] for summary in summaries)
+
+
+def test_not_valid_workers(tmp_path):
+    with pytest.raises(ValueError):
+        trace_cache.fill_cache(str(tmp_path), str(tmp_path / "cache"), workers=0)
@@ -0,0 +1,99 @@
+"""Downsampling of visualizer against loop implementations of min/max decimation and LTTB, and the HTML of
+figures_to_html including plotly.js only once.
+
+Usage:
+    python -m pytest tests
+"""
+from indoor_positioning import visualizer
+
+import numpy as np
+import pytest
+
+
+def loop_minmax(y, n_bins):
+    starts = np.linspace(0, y.shape[0], n_bins + 1).astype(np.int64)
+    kept = {0, y.shape[0] - 1}
+    for start, end in zip(starts[:-1], starts[1:]):
+        bucket = y[start:end]
+        if np.isnan(bucket).all():
+            # A bucket of missing values keeps its first sample
+            kept.add(int(start))
+            continue
+        kept |= {start + int(np.nanargmax(bucket)), start + int(np.nanargmin(bucket))}
+    return sorted(kept)
+
+
+def loop_lttb(x, y, n_out):
+    edges = np.linspace(1, x.shape[0] - 1, n_out - 1).astype(np.int64)
+    selected = [0]
+    for bucket, (start, end) in enumerate(zip(edges[:-1], edges[1:])):
+        if bucket + 2 < len(edges):
+            next_x, next_y = x[end:edges[bucket + 2]].mean(), y[end:edges[bucket + 2]].mean()
+        else:
+            next_x, next_y = x[-1], y[-1]
+        previous = selected[-1]
+        areas = [abs((x[previous] - next_x) * (y[ix] - y[previous]) - (x[previous] - x[ix]) * (next_y - y[previous]))
+                 for ix in range(start, end)]
+        selected.append(start + int(np.argmax(areas)))
+    return selected + [x.shape[0] - 1]
+
+
+@pytest.fixture
+def series():
+    rng = np.random.default_rng(0)
+    x = np.cumsum(rng.integers(15, 25, 5003)).astype("float64")
+    y = 9.8 + np.sin(x / 500) + rng.normal(0, 0.3, x.shape[0])
+    # Ties, spikes and missing values
+    y[100:140] = 9.8
+    y[[1000, 3000]] = [30.0, -10.0]
+    y[2000:2010] = np.nan
+    return x, y
+
+
+@pytest.mark.parametrize("n_bins", [1, 7, 100, 2000])
+def test_minmax_indices(series, n_bins):
+    _, y = series
+    indices = visualizer.minmax_indices(y, n_bins)
+    assert indices.tolist() == loop_minmax(y, n_bins)
+    assert indices.shape[0] <= 2 * n_bins + 2 and {1000, 3000} <= set(indices.tolist())
+    np.testing.assert_array_equal(visualizer.minmax_indices(y[:50], 30), np.arange(50))
+
+
+@pytest.mark.parametrize("n_out", [3, 10, 500])
+def test_lttb_indices(series, n_out):
+    x, y = series
+    y = np.nan_to_num(y, nan=9.8)
+    indices = visualizer.lttb_indices(x, y, n_out)
+    assert indices.tolist() == loop_lttb(x, y, n_out)
+    assert indices.shape[0] == n_out and np.all(np.diff(indices) > 0)
+    np.testing.assert_array_equal(visualizer.lttb_indices(x[:50], y[:50], 60), np.arange(50))
+
+
+def test_downsample_indices_keep_every_series(series):
+    x, y = series
+    y = np.nan_to_num(y, nan=9.8)
+    other = -y
+    indices = visualizer.downsample_indices(x, [y, other], 200, method="lttb")
+    assert set(visualizer.lttb_indices(x, other, 200).tolist()) <= set(indices.tolist())
+    indices = visualizer.downsample_indices(x, [y, other], 200)
+    assert set(visualizer.minmax_indices(y, 99).tolist()) <= set(indices.tolist()) and indices.shape[0] <= 400
+    with pytest.raises(ValueError):
+        visualizer.downsample_indices(x, [y], 200, method="every")
+
+
+@pytest.mark.parametrize("add_js", [True, "directory"])
+def test_plotlyjs_is_included_once(tmp_path, add_js):
+    go = pytest.importorskip("plotly.graph_objects")
+    import plotly.offline as pyo
+
+    header = pyo.get_plotlyjs()[:60]
+    figs = [go.Figure(go.Scatter(x=[0, 1, 2], y=[ix, ix + 1, ix])) for ix in range(3)]
+    filename = tmp_path / "figures.html"
+    visualizer.figures_to_html(figs, str(filename), add_js=add_js)
+    page = filename.read_text(encoding="utf-8")
+    assert page.count("Plotly.newPlot") == 3
+    if add_js == "directory":
+        assert header not in page and page.count('src="{}"'.format(visualizer.PLOTLYJS_FILE)) == 1
+        assert (tmp_path / visualizer.PLOTLYJS_FILE).read_text(encoding="utf-8").startswith(header)
+    else:
+        assert page.count(header) == 1 and page.index(header) < page.index("Plotly.newPlot")
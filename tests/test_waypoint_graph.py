@@ -0,0 +1,31 @@
+"""Edges of waypoint_graph.WaypointGraph, which stay inside the floor outline, on a synthetic L-shaped floor.
+
+Usage:
+    python -m pytest tests
+"""
+from indoor_positioning.gridding.occupancy import OccupancyGridMap
+from indoor_positioning.waypoint_graph import WaypointGraph
+from shapely.geometry import MultiPolygon, Polygon, box
+
+import numpy as np
+import pytest
+
+# 20 x 20 m frame, whose top right quarter is out of the L-shaped floor
+OUTLINE = Polygon([(0, 0), (20, 0), (20, 10), (10, 10), (10, 20), (0, 20)])
+LAYOUT = MultiPolygon([box(0, 0, 1, 1), box(4, 4, 6, 6), box(19, 19, 20, 20)])
+
+WAYPOINTS = np.array([[15, 5], [5, 17], [8, 8], [15, 15]])
+
+
+def test_edges_stay_inside_the_outline():
+    graph = WaypointGraph.build(WAYPOINTS, OccupancyGridMap(LAYOUT, 0.5, outline=OUTLINE), max_edge_length=20)
+    assert sorted(map(tuple, np.sort(graph.edges, axis=1))) == [(0, 2), (1, 2)]
+    length, path = graph.shortest_path(0, 1)
+    assert path == [0, 2, 1]
+    assert length == pytest.approx(np.hypot(7, 3) + np.hypot(3, 9))
+    assert graph.shortest_path(0, 3) == (np.inf, [])
+
+
+def test_without_outline_edges_cross_the_outside():
+    graph = WaypointGraph.build(WAYPOINTS, OccupancyGridMap(LAYOUT, 0.5), max_edge_length=20)
+    assert graph.shortest_path(0, 1)[1] == [0, 1]
@@ -0,0 +1,59 @@
+"""Persistent waypoint_index.WaypointIndex: only the new or changed traces of a floor are parsed again, and its
+waypoints are those of data_parser.waypoint_list.
+
+Usage:
+    python -m pytest tests
+"""
+from indoor_positioning import data_parser
+from indoor_positioning.waypoint_index import WaypointIndex
+
+import os
+import numpy as np
+
+
+def write_trace(floor_dir, name, waypoints):
+    lines = ["#\tstartTime:0", "#\tSiteID:site\tSiteName:name\tFloorId:floor\tFloorName:F1"]
+    for ts, (x, y) in enumerate(waypoints):
+        lines.append("{}\tTYPE_WIFI\tssid\tbssid\t-50\t2412\t0".format(ts))
+        lines.append("{}\tTYPE_WAYPOINT\t{}\t{}".format(ts, x, y))
+    floor_dir.mkdir(parents=True, exist_ok=True)
+    (floor_dir / (name + ".txt")).write_text("\n".join(lines) + "\n")
+    return str(floor_dir / (name + ".txt"))
+
+
+def test_only_changed_traces_are_parsed(tmp_path):
+    floor_dir = tmp_path / "site" / "F1"
+    traces = [write_trace(floor_dir, "trace{}".format(ix), [(ix, 1.5), (ix, 2.5)]) for ix in range(3)]
+    index = WaypointIndex(str(tmp_path / "index"))
+    np.testing.assert_array_equal(index.waypoints(str(floor_dir)), data_parser.waypoint_list(str(floor_dir)))
+    assert (index.parsed, index.reused) == (3, 0)
+
+    # A new index object reads the saved file
+    index = WaypointIndex(str(tmp_path / "index"))
+    trace_waypoints = index.update(str(floor_dir))
+    assert (index.parsed, index.reused) == (0, 3)
+    assert trace_waypoints[traces[1]].tss.tolist() == [0, 1]
+    assert trace_waypoints[traces[1]].xy.tolist() == [[1, 1.5], [1, 2.5]]
+
+    write_trace(floor_dir, "trace1", [(7, 7.5)])
+    os.utime(traces[1], ns=(0, 0))
+    os.remove(traces[2])
+    write_trace(floor_dir, "trace3", [(3, 3.5)])
+    index = WaypointIndex(str(tmp_path / "index"))
+    waypoints = index.waypoints(str(floor_dir))
+    assert (index.parsed, index.reused) == (2, 1)
+    np.testing.assert_array_equal(waypoints, data_parser.waypoint_list(str(floor_dir)))
+    assert waypoints.tolist() == [[0, 1.5], [0, 2.5], [3, 3.5], [7, 7.5]]
+
+    index = WaypointIndex(str(tmp_path / "index"))
+    assert sorted(index.update(str(floor_dir))) == sorted([traces[0], traces[1], str(floor_dir / "trace3.txt")])
+    assert (index.parsed, index.reused) == (0, 3)
+
+
+def test_floors_have_their_own_index(tmp_path):
+    write_trace(tmp_path / "site" / "F1", "trace", [(1, 1)])
+    write_trace(tmp_path / "site" / "F2", "trace", [(2, 2)])
+    index = WaypointIndex(str(tmp_path / "index"))
+    assert index.waypoints(str(tmp_path / "site" / "F1")).tolist() == [[1, 1]]
+    assert index.waypoints(str(tmp_path / "site" / "F2")).tolist() == [[2, 2]]
+    assert len(list((tmp_path / "index").glob("*.npz"))) == 2